@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Count the connections and round-trips per migrated version
+
+A migration of ``--versions`` versions, each running a ``true`` operation,
+is applied with ``allow_serie``. The bookkeeping is written in temporary
+tables (``marabunta_version_bench``, ``marabunta_checkpoint_bench``, ...),
+dropped at the end, so the benchmark can run on any database reachable
+with the usual environment variables (``PGHOST``, ``PGUSER``, ...).
+The names of their primary keys are the ones of the marabunta tables, use
+a database without them::
+
+    $ python benchmarks/bookkeeping_queries.py -d bench_db --versions 100
+
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from marabunta.config import Config  # noqa: E402
+from marabunta.database import Database, MigrationTable  # noqa: E402
+from marabunta.model import (  # noqa: E402
+    Migration, MigrationOption, Operation, Version,
+)
+from marabunta.runner import Runner  # noqa: E402
+
+counters = {'connections': 0, 'queries': 0}
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+
+    def execute(self, query, vars=None):
+        counters['queries'] += 1
+        return super(CountingCursor, self).execute(query, vars)
+
+
+def counting_connect(connect):
+    def wrapped(*args, **kwargs):
+        counters['connections'] += 1
+        kwargs['cursor_factory'] = CountingCursor
+        return connect(*args, **kwargs)
+    return wrapped
+
+
+def build_migration(count):
+    options = MigrationOption()
+    versions = []
+    for idx in range(count):
+        number = 'setup' if idx == 0 else '0.0.{}'.format(idx)
+        version = Version(number, options)
+        version.add_operation('pre', Operation('true'))
+        versions.append(version)
+    return Migration(versions, options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', '-d', required=True)
+    parser.add_argument('--versions', '-n', type=int, default=50)
+    args = parser.parse_args()
+
+    psycopg2.connect = counting_connect(psycopg2.connect)
+
+    config = Config(None, args.database, db_host=None, allow_serie=True)
+    database = Database(config)
+    table = MigrationTable(database)
+    migration = build_migration(args.versions)
+    runner = Runner(config, migration, database, table)
+    # all the tables written by the runner
+    tables = [table, runner.checkpoint_table, runner.stats_table]
+    if runner.log_table:
+        tables.append(runner.log_table)
+    for bench_table in tables:
+        bench_table.table_name += '_bench'
+    stdout = sys.stdout
+    start = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            runner.perform()
+    finally:
+        sys.stdout = stdout
+        duration = time.perf_counter() - start
+        connections, queries = counters['connections'], counters['queries']
+        with database.cursor_autocommit() as cursor:
+            for bench_table in tables:
+                cursor.execute('DROP TABLE IF EXISTS {}'.format(
+                    bench_table.table_name
+                ))
+        database.close()
+
+    print('versions:                 {}'.format(args.versions))
+    print('duration:                 {:.2f}s'.format(duration))
+    print('connections per version:  {:.2f}'.format(
+        connections / args.versions))
+    print('queries per version:      {:.2f}'.format(
+        queries / args.versions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Measure the cold start of marabunta when there is nothing to migrate
+
+This is the case of almost every start of an Odoo container which calls
+marabunta in its entrypoint. Each run is a new python process, so imports
+are part of the measure.
+
+The database must be reachable with the usual environment variables
+(``PGHOST``, ``PGUSER``, ...). The migration file is applied once before
+the measures so the following runs have nothing to do::
+
+    $ python benchmarks/noop_startup.py -d bench_db -f tests/examples/migration.yml
+
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def run_marabunta(args):
+    command = [sys.executable, '-m', 'marabunta',
+               '--migration-file', args.migration_file,
+               '--database', args.database,
+               '--web-port', str(args.web_port)]
+    start = time.perf_counter()
+    subprocess.run(command, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', '-d', required=True)
+    parser.add_argument('--migration-file', '-f', required=True)
+    parser.add_argument('--runs', '-n', type=int, default=20)
+    parser.add_argument('--web-port', type=int, default=18069)
+    args = parser.parse_args()
+    args.migration_file = os.path.abspath(args.migration_file)
+
+    # apply the migration (no-op if already done)
+    run_marabunta(args)
+
+    timings = [run_marabunta(args) for __ in range(args.runs)]
+    print('runs:   {}'.format(args.runs))
+    print('min:    {:.1f} ms'.format(min(timings) * 1000))
+    print('median: {:.1f} ms'.format(statistics.median(timings) * 1000))
+    print('max:    {:.1f} ms'.format(max(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Compare the output engines on a command printing a lot of logs
+
+A fake ``odoo`` prints ``--size`` MB of log lines. It is executed, in a
+separate process for each engine so their peak RSS can be compared, by:
+
+* ``pipes``: :class:`marabunta.model.Operation` in non-interactive mode,
+  streaming the output from pipes;
+* ``pexpect``: the previous implementation, a pseudo-terminal read by
+  ``pexpect`` until EOF, the whole output being kept in ``child.before``.
+
+The console output is sent to ``/dev/null``. ``pexpect`` searches the
+whole buffer for EOF after each read, it can take a very long time on
+large outputs, ``--engines pipes`` runs only the new engine::
+
+    $ python benchmarks/operation_output.py --size 1024
+    $ python benchmarks/operation_output.py --size 64 --engines pexpect,pipes
+
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+FAKE_ODOO = """
+import sys
+line = ('2026-01-01 00:00:00,000 1 INFO db odoo.modules.loading: '
+        'loading module %s\\n' % ('x' * 40)).encode()
+count = int(sys.argv[1]) * 1024 * 1024 // len(line)
+out = sys.stdout.buffer
+for __ in range(count):
+    out.write(line)
+"""
+
+
+def run_pipes(args):
+    from marabunta.model import Operation
+    Operation(args)._execute(lambda *a, **kw: None, interactive=False)
+
+
+def run_pexpect(args):
+    from io import StringIO
+
+    import pexpect
+    child = pexpect.spawn(args[0], args[1:], timeout=None, encoding='utf8')
+    child.logfile = sys.stdout
+    child.expect(pexpect.EOF)
+    log_buffer = StringIO()
+    log_buffer.write(child.before)
+    child.close()
+    log_buffer.seek(0)
+    '\n'.join(log_buffer.read().splitlines())
+
+
+ENGINES = {'pipes': run_pipes, 'pexpect': run_pexpect}
+
+
+def measure(engine, size):
+    """Executed in the child process, print the results as json"""
+    with tempfile.NamedTemporaryFile('w', suffix='.py',
+                                     delete=False) as script:
+        script.write(FAKE_ODOO)
+    args = [sys.executable, script.name, str(size)]
+    stdout = sys.stdout
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            ENGINES[engine](args)
+        finally:
+            sys.stdout = stdout
+            os.unlink(script.name)
+    duration = time.perf_counter() - start
+    # kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'duration': duration, 'max_rss': max_rss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Size of the output in MB')
+    parser.add_argument('--engines', default='pexpect,pipes',
+                        help='Comma-separated engines to compare')
+    parser.add_argument('--engine', choices=sorted(ENGINES),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.engine:
+        measure(args.engine, args.size)
+        return
+
+    print('output size: {} MB'.format(args.size))
+    for engine in args.engines.split(','):
+        output = subprocess.check_output([
+            sys.executable, __file__, '--engine', engine,
+            '--size', str(args.size),
+        ])
+        result = json.loads(output)
+        print('{:<8} {:>8.2f}s  {:>8.1f} MB/s  peak RSS {:>8.1f} MB'.format(
+            engine,
+            result['duration'],
+            args.size / result['duration'],
+            result['max_rss'] / 1024.,
+        ))
+
+
+if __name__ == '__main__':
+    main()
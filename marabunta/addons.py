@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Knowledge of the addons source code and dependencies
+
+The addons are looked up in the addons path, the first directory
+containing an addon wins, as in Odoo. The content of each addon is hashed,
+in a pool of threads, and compared with the checksum stored when it was
+last installed or upgraded.
+
+Reading the whole content of the addons is the expensive part, so a
+fingerprint of the files (path, size and modification time) is stored
+along with the checksum: when it has not changed, the content is not read
+again.
+
+The version of their manifest, read without executing them, can be
+compared with the version installed in the database instead. The parsed
+manifests are stored with their size and modification time as well
+(:class:`ManifestReader`), they are parsed again only when they changed.
+
+The dependency graph of the addons tells which addons Odoo upgrades along
+with the ones it is asked to upgrade (:func:`prune_upgrades`,
+:func:`upgrade_closure`). Odoo updates the dependencies from the manifests
+before upgrading the addons, so the ones declared in the manifests
+(:meth:`ManifestReader.dependencies`) replace the ones stored in the
+database.
+"""
+
+import ast
+import hashlib
+import os
+import re
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .database import AddonChecksumTable, AddonManifestTable
+
+# files not part of the source of an addon
+IGNORED_DIRECTORIES = {'__pycache__'}
+IGNORED_EXTENSIONS = ('.pyc', '.pyo')
+
+READ_SIZE = 1024 * 1024
+
+
+def find_addons(addons_path, names):
+    """Return the directory of each addon found in the addons path
+
+    :param addons_path: list of directories containing addons
+    :return: dict with the name of the addons as keys
+    """
+    directories = {}
+    for name in names:
+        for path in addons_path:
+            directory = os.path.join(path, name)
+            if manifest_path(directory):
+                directories[name] = directory
+                break
+    return directories
+
+
+def manifest_path(directory):
+    """Return the path of the manifest of an addon, None if not found"""
+    for name in ('__manifest__.py', '__openerp__.py'):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _literal_depends(value):
+    """Return the names of a literal list of dependencies, None if not one"""
+    if not isinstance(value, (ast.List, ast.Tuple)):
+        return None
+    depends = set()
+    for element in value.elts:
+        if not (isinstance(element, ast.Constant) and
+                isinstance(element.value, str)):
+            return None
+        depends.add(element.value)
+    return depends
+
+
+def parse_manifest(path):
+    """Return the version and the dependencies of a manifest
+
+    The manifest is parsed without executing it.
+
+    :return: the version and the set of the direct dependencies, None when
+             they are not given as a literal list
+    """
+    with open(path, 'rb') as source:
+        tree = ast.parse(source.read(), path)
+    version = None
+    depends = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Dict):
+            for key, value in zip(node.keys, node.values):
+                if not isinstance(key, ast.Constant):
+                    continue
+                if key.value == 'version' and isinstance(value, ast.Constant):
+                    version = u'{}'.format(value.value)
+                elif key.value == 'depends':
+                    depends = _literal_depends(value)
+            break
+    return version, depends
+
+
+def version_bumped(manifest_version, latest_version):
+    """Compare the version of a manifest with the installed one
+
+    Odoo prefixes the versions of the manifests without serie (``1.0.3``)
+    with the serie (``16.0.1.0.3``) in ``latest_version``.
+    """
+    if not manifest_version or not latest_version:
+        return True
+    if manifest_version == latest_version:
+        return False
+    serie = latest_version[:-len(manifest_version) - 1]
+    return not (latest_version.endswith(u'.' + manifest_version) and
+                re.match(r'^\d+\.\d+$', serie))
+
+
+def addon_files(directory):
+    """Return the files of an addon, sorted, relative to its directory"""
+    files = []
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames[:] = [name for name in dirnames
+                       if name not in IGNORED_DIRECTORIES]
+        for filename in filenames:
+            if filename.endswith(IGNORED_EXTENSIONS):
+                continue
+            path = os.path.join(root, filename)
+            files.append(os.path.relpath(path, directory))
+    files.sort()
+    return files
+
+
+def addon_fingerprint(directory, files):
+    """Hash of the path, size and modification time of the files"""
+    digest = hashlib.sha1()
+    for name in files:
+        stat = os.stat(os.path.join(directory, name))
+        digest.update(u'{}\0{}\0{}\n'.format(
+            name, stat.st_size, stat.st_mtime_ns,
+        ).encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def addon_checksum(directory, files):
+    """Hash of the path and the content of the files"""
+    digest = hashlib.sha1()
+    for name in files:
+        digest.update(name.encode('utf-8', 'surrogateescape') + b'\0')
+        with open(os.path.join(directory, name), 'rb') as source:
+            for block in iter(lambda: source.read(READ_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def ancestors(dependencies, name, cache=None):
+    """Return all the direct and indirect dependencies of an addon
+
+    :param dependencies: dict of the direct dependencies of the addons
+    :param cache: dict to keep the ancestors of the addons between calls
+    """
+    if cache is None:
+        cache = {}
+    if name in cache:
+        return cache[name]
+    result = set()
+    # mark the addon as visited in case of circular dependencies
+    cache[name] = result
+    for depends in dependencies.get(name, ()):
+        result.add(depends)
+        result |= ancestors(dependencies, depends, cache)
+    return result
+
+
+def prune_upgrades(to_upgrade, dependencies):
+    """Remove the addons upgraded anyway with one of their dependencies
+
+    Odoo upgrades the installed addons depending on an upgraded addon, so
+    an addon is redundant when one of its dependencies, direct or not, is
+    upgraded as well.
+
+    :return: the addons to upgrade, sorted with the deepest dependencies
+             first, and the set of the redundant addons
+    """
+    cache = {}
+    to_upgrade = set(to_upgrade)
+    covered = set()
+    for name in to_upgrade:
+        for depends in ancestors(dependencies, name, cache) & to_upgrade:
+            # addons in a dependency cycle do not cover each other
+            if name not in ancestors(dependencies, depends, cache):
+                covered.add(name)
+                break
+    kept = sorted(to_upgrade - covered,
+                  key=lambda name: (len(cache[name]), name))
+    return kept, covered
+
+
+def upgrade_closure(to_upgrade, dependencies, installed):
+    """Return all the addons Odoo upgrades when asked for ``to_upgrade``
+
+    :param installed: names of the installed addons
+    """
+    dependents = {}
+    for name, depends in dependencies.items():
+        for depend in depends:
+            dependents.setdefault(depend, set()).add(name)
+    closure = set(to_upgrade)
+    queue = deque(closure)
+    while queue:
+        for dependent in dependents.get(queue.popleft(), ()):
+            if dependent in installed and dependent not in closure:
+                closure.add(dependent)
+                queue.append(dependent)
+    return closure
+
+
+class AddonsChecksum(object):
+    """Compare the content of the addons with their stored checksums
+
+    :param addons_path: list of directories containing addons
+    :param max_workers: number of threads hashing the addons
+    """
+
+    def __init__(self, database, addons_path, max_workers=None):
+        self.table = AddonChecksumTable(database)
+        self.addons_path = addons_path
+        self.max_workers = max_workers
+        # name: (checksum, fingerprint) computed during this run
+        self._computed = {}
+        self._table_created = False
+
+    def _compute(self, directory, stored):
+        files = addon_files(directory)
+        fingerprint = addon_fingerprint(directory, files)
+        if stored and stored[1] == fingerprint:
+            return stored[0], fingerprint
+        return addon_checksum(directory, files), fingerprint
+
+    def unchanged(self, names):
+        """Return the addons whose content did not change
+
+        The addons not found in the addons path or without stored
+        checksum are considered as changed.
+        """
+        directories = find_addons(self.addons_path, names)
+        if not directories:
+            return set()
+        self._ensure_table()
+        stored = self.table.read(sorted(directories))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                name: executor.submit(self._compute, directory,
+                                      stored.get(name))
+                for name, directory in directories.items()
+            }
+            for name, future in futures.items():
+                self._computed[name] = future.result()
+        return {name for name in directories
+                if name in stored and
+                stored[name][0] == self._computed[name][0]}
+
+    def record(self, names):
+        """Store the checksums of installed or upgraded addons"""
+        missing = [name for name in names if name not in self._computed]
+        if missing:
+            self.unchanged(missing)
+        rows = [(name,) + self._computed[name] for name in sorted(names)
+                if name in self._computed]
+        if rows:
+            self._ensure_table()
+            self.table.write(rows, datetime.now())
+
+    def _ensure_table(self):
+        if not self._table_created:
+            self.table.create_if_not_exists()
+            self._table_created = True
+
+
+class ManifestReader(object):
+    """Read the manifests of the addons found in the addons path
+
+    The manifests are stored in ``marabunta_addon_manifest`` with their
+    modification time and size: the ones which did not change since a
+    previous run are not parsed again, the other ones are parsed in a pool
+    of threads. The manifests parsed during a run are stored by
+    :meth:`save`.
+
+    :param addons_path: list of directories containing addons
+    :param max_workers: number of threads parsing the manifests
+    """
+
+    def __init__(self, database, addons_path, max_workers=None):
+        self.table = AddonManifestTable(database)
+        self.addons_path = addons_path
+        self.max_workers = max_workers
+        # path: (mtime, size, version, depends) stored or parsed
+        self._manifests = {}
+        # paths parsed during this run, not stored yet
+        self._parsed = set()
+
+    def read(self, names):
+        """Return the version and the dependencies of the addons by name
+
+        The addons not found in the addons path are not returned.
+        """
+        paths = {name: manifest_path(directory) for name, directory
+                 in find_addons(self.addons_path, names).items()}
+        stats = {path: os.stat(path) for path in paths.values()}
+        unknown = [path for path in stats if path not in self._manifests]
+        if unknown:
+            self._manifests.update(self.table.read(unknown))
+        changed = [
+            path for path, stat in stats.items()
+            if self._manifests.get(path, ())[:2] !=
+            (stat.st_mtime_ns, stat.st_size)
+        ]
+        if changed:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                parsed = list(executor.map(parse_manifest, changed))
+            for path, manifest in zip(changed, parsed):
+                stat = stats[path]
+                self._manifests[path] = (stat.st_mtime_ns,
+                                         stat.st_size) + manifest
+                self._parsed.add(path)
+        return {name: self._manifests[path][2:]
+                for name, path in paths.items()}
+
+    def dependencies(self, dependencies, names=()):
+        """Update the dependencies of the addons with their manifests
+
+        The dependencies stored in ``ir_module_module_dependency`` are the
+        ones of the last installation or upgrade of the addons, a
+        dependency added or removed since then in a manifest is only known
+        by Odoo once it updates the list of the addons. The manifests whose
+        ``depends`` is not a literal list keep the stored dependencies.
+
+        :param dependencies: dict of the direct dependencies of the addons
+        :param names: addons to read in addition to the ones of
+                      ``dependencies``
+        :return: a new dict of the direct dependencies
+        """
+        dependencies = dict(dependencies)
+        manifests = self.read(set(dependencies) | set(names))
+        for name, (__, depends) in manifests.items():
+            if depends is not None:
+                dependencies[name] = depends
+        return dependencies
+
+    def save(self):
+        """Store the manifests parsed during this run"""
+        if not self._parsed:
+            return
+        self.table.create_if_not_exists()
+        self.table.write([(path,) + self._manifests[path]
+                          for path in sorted(self._parsed)])
+        self._parsed = set()
+
+
+class ManifestVersions(object):
+    """Compare the version of the manifests with the installed versions
+
+    An addon whose manifest has the same version as its ``latest_version``
+    in ``ir_module_module`` is considered as unchanged.
+
+    :param module_table: state of the addons in the database
+    :type module_table: :class:`marabunta.database.IrModuleModule`
+    :param manifests: reader of the manifests of the addons path
+    :type manifests: :class:`ManifestReader`
+    """
+
+    def __init__(self, module_table, manifests):
+        self.module_table = module_table
+        self.manifests = manifests
+
+    def manifest_versions(self, names):
+        """Return the version of the manifest of the addons by name"""
+        return {name: version
+                for name, (version, __) in self.manifests.read(names).items()}
+
+    def unchanged(self, names):
+        """Return the addons whose version did not change
+
+        The addons not found in the addons path are considered as changed.
+        """
+        latest_versions = {addon.name: addon.latest_version
+                           for addon in self.module_table.read_state()}
+        return {name for name, version
+                in self.manifest_versions(names).items()
+                if not version_bumped(version, latest_versions.get(name))}
+
+    def record(self, names):
+        """Odoo stores the new versions itself"""
@@ -2,11 +2,23 @@
 # Copyright 2016-2017 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
-from distutils.util import strtobool
 import argparse
 import os
 
 
+def strtobool(val):
+    """Convert a string representation of truth to 1 or 0.
+
+    Same as ``distutils.util.strtobool``, which is costly to import.
+    """
+    val = val.lower()
+    if val in ('y', 'yes', 't', 'true', 'on', '1'):
+        return 1
+    elif val in ('n', 'no', 'f', 'false', 'off', '0'):
+        return 0
+    raise ValueError('invalid truth value %r' % (val,))
+
+
 class Config(object):
     def __init__(self,
                  migration_file,
@@ -18,7 +30,14 @@ class Config(object):
                  mode=None,
                  allow_serie=False,
                  force_version=None,
+                 resume=False,
                  override_translations=False,
+                 lock_timeout=None,
+                 lock_namespace=None,
+                 operation_timeout=None,
+                 addons_snapshot='full',
+                 log_storage='text',
+                 addons_path=None,
                  web_host='localhost',
                  web_port=8069,
                  web_resp_status=503,
@@ -36,7 +55,14 @@ class Config(object):
         self.force_version = force_version
         if force_version and not allow_serie:
             self.allow_serie = True
+        self.resume = resume
         self.override_translations = override_translations
+        self.lock_timeout = lock_timeout
+        self.lock_namespace = lock_namespace
+        self.operation_timeout = operation_timeout
+        self.addons_snapshot = addons_snapshot
+        self.log_storage = log_storage
+        self.addons_path = addons_path
         self.web_host = web_host
         self.web_port = web_port
         self.web_resp_status = web_resp_status
@@ -62,7 +88,14 @@ class Config(object):
                    mode=args.mode,
                    allow_serie=args.allow_serie,
                    force_version=args.force_version,
+                   resume=args.resume,
                    override_translations=args.override_translations,
+                   lock_timeout=args.lock_timeout,
+                   lock_namespace=args.lock_namespace,
+                   operation_timeout=args.operation_timeout,
+                   addons_snapshot=args.addons_snapshot,
+                   log_storage=args.log_storage,
+                   addons_path=args.addons_path,
                    web_host=args.web_host,
                    web_port=args.web_port,
                    web_resp_status=args.web_resp_status,
@@ -113,62 +146,19 @@ def get_args_parser():
     """Return a parser for command line options."""
     parser = argparse.ArgumentParser(
         description='Marabunta: Migrating ants for Odoo')
+    # required to run the migration, checked by marabunta.core.main as
+    # the subcommands do not need it
     parser.add_argument('--migration-file', '-f',
                         action=EnvDefault,
                         envvar='MARABUNTA_MIGRATION_FILE',
-                        required=True,
+                        required=False,
                         help='The yaml file containing the migration steps')
     parser.add_argument('--database', '-d',
                         action=EnvDefault,
                         envvar=['MARABUNTA_DATABASE', 'PGDATABASE'],
                         required=True,
                         help="Odoo's database")
-    parser.add_argument('--db-user', '-u',
-                        action=EnvDefault,
-                        envvar=['MARABUNTA_DB_USER', 'PGUSER'],
-                        required=True,
-                        help="Odoo's database user")
-    parser.add_argument('--db-password', '-w',
-                        action=EnvDefault,
-                        envvar=['MARABUNTA_DB_PASSWORD', 'PGPASSWORD'],
-                        required=False,
-                        help="Odoo's database password")
-    parser.add_argument('--db-port', '-p',
-                        action=EnvDefault,
-                        envvar=['MARABUNTA_DB_PORT', 'PGPORT'],
-                        type=int,
-                        default=5432,
-                        required=False,
-                        help="Odoo's database port")
-    parser.add_argument('--db-host', '-H',
-                        action=EnvDefault,
-                        envvar=['MARABUNTA_DB_HOST', 'PGHOST'],
-                        required=False,
-                        help="Odoo's database host")
-    parser.add_argument('--mode',
-                        action=EnvDefault,
-                        envvar='MARABUNTA_MODE',
-                        required=False,
-                        help="Specify the mode in which we run the migration,"
-                             "such as 'sample' or 'full'. Additional operations "
-                             "of this mode will be executed after the main "
-                             "operations and the addons list of this mode "
-                             "will be merged with the main addons list.")
-    parser.add_argument('--allow-serie',
-                        action=BoolEnvDefault,
-                        required=False,
-                        envvar='MARABUNTA_ALLOW_SERIE',
-                        help='Allow to run more than 1 version upgrade at a '
-                             'time.')
-    parser.add_argument('--force-version',
-                        required=False,
-                        default=os.environ.get('MARABUNTA_FORCE_VERSION'),
-                        help='Force upgrade of a version, even if it has '
-                             'already been applied.')
-    parser.add_argument("--override-translations",
-                        required=False,
-                        default=os.environ.get("MARABUNTA_OVERRIDE_TRANSLATIONS"),
-                        help="Force override of translations.")
+    add_migration_arguments(parser)
 
     group = parser.add_argument_group(
         title='Web',
@@ -217,4 +207,191 @@ def get_args_parser():
                            'Such monitoring requests will return HTTP 200 '
                            'status code instead of the default 503.'
                        ))
+
+    subparsers = parser.add_subparsers(
+        dest='command',
+        metavar='COMMAND',
+        help='Run a command instead of the migration',
+    )
+    log_parser = subparsers.add_parser(
+        'log',
+        help='Print the log of a version, stored in any format',
+    )
+    log_parser.add_argument('version', help='Number of the version')
+    plan_parser = subparsers.add_parser(
+        'plan',
+        help='Print the steps the migration would execute, with their '
+             'estimated duration, without executing them',
+    )
+    plan_parser.add_argument('--json', action='store_true',
+                             help='Print the plan as JSON')
+    return parser
+
+
+def add_migration_arguments(parser):
+    """Add the options common to the commands running a migration"""
+    parser.add_argument('--db-user', '-u',
+                        action=EnvDefault,
+                        envvar=['MARABUNTA_DB_USER', 'PGUSER'],
+                        required=True,
+                        help="Odoo's database user")
+    parser.add_argument('--db-password', '-w',
+                        action=EnvDefault,
+                        envvar=['MARABUNTA_DB_PASSWORD', 'PGPASSWORD'],
+                        required=False,
+                        help="Odoo's database password")
+    parser.add_argument('--db-port', '-p',
+                        action=EnvDefault,
+                        envvar=['MARABUNTA_DB_PORT', 'PGPORT'],
+                        type=int,
+                        default=5432,
+                        required=False,
+                        help="Odoo's database port")
+    parser.add_argument('--db-host', '-H',
+                        action=EnvDefault,
+                        envvar=['MARABUNTA_DB_HOST', 'PGHOST'],
+                        required=False,
+                        help="Odoo's database host")
+    parser.add_argument('--mode',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_MODE',
+                        required=False,
+                        help="Specify the mode in which we run the migration,"
+                             "such as 'sample' or 'full'. Additional operations "
+                             "of this mode will be executed after the main "
+                             "operations and the addons list of this mode "
+                             "will be merged with the main addons list.")
+    parser.add_argument('--allow-serie',
+                        action=BoolEnvDefault,
+                        required=False,
+                        envvar='MARABUNTA_ALLOW_SERIE',
+                        help='Allow to run more than 1 version upgrade at a '
+                             'time.')
+    parser.add_argument('--force-version',
+                        required=False,
+                        default=os.environ.get('MARABUNTA_FORCE_VERSION'),
+                        help='Force upgrade of a version, even if it has '
+                             'already been applied.')
+    parser.add_argument('--resume',
+                        action=BoolEnvDefault,
+                        required=False,
+                        envvar='MARABUNTA_RESUME',
+                        help='Resume a version which failed, skipping its '
+                             'operations already done.')
+    parser.add_argument("--override-translations",
+                        required=False,
+                        default=os.environ.get("MARABUNTA_OVERRIDE_TRANSLATIONS"),
+                        help="Force override of translations.")
+    parser.add_argument('--lock-timeout',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_LOCK_TIMEOUT',
+                        type=int,
+                        required=False,
+                        help='When a concurrent process is already running '
+                             'the migration, maximum time in seconds to '
+                             'wait for it to finish (no limit by default).')
+    parser.add_argument('--lock-namespace',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_LOCK_NAMESPACE',
+                        required=False,
+                        help='Namespace of the lock preventing concurrent '
+                             'migrations. Only processes using the same '
+                             'database and namespace exclude each other.')
+    parser.add_argument('--operation-timeout',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_OPERATION_TIMEOUT',
+                        type=int,
+                        required=False,
+                        help='Timeout in seconds of the operations which '
+                             'have none in the migration file (no limit by '
+                             'default). The command of an operation is '
+                             'terminated with its process group when it '
+                             'expires.')
+    parser.add_argument('--addons-snapshot',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_ADDONS_SNAPSHOT',
+                        choices=['full', 'delta'],
+                        default='full',
+                        required=False,
+                        help="How the state of the addons is stored after "
+                             "each version in 'marabunta_version': 'full' "
+                             "list (default) or 'delta' with the state of "
+                             "the previous version.")
+    parser.add_argument('--log-storage',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_LOG_STORAGE',
+                        choices=['text', 'compressed', 'table'],
+                        default='text',
+                        required=False,
+                        help="Where the logs of the versions are stored: "
+                             "'text' in the 'log' column of "
+                             "'marabunta_version' at the end of the version "
+                             "(default), 'compressed' in its "
+                             "'log_compressed' column (zstd when "
+                             "'zstandard' is installed, zlib otherwise) or "
+                             "'table' in 'marabunta_version_log', written "
+                             "while the version is applied.")
+    parser.add_argument('--addons-path',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_ADDONS_PATH',
+                        required=False,
+                        help="Comma-separated list of the directories "
+                             "containing the addons, as Odoo's "
+                             "addons_path. Required by the "
+                             "'skip_unchanged_addons' option.")
+
+
+def get_multi_args_parser():
+    """Return a parser for the command line options of marabunta-multi."""
+    parser = argparse.ArgumentParser(
+        description='Marabunta: Migrating ants for Odoo, '
+                    'on several databases in parallel')
+    parser.add_argument('--migration-file', '-f',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_MIGRATION_FILE',
+                        required=True,
+                        help='The yaml file containing the migration steps')
+    parser.add_argument('--databases', '-d',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_DATABASES',
+                        required=False,
+                        help='Comma-separated list of the databases '
+                             'to migrate')
+    parser.add_argument('--database-pattern',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_DATABASE_PATTERN',
+                        required=False,
+                        help="Migrate the databases whose name matches this "
+                             "pattern (SQL LIKE syntax, e.g. 'tenant_%%')")
+    parser.add_argument('--maintenance-database',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_MAINTENANCE_DATABASE',
+                        default='postgres',
+                        required=False,
+                        help="Database used to list the databases matching "
+                             "--database-pattern (defaults to 'postgres')")
+    parser.add_argument('--jobs', '-j',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_JOBS',
+                        type=int,
+                        default=4,
+                        required=False,
+                        help='Number of databases migrated in parallel '
+                             '(defaults to 4)')
+    parser.add_argument('--backup-jobs',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_BACKUP_JOBS',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help='Number of backups running in parallel '
+                             '(defaults to 1)')
+    parser.add_argument('--log-dir',
+                        action=EnvDefault,
+                        envvar='MARABUNTA_LOG_DIR',
+                        required=False,
+                        help='Write the output of each database in '
+                             '<log-dir>/<database>.log instead of the '
+                             'standard output')
+    add_migration_arguments(parser)
     return parser
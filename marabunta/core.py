@@ -14,27 +14,40 @@ required.
 
 """
 
+import hashlib
+import json
 import logging
-import time
+import struct
+import sys
 import threading
 
-from .config import Config, get_args_parser
-from .database import Database, MigrationTable
-from .output import safe_print
-from .parser import YamlParser
-from .runner import Runner
-from .web import WebApp
+from datetime import datetime
 
-from pkg_resources import get_distribution, DistributionNotFound
+import psycopg2
 
-try:
-    __version__ = get_distribution(__name__).version
-except DistributionNotFound:
-    # package is not installed
-    pass
+from .config import Config, get_args_parser
+from .database import (
+    CompletionTable, Database, MigrationTable, VersionLogTable,
+)
+from .exception import MigrationError
+from .output import print_decorated, safe_print
 
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
+
+def __getattr__(name):
+    # the version is computed lazily, reading the distribution metadata
+    # slows down the start of the application
+    if name == '__version__':
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            return version('marabunta')
+        except PackageNotFoundError:
+            # package is not installed
+            pass
+    raise AttributeError(name)
+
+
 # The number below has been generated as below:
 # pg_lock accepts an int8 so we build an hash composed with
 # contextual information and we throw away some bits
@@ -46,46 +59,140 @@ logging.getLogger('werkzeug').setLevel(logging.ERROR)
 ADVISORY_LOCK_IDENT = 7141416871301361999
 
 
+def advisory_lock_ident(database, namespace=None):
+    """Return the key of the advisory lock taken during a migration
+
+    Without namespace, the key is :data:`ADVISORY_LOCK_IDENT`, the one of
+    the previous versions of marabunta, so they still exclude each other
+    during an upgrade of marabunta. With a namespace, the key is a hash of
+    the name of the database and of the namespace::
+
+        lock_name = 'marabunta:<database>:<namespace>'
+        hasher = hashlib.sha1()
+        hasher.update(lock_name.encode('utf-8'))
+        lock_ident = struct.unpack('<q', hasher.digest()[:8])[0]
+
+    Advisory locks are already scoped to a database by PostgreSQL, having
+    the name of the database in the key gives each database its own key
+    for tools that manage several databases. The namespace allows to
+    have distinct locks (thus concurrent migrations) on the same database.
+    """
+    if not namespace:
+        return ADVISORY_LOCK_IDENT
+    hasher = hashlib.sha1()
+    hasher.update(u':'.join(['marabunta', database, namespace])
+                  .encode('utf-8'))
+    return struct.unpack('<q', hasher.digest()[:8])[0]
+
+
 def pg_advisory_lock(cursor, lock_ident):
     cursor.execute('SELECT pg_try_advisory_xact_lock(%s);', (lock_ident,))
     acquired = cursor.fetchone()[0]
     return acquired
 
 
+def pg_advisory_lock_wait(cursor, lock_ident, lock_timeout=None):
+    """Wait on the server until the lock is acquired
+
+    :param lock_timeout: maximum time to wait for the lock in seconds,
+                         waits indefinitely when empty
+    """
+    timeout = '{}s'.format(lock_timeout) if lock_timeout else '0'
+    cursor.execute('SET LOCAL lock_timeout = %s;', (timeout,))
+    cursor.execute('SELECT pg_advisory_xact_lock(%s);', (lock_ident,))
+
+
 class ApplicationLock(threading.Thread):
 
-    def __init__(self, connection):
-        self.acquired = False
+    def __init__(self, connection, lock_ident, lock_timeout=None):
         self.connection = connection
+        self.lock_ident = lock_ident
+        self.lock_timeout = lock_timeout
         self.replica = False
-        self.stop = False
+        self.error = None
+        # set after the first attempt to acquire the lock
+        self._attempted = threading.Event()
+        # set when the lock is acquired or could not be acquired
+        self._ready = threading.Event()
+        self._release = threading.Event()
         super(ApplicationLock, self).__init__()
+        # do not prevent the process to exit if it is waiting on the lock
+        self.daemon = True
+
+    @property
+    def acquired(self):
+        return self._ready.is_set() and not self.error
 
     def run(self):
         with self.connection.cursor() as cursor:
             # If the migration is run concurrently (in several
             # containers, hosts, ...), only 1 is allowed to proceed
             # with the migration. It will be the first one to win
-            # the advisory lock. The others will be flagged as 'replica'.
-            while not pg_advisory_lock(cursor, ADVISORY_LOCK_IDENT):
-                if not self.replica:  # print only the first time
+            # the advisory lock. The others will be flagged as 'replica'
+            # and wait on the server until the lock is released: no
+            # polling, the lock is handed over as soon as it is released.
+            try:
+                if not pg_advisory_lock(cursor, self.lock_ident):
                     safe_print('A concurrent process is already '
                                'running the migration')
-                self.replica = True
-                time.sleep(0.5)
-            else:
-                self.acquired = True
-                idx = 0
-                while not self.stop:
-                    # keep the connection alive to maintain the advisory
-                    # lock by running a query every 30 seconds
-                    if idx == 60:
-                        cursor.execute("SELECT 1")
-                        idx = 0
-                    idx += 1
-                    # keep the sleep small to be able to exit quickly
-                    # when 'stop' is set to True
-                    time.sleep(0.5)
+                    self.replica = True
+                    self._attempted.set()
+                    pg_advisory_lock_wait(cursor, self.lock_ident,
+                                          lock_timeout=self.lock_timeout)
+            except psycopg2.Error as err:
+                # includes the cancellation of the wait by 'cancel()'
+                self.error = err
+                return
+            finally:
+                self._attempted.set()
+                self._ready.set()
+            # keep the connection alive to maintain the advisory
+            # lock by running a query every 30 seconds
+            while not self._release.wait(30):
+                cursor.execute("SELECT 1")
+
+    def ready(self):
+        """Return True when the lock is acquired or could not be"""
+        return self._ready.is_set()
+
+    def wait_replica(self):
+        """Wait for the first attempt to get the lock
+
+        Return True when a concurrent process was holding the lock.
+        """
+        self._attempted.wait()
+        return self.replica
+
+    def wait_acquired(self):
+        """Block until the lock is acquired
+
+        Raise a MigrationError if the lock could not be acquired.
+        """
+        self._ready.wait()
+        if self.error:
+            raise MigrationError(
+                u'Could not acquire the migration lock: {}'.format(
+                    self.error
+                )
+            )
+
+    def release(self):
+        """Stop the thread, the lock is released with the transaction"""
+        self._release.set()
+        self.join()
+
+    def cancel(self):
+        """Stop waiting for the lock and stop the thread"""
+        self.connection.cancel()
+        self.release()
+
+
+def migration_file_hash(filename):
+    """Return the sha1 of the content of a migration file"""
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        hasher.update(fh.read())
+    return hasher.hexdigest()
 
 
 class WebServer(threading.Thread):
@@ -104,6 +211,28 @@ def migrate(config):
     :param config: The configuration to be applied
     :type config: Config
     """
+    database = Database(config)
+    try:
+        _migrate(config, database)
+    finally:
+        database.close()
+
+
+def _migrate(config, database):
+    migration_hash = migration_file_hash(config.migration_file)
+
+    # Fast path for the most common case: the migration file has already
+    # been fully applied, we can leave before having started the web
+    # server, parsed the migration file or acquired the lock.
+    if is_up_to_date(config, database, migration_hash):
+        print_decorated(u'migration: nothing to migrate')
+        return
+
+    # imported here, they are slow to import and not needed by the
+    # fast path above
+    from .parser import YamlParser
+    from .web import WebApp
+
     webapp = WebApp(config.web_host, config.web_port,
                     custom_maintenance_file=config.web_custom_html,
                     resp_status=config.web_resp_status,
@@ -114,37 +243,122 @@ def migrate(config):
     webserver.daemon = True
     webserver.start()
 
-    migration_parser = YamlParser.parse_from_file(config.migration_file)
-    migration = migration_parser.parse()
+    def load_migration():
+        migration_parser = YamlParser.parse_from_file(config.migration_file)
+        return migration_parser.parse()
 
-    database = Database(config)
+    if not apply_migration(config, database, migration_hash,
+                           load_migration):
+        print_decorated(u'migration: applied by a concurrent process')
+
+
+def is_up_to_date(config, database, migration_hash):
+    """Return True if the migration file has already been applied"""
+    if config.force_version:
+        return False
+    return CompletionTable(database).is_up_to_date(migration_hash)
+
+
+def apply_migration(config, database, migration_hash, load_migration,
+                    backup_lock=None):
+    """Acquire the migration lock and run the migration on a database
 
+    :param load_migration: callable returning the :class:`Migration`,
+                           only called when the migration has to be run
+    :param backup_lock: optional context manager acquired around the
+                        backup
+    :return: True if the migration has been run by this process, False if
+             a concurrent process has applied it while we were waiting for
+             the lock
+    """
+    from .runner import Runner
+
+    completion = CompletionTable(database)
     with database.connect() as lock_connection:
-        application_lock = ApplicationLock(lock_connection)
+        application_lock = ApplicationLock(
+            lock_connection,
+            advisory_lock_ident(config.database, config.lock_namespace),
+            lock_timeout=config.lock_timeout,
+        )
         application_lock.start()
-
-        while not application_lock.acquired:
-            time.sleep(0.5)
-        else:
-            if application_lock.replica:
-                # when a replica could finally acquire a lock, it
-                # means that the concurrent process has finished the
-                # migration or that it failed to run it.
-                # In both cases after the lock is released, this process will
-                # verify if it has still to do something (if the other process
-                # failed mainly).
-                application_lock.stop = True
-                application_lock.join()
-            # we are not in the replica or the lock is released: go on for the
-            # migration
+        replica = application_lock.wait_replica()
+        if replica and not config.force_version:
+            # A concurrent process is running the migration, most of the
+            # time it will apply it successfully and there will be nothing
+            # left to do: stop as soon as it notifies its success.
+            done = completion.wait_done(migration_hash,
+                                        application_lock.ready)
+            if not done and application_lock.acquired:
+                # the lock may be handed over before the notification
+                # is read
+                done = completion.is_up_to_date(migration_hash)
+            if done:
+                application_lock.cancel()
+                return False
+        # when a replica could finally acquire a lock, it
+        # means that the concurrent process has finished the
+        # migration or that it failed to run it.
+        # In both cases after the lock is released, this process will
+        # verify if it has still to do something (if the other process
+        # failed mainly).
+        application_lock.wait_acquired()
 
         try:
+            migration = load_migration()
             table = MigrationTable(database)
-            runner = Runner(config, migration, database, table)
+            runner = Runner(config, migration, database, table,
+                            backup_lock=backup_lock)
             runner.perform()
+            # when a version is forced, the other ones may not be applied
+            if not config.force_version and migration.versions:
+                completion.create_if_not_exists()
+                completion.mark_done(migration_hash,
+                                     migration.versions[-1].number,
+                                     datetime.now())
         finally:
-            application_lock.stop = True
-            application_lock.join()
+            application_lock.release()
+    return True
+
+
+def print_log(config, number):
+    """Print the log of a version, as a stream
+
+    The log is read from ``marabunta_version_log`` when the version has
+    been applied with ``--log-storage table``, otherwise from
+    ``marabunta_version``, compressed or not.
+    """
+    database = Database(config)
+    try:
+        chunks = VersionLogTable(database).iter_chunks(number)
+        first = next(chunks, None)
+        if first is None:
+            chunks = MigrationTable(database).iter_log(number)
+        else:
+            sys.stdout.write(first)
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        sys.stdout.flush()
+    finally:
+        database.close()
+
+
+def print_plan(config, as_json=False):
+    """Print the steps the migration would execute, see :mod:`.plan`"""
+    from .parser import YamlParser
+    from .plan import Plan, format_plan
+    from .runner import Runner
+
+    migration = YamlParser.parse_from_file(config.migration_file).parse()
+    database = Database(config)
+    try:
+        runner = Runner(config, migration, database, MigrationTable(database))
+        plan = Plan(runner).build()
+    finally:
+        database.close()
+    if as_json:
+        safe_print(json.dumps(plan, indent=2))
+    else:
+        safe_print(format_plan(plan))
 
 
 def main():
@@ -152,6 +366,21 @@ def main():
     parser = get_args_parser()
     args = parser.parse_args()
     config = Config.from_parse_args(args)
+    if args.command == 'log':
+        try:
+            print_log(config, args.version)
+        except MigrationError as err:
+            parser.exit(1, u'{}\n'.format(err))
+        return
+    if not args.migration_file:
+        parser.error('the following arguments are required: '
+                     '--migration-file/-f')
+    if args.command == 'plan':
+        try:
+            print_plan(config, as_json=args.json)
+        except MigrationError as err:
+            parser.exit(1, u'{}\n'.format(err))
+        return
     migrate(config)
 
 
@@ -2,19 +2,33 @@
 # Copyright 2016-2017 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import hashlib
 import json
+import select
+import time
 
 import psycopg2
 
 from collections import namedtuple
 from contextlib import contextmanager
 
+from .exception import MigrationError
+from .logs import compress_log, iter_decompressed_log
+from .version import MarabuntaVersion
+
 
 class Database(object):
 
+    # when the connection has been idle for longer than this delay (in
+    # seconds), it is checked before being used: it may have been closed
+    # by the server or a proxy during a long operation
+    health_check_interval = 30
+
     def __init__(self, config):
         self.config = config
         self.name = config.database
+        self._connection = None
+        self._last_used = None
 
     def dsn(self):
         cfg = self.config
@@ -33,22 +47,102 @@ class Database(object):
 
     @contextmanager
     def connect(self, autocommit=False):
-        with psycopg2.connect(**self.dsn()) as conn:
-            if autocommit:
-                conn.autocommit = True
-            yield conn
+        """Open a new connection, closed when leaving the context"""
+        conn = psycopg2.connect(**self.dsn())
+        try:
+            with conn:
+                if autocommit:
+                    conn.autocommit = True
+                yield conn
+        finally:
+            conn.close()
+
+    def _is_alive(self, conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+        return True
+
+    def _autocommit_connection(self):
+        conn = self._connection
+        if conn is not None and not conn.closed:
+            idle = time.monotonic() - self._last_used
+            if idle > self.health_check_interval and not self._is_alive(conn):
+                self.close()
+        if self._connection is None or self._connection.closed:
+            self._connection = psycopg2.connect(**self.dsn())
+            self._connection.autocommit = True
+        return self._connection
 
     @contextmanager
     def cursor_autocommit(self):
-        with self.connect(autocommit=True) as conn:
+        """Cursor on a connection kept open between the calls
+
+        The bookkeeping queries are short but numerous, opening a
+        connection for each of them is slow (TLS, poolers, ...).
+        """
+        conn = self._autocommit_connection()
+        try:
             with conn.cursor() as cursor:
                 yield cursor
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # the connection is probably broken, a new one will be
+            # opened on the next call
+            self.close()
+            raise
+        finally:
+            self._last_used = time.monotonic()
+
+    def close(self):
+        """Close the connection used by :meth:`cursor_autocommit`"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
 
+_NOT_LOADED = object()
 
-VersionRecord = namedtuple(
-    'VersionRecord',
-    'number date_start date_done log addons'
-)
+
+class VersionRecord(object):
+    """A version of the ``marabunta_version`` table
+
+    The log and the addons of a version can be large, when a ``loader`` is
+    given, they are read only when they are accessed, each one on its own:
+    reading the addons does not fetch the log.
+
+    :param loader: callable returning the ``'log'`` or the ``'addons'`` of a
+                   version from its number and the name of the detail
+    """
+
+    def __init__(self, number, date_start, date_done,
+                 log=_NOT_LOADED, addons=_NOT_LOADED, loader=None):
+        self.number = number
+        self.date_start = date_start
+        self.date_done = date_done
+        self._log = log
+        self._addons = addons
+        self._loader = loader
+
+    @property
+    def log(self):
+        if self._log is _NOT_LOADED:
+            self._log = self._loader(self.number, 'log')
+        return self._log
+
+    @log.setter
+    def log(self, value):
+        self._log = value
+
+    @property
+    def addons(self):
+        if self._addons is _NOT_LOADED:
+            self._addons = self._loader(self.number, 'addons')
+        return self._addons
+
+    def __repr__(self):
+        return u'VersionRecord<{}>'.format(self.number)
 
 
 class MigrationTable(object):
@@ -57,26 +151,67 @@ class MigrationTable(object):
         self.database = database
         self.table_name = 'marabunta_version'
         self.VersionRecord = VersionRecord
+        # maximum number of deltas applied to rebuild the addons state
+        self.addons_keyframe_interval = 20
         self._versions = None
+        # versions started again in this run, see start_version
+        self._restarted = set()
+        # the table exists and has all its columns
+        self._table_checked = False
 
     def create_if_not_exists(self):
         with self.database.cursor_autocommit() as cursor:
             query = """
-            CREATE TABLE IF NOT EXISTS {} (
+            CREATE TABLE IF NOT EXISTS {0} (
                 number VARCHAR NOT NULL,
                 date_start TIMESTAMP NOT NULL,
                 date_done TIMESTAMP,
                 log TEXT,
+                log_compressed BYTEA,
                 addons TEXT,
 
                 CONSTRAINT version_pk PRIMARY KEY (number)
             );
             """.format(self.table_name)
             cursor.execute(query)
+            self._add_columns(cursor)
+        self._table_checked = True
+
+    def _add_columns(self, cursor):
+        """Add the columns missing in a table created by an older version"""
+        query = """
+        ALTER TABLE {} ADD COLUMN IF NOT EXISTS log_compressed BYTEA;
+        """.format(self.table_name)
+        cursor.execute(query)
+
+    def _check_table(self):
+        """Check the table before reading the log or addons of a version
+
+        The logs can be read (``marabunta log``) on a database where no
+        migration has been run, or run by an older version of marabunta.
+
+        :raise MigrationError: when the table does not exist
+        """
+        if self._table_checked:
+            return
+        with self.database.cursor_autocommit() as cursor:
+            if not table_exists(cursor, self.table_name):
+                raise MigrationError(
+                    u'no {} table, no migration has been run on this '
+                    u'database'.format(self.table_name)
+                )
+            self._add_columns(cursor)
+        self._table_checked = True
+
+    def exists(self):
+        with self.database.cursor_autocommit() as cursor:
+            return table_exists(cursor, self.table_name)
 
     def versions(self):
         """ Read versions from the table
 
+        Only the number and dates of the versions are read, the log and
+        addons of a version are read when they are accessed.
         The versions are kept in cache for the next reads.
         """
         if self._versions is None:
@@ -84,97 +219,910 @@ class MigrationTable(object):
                 query = """
                 SELECT number,
                        date_start,
-                       date_done,
-                       log,
-                       addons
+                       date_done
                 FROM {}
                 """.format(self.table_name)
                 cursor.execute(query)
                 rows = cursor.fetchall()
-                versions = []
-                for row in rows:
-                    row = list(row)
-                    # convert 'addons' to json
-                    row[4] = json.loads(row[4]) if row[4] else []
-                    versions.append(
-                        self.VersionRecord(*row)
-                    )
-                self._versions = versions
+                self._versions = [
+                    self.VersionRecord(*row, loader=self._read_details)
+                    for row in rows
+                ]
         return self._versions
 
-    def start_version(self, number, start):
+    def _read_details(self, number, detail):
+        """Read the log or the addons of a version
+
+        The addons are read without the log columns: rebuilding the state
+        of the addons from a chain of deltas does not fetch nor decompress
+        the logs of the versions.
+
+        :param detail: ``'log'`` or ``'addons'``
+        """
+        self._check_table()
+        if detail == 'addons':
+            columns = 'addons'
+        else:
+            columns = 'log, log_compressed'
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            SELECT {}
+            FROM {}
+            WHERE number = %s
+            """.format(columns, self.table_name)
+            cursor.execute(query, (number,))
+            row = cursor.fetchone()
+        if detail == 'addons':
+            # convert 'addons' to json
+            return json.loads(row[0]) if row and row[0] else []
+        if not row:
+            return None
+        log, log_compressed = row
+        if log_compressed is not None:
+            log = u''.join(iter_decompressed_log(log_compressed))
+        return log
+
+    def iter_log(self, number):
+        """Yield the log of a version by chunks
+
+        :raise MigrationError: when the version or the table does not exist
+        """
+        self._check_table()
         with self.database.cursor_autocommit() as cursor:
             query = """
-            SELECT number FROM {}
+            SELECT log,
+                   log_compressed
+            FROM {}
             WHERE number = %s
             """.format(self.table_name)
             cursor.execute(query, (number,))
-            if cursor.fetchone():
-                query = """
-                UPDATE {}
-                SET date_start = %s,
-                    date_done = NULL,
-                    log = NULL,
-                    addons = NULL
-                WHERE number = %s
-                """.format(self.table_name)
-                cursor.execute(query, (start, number))
-            else:
-                query = """
-                INSERT INTO {}
-                (number, date_start)
-                VALUES (%s, %s)
-                """.format(self.table_name)
-                cursor.execute(query, (number, start))
-        self._versions = None  # reset versions cache
+            row = cursor.fetchone()
+        if not row:
+            raise MigrationError(u'version {} not found'.format(number))
+        log, log_compressed = row
+        if log_compressed is not None:
+            for chunk in iter_decompressed_log(log_compressed):
+                yield chunk
+        elif log:
+            yield log
+
+    def _update_cache(self, record):
+        """Replace a version in the cache by its new values"""
+        if self._versions is None:
+            return
+        self._versions = [version for version in self._versions
+                          if version.number != record.number]
+        self._versions.append(record)
+
+    def start_version(self, number, start, keep_log=False):
+        """Mark a version as started, its log and addons are cleared
+
+        When a version is started again (``--force-version``), the versions
+        whose addons are stored relative to it are stored as full
+        snapshots first, and it stores a full snapshot when it finishes.
 
-    def record_log(self, number, log):
+        :param keep_log: keep the log of a failed run of the version, when
+                         it is resumed
+        """
+        if any(version.number == number for version in self.versions()):
+            self._restarted.add(number)
+            self._materialize_dependents(number)
+        clear_log = """
+                log = NULL,
+                log_compressed = NULL,"""
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            INSERT INTO {}
+            (number, date_start)
+            VALUES (%s, %s)
+            ON CONFLICT (number) DO UPDATE
+            SET date_start = EXCLUDED.date_start,
+                date_done = NULL,{}
+                addons = NULL
+            RETURNING number, date_start, date_done
+            """.format(self.table_name, '' if keep_log else clear_log)
+            cursor.execute(query, (number, start))
+            row = cursor.fetchone()
+        if keep_log:
+            record = self.VersionRecord(*row, addons=[],
+                                        loader=self._read_details)
+        else:
+            record = self.VersionRecord(*row, log=None, addons=[])
+        self._update_cache(record)
+
+    def record_log(self, number, log, compress=False):
+        """Store the log of a version
+
+        :param compress: store the log compressed in ``log_compressed``
+                         instead of ``log``
+        """
         with self.database.cursor_autocommit() as cursor:
             query = """
             UPDATE {}
-            SET log = %s
+            SET log = %s,
+                log_compressed = %s
             WHERE number = %s
             """.format(self.table_name)
-            cursor.execute(query, (log, number))
-            self._versions = None  # reset versions cache
+            cursor.execute(query, self._log_values(log, compress) + (number,))
+        for version in self._versions or []:
+            if version.number == number:
+                version.log = log
 
-    def finish_version(self, number, end, log, addons):
+    def _log_values(self, log, compress):
+        """Return the values of the ``log`` and ``log_compressed`` columns"""
+        if compress and log is not None:
+            return None, psycopg2.Binary(compress_log(log))
+        return log, None
+
+    def finish_version(self, number, end, log, addons, delta=False,
+                       compress=False):
+        """Mark a version as done
+
+        :param addons: state of the addons after the version, list of
+                       dicts with the ``name`` and ``state`` keys
+        :param delta: store only the difference with the state of the
+                      version done before, see :meth:`addons_state`
+        :param compress: store the log compressed in ``log_compressed``
+        """
+        if delta and number not in self._restarted:
+            addons = self._addons_delta(number, addons)
         with self.database.cursor_autocommit() as cursor:
             query = """
             UPDATE {}
             SET date_done = %s,
                 log = %s,
+                log_compressed = %s,
                 addons = %s
             WHERE number = %s
+            RETURNING number, date_start, date_done
+            """.format(self.table_name)
+            cursor.execute(query, (end,) + self._log_values(log, compress) + (
+                json.dumps(addons, separators=(',', ':')),
+                number,
+            ))
+            row = cursor.fetchone()
+        self._update_cache(self.VersionRecord(*row, log=log, addons=addons))
+
+    def _addons_delta(self, number, addons):
+        """Return the difference between ``addons`` and the previous version
+
+        The previous version is the greatest done version below
+        ``number``. A full snapshot is returned when there is no previous
+        version or when the chain of deltas to rebuild the state would
+        become longer than ``addons_keyframe_interval``.
+        """
+        current_version = MarabuntaVersion(number)
+        done = sorted(
+            (version for version in self.versions()
+             if version.date_done and
+             MarabuntaVersion(version.number) < current_version),
+            key=lambda version: MarabuntaVersion(version.number),
+            reverse=True,
+        )
+        # the previous version, unless its state depends on this one
+        base = next((version for version in done
+                     if number not in self._addons_chain(version.number)),
+                    None)
+        if base is None:
+            return addons
+        depth = 1
+        if isinstance(base.addons, dict):
+            depth = base.addons['depth'] + 1
+        if depth > self.addons_keyframe_interval:
+            return addons
+        previous = {addon['name']: addon['state']
+                    for addon in self.addons_state(base.number)}
+        current = {addon['name']: addon['state'] for addon in addons}
+        return {
+            'base': base.number,
+            'depth': depth,
+            'changed': [{'name': name, 'state': state}
+                        for name, state in sorted(current.items())
+                        if previous.get(name) != state],
+            'removed': sorted(set(previous) - set(current)),
+        }
+
+    def addons_state(self, number):
+        """Return the full state of the addons recorded for a version
+
+        The ``addons`` of a version are either the full list of the addons
+        with their state or, when stored with ``delta``, a dict with the
+        ``base`` version it is relative to, the addons whose state has
+        ``changed`` and the names of the ``removed`` addons. The chain of
+        deltas is applied on the full list it starts from.
+
+        :return: list of dicts with the ``name`` and ``state`` keys, sorted
+                 by name
+        """
+        versions = {version.number: version for version in self.versions()}
+        deltas = []
+        addons = versions[number].addons
+        chain = [number]
+        while isinstance(addons, dict):
+            deltas.append(addons)
+            if addons['base'] in chain:
+                raise MigrationError(
+                    u'the addons of version {} are stored relative to '
+                    u'themselves: {}'.format(
+                        number, u' -> '.join(chain + [addons['base']])
+                    )
+                )
+            chain.append(addons['base'])
+            base = versions.get(addons['base'])
+            addons = base.addons if base else []
+        state = {addon['name']: addon['state'] for addon in addons}
+        for delta in reversed(deltas):
+            for addon in delta['changed']:
+                state[addon['name']] = addon['state']
+            for name in delta['removed']:
+                state.pop(name, None)
+        return [{'name': name, 'state': addon_state}
+                for name, addon_state in sorted(state.items())]
+
+    def _addons_chain(self, number):
+        """Return the versions the addons of a version are relative to"""
+        versions = {version.number: version for version in self.versions()}
+        chain = []
+        version = versions.get(number)
+        while version and isinstance(version.addons, dict):
+            if version.addons['base'] in chain:
+                break
+            chain.append(version.addons['base'])
+            version = versions.get(version.addons['base'])
+        return chain
+
+    def _materialize_dependents(self, number):
+        """Store as full snapshots the addons relative to a version"""
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            SELECT number
+            FROM {}
+            WHERE addons::json->>'base' = %s
+            """.format(self.table_name)
+            cursor.execute(query, (number,))
+            numbers = {row[0] for row in cursor.fetchall()}
+        dependents = [version for version in self.versions()
+                      if version.number in numbers]
+        if not dependents:
+            return
+        states = [(version, self.addons_state(version.number))
+                  for version in dependents]
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            UPDATE {}
+            SET addons = %s
+            WHERE number = %s
+            """.format(self.table_name)
+            cursor.executemany(query, [
+                (json.dumps(addons, separators=(',', ':')), version.number)
+                for version, addons in states
+            ])
+        for version, addons in states:
+            version._addons = addons
+
+
+class VersionLogTable(object):
+    """Log of the versions, written by chunks while they are applied
+
+    Used instead of the ``log`` column of ``marabunta_version`` with
+    ``--log-storage table``. The chunks of a version are ordered by the
+    index of the operation which produced them and by their sequence
+    number within the operation.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.table_name = 'marabunta_version_log'
+
+    def create_if_not_exists(self):
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            CREATE TABLE IF NOT EXISTS {} (
+                version VARCHAR NOT NULL,
+                operation INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                chunk TEXT NOT NULL,
+
+                CONSTRAINT version_log_pk PRIMARY KEY (version, operation, seq)
+            );
+            """.format(self.table_name)
+            cursor.execute(query)
+
+    def clear(self, version):
+        """Remove the log of a version, before it is applied again"""
+        with self.database.cursor_autocommit() as cursor:
+            query = "DELETE FROM {} WHERE version = %s".format(self.table_name)
+            cursor.execute(query, (version,))
+
+    def last_operation(self, version):
+        """Return the index of the last operation logged for a version
+
+        :return: the index, -1 when nothing has been logged
+        """
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            SELECT max(operation)
+            FROM {}
+            WHERE version = %s
+            """.format(self.table_name)
+            cursor.execute(query, (version,))
+            last = cursor.fetchone()[0]
+        return -1 if last is None else last
+
+    def write(self, rows):
+        """Insert chunks in a single statement
+
+        :param rows: list of ``(version, operation, seq, chunk)``
+        """
+        from psycopg2.extras import execute_values
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            INSERT INTO {} (version, operation, seq, chunk) VALUES %s
+            """.format(self.table_name)
+            execute_values(cursor, query, rows, page_size=len(rows))
+
+    def read(self, version):
+        """Return the full log of a version"""
+        return u''.join(self.iter_chunks(version))
+
+    def iter_chunks(self, version, itersize=100):
+        """Yield the chunks of the log of a version
+
+        They are fetched by batches of ``itersize`` with a server-side
+        cursor. Nothing is yielded when the table does not exist.
+        """
+        with self.database.cursor_autocommit() as cursor:
+            cursor.execute('SELECT to_regclass(%s)', (self.table_name,))
+            if cursor.fetchone()[0] is None:
+                return
+        with self.database.connect() as conn:
+            with conn.cursor(name='marabunta_version_log') as cursor:
+                cursor.itersize = itersize
+                query = """
+                SELECT chunk
+                FROM {}
+                WHERE version = %s
+                ORDER BY operation, seq
+                """.format(self.table_name)
+                cursor.execute(query, (version,))
+                for row in cursor:
+                    yield row[0]
+
+
+class AddonChecksumTable(object):
+    """Checksums of the addons when they were last installed or upgraded
+
+    See :mod:`marabunta.addons`.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.table_name = 'marabunta_addon_checksum'
+
+    def create_if_not_exists(self):
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            CREATE TABLE IF NOT EXISTS {} (
+                name VARCHAR NOT NULL,
+                checksum VARCHAR NOT NULL,
+                fingerprint VARCHAR NOT NULL,
+                date_done TIMESTAMP NOT NULL,
+
+                CONSTRAINT addon_checksum_pk PRIMARY KEY (name)
+            );
+            """.format(self.table_name)
+            cursor.execute(query)
+
+    def read(self, names):
+        """Return the checksum and the fingerprint of addons by name"""
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            SELECT name,
+                   checksum,
+                   fingerprint
+            FROM {}
+            WHERE name = ANY(%s)
+            """.format(self.table_name)
+            cursor.execute(query, (list(names),))
+            return {name: (checksum, fingerprint)
+                    for name, checksum, fingerprint in cursor.fetchall()}
+
+    def write(self, rows, date_done):
+        """Store checksums in a single statement
+
+        :param rows: list of ``(name, checksum, fingerprint)``
+        """
+        from psycopg2.extras import execute_values
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            INSERT INTO {} (name, checksum, fingerprint, date_done)
+            VALUES %s
+            ON CONFLICT (name) DO UPDATE
+            SET checksum = EXCLUDED.checksum,
+                fingerprint = EXCLUDED.fingerprint,
+                date_done = EXCLUDED.date_done
             """.format(self.table_name)
-            cursor.execute(query, (end, log, json.dumps(addons), number))
-            self._versions = None  # reset versions cache
+            execute_values(cursor, query,
+                           [row + (date_done,) for row in rows],
+                           page_size=len(rows))
+
+
+class AddonManifestTable(object):
+    """Version and dependencies of the manifests of the addons, by path
+
+    They are stored with the modification time and the size of the
+    manifests, a manifest is parsed again by the next runs only when they
+    changed. See :class:`marabunta.addons.ManifestReader`.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.table_name = 'marabunta_addon_manifest'
+
+    def create_if_not_exists(self):
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            CREATE TABLE IF NOT EXISTS {} (
+                path VARCHAR NOT NULL,
+                mtime BIGINT NOT NULL,
+                size BIGINT NOT NULL,
+                version VARCHAR,
+                depends TEXT,
+
+                CONSTRAINT addon_manifest_pk PRIMARY KEY (path)
+            );
+            """.format(self.table_name)
+            cursor.execute(query)
+
+    def read(self, paths):
+        """Return the stored manifests by path
+
+        Nothing is returned when the table does not exist.
+
+        :return: dict with the paths as keys and ``(mtime, size, version,
+                 depends)`` as values, ``depends`` being a set or None
+        """
+        with self.database.cursor_autocommit() as cursor:
+            cursor.execute('SELECT to_regclass(%s)', (self.table_name,))
+            if cursor.fetchone()[0] is None:
+                return {}
+            query = """
+            SELECT path,
+                   mtime,
+                   size,
+                   version,
+                   depends
+            FROM {}
+            WHERE path = ANY(%s)
+            """.format(self.table_name)
+            cursor.execute(query, (list(paths),))
+            rows = cursor.fetchall()
+        return {
+            path: (mtime, size, version,
+                   set(json.loads(depends)) if depends is not None else None)
+            for path, mtime, size, version, depends in rows
+        }
+
+    def write(self, rows):
+        """Store manifests in a single statement
+
+        :param rows: list of ``(path, mtime, size, version, depends)``
+        """
+        from psycopg2.extras import execute_values
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            INSERT INTO {} (path, mtime, size, version, depends)
+            VALUES %s
+            ON CONFLICT (path) DO UPDATE
+            SET mtime = EXCLUDED.mtime,
+                size = EXCLUDED.size,
+                version = EXCLUDED.version,
+                depends = EXCLUDED.depends
+            """.format(self.table_name)
+            execute_values(cursor, query, [
+                (path, mtime, size, version,
+                 json.dumps(sorted(depends)) if depends is not None else None)
+                for path, mtime, size, version, depends in rows
+            ], page_size=len(rows))
+
+
+class CheckpointTable(object):
+    """Steps of the versions already done, to resume a failed version
+
+    A step (operation or installation / upgrade of addons) is identified
+    by a fingerprint of its stage, position and command, see
+    :meth:`marabunta.runner.VersionRunner.fingerprint`.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.table_name = 'marabunta_checkpoint'
+
+    def create_if_not_exists(self):
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            CREATE TABLE IF NOT EXISTS {} (
+                version VARCHAR NOT NULL,
+                fingerprint VARCHAR NOT NULL,
+                step TEXT NOT NULL,
+                date_done TIMESTAMP NOT NULL,
+
+                CONSTRAINT checkpoint_pk PRIMARY KEY (version, fingerprint)
+            );
+            """.format(self.table_name)
+            cursor.execute(query)
+
+    def exists(self):
+        with self.database.cursor_autocommit() as cursor:
+            return table_exists(cursor, self.table_name)
+
+    def read(self, version):
+        """Return the fingerprints of the steps done for a version"""
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            SELECT fingerprint
+            FROM {}
+            WHERE version = %s
+            """.format(self.table_name)
+            cursor.execute(query, (version,))
+            return {row[0] for row in cursor.fetchall()}
+
+    def record(self, version, fingerprint, step, date_done):
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            INSERT INTO {} (version, fingerprint, step, date_done)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (version, fingerprint) DO UPDATE
+            SET date_done = EXCLUDED.date_done
+            """.format(self.table_name)
+            cursor.execute(query, (version, fingerprint, step, date_done))
+
+    def clear(self, version):
+        """Forget the steps of a version, done or started again"""
+        with self.database.cursor_autocommit() as cursor:
+            query = "DELETE FROM {} WHERE version = %s".format(self.table_name)
+            cursor.execute(query, (version,))
+
+
+class OperationStatsTable(object):
+    """Duration and resources used by the last execution of the operations
+
+    An operation is identified in a version and a mode (empty for the base
+    mode) by its stage and its position, such as ``post:3``. The backup has
+    an empty version.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.table_name = 'marabunta_operation_stats'
+
+    def create_if_not_exists(self):
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            CREATE TABLE IF NOT EXISTS {} (
+                version VARCHAR NOT NULL,
+                mode VARCHAR NOT NULL,
+                operation VARCHAR NOT NULL,
+                command TEXT NOT NULL,
+                date_start TIMESTAMP NOT NULL,
+                wall_time DOUBLE PRECISION NOT NULL,
+                cpu_time DOUBLE PRECISION NOT NULL,
+                max_rss BIGINT,
+                exit_code INTEGER,
+
+                CONSTRAINT operation_stats_pk
+                    PRIMARY KEY (version, mode, operation)
+            );
+            """.format(self.table_name)
+            cursor.execute(query)
+
+    def write(self, rows):
+        """Store the statistics of executions
+
+        :param rows: list of ``(version, mode, operation, command,
+                     date_start, stats)``, ``stats`` being a
+                     :class:`marabunta.process.ExecutionStats`
+        """
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            INSERT INTO {} (version, mode, operation, command, date_start,
+                            wall_time, cpu_time, max_rss, exit_code)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (version, mode, operation) DO UPDATE
+            SET command = EXCLUDED.command,
+                date_start = EXCLUDED.date_start,
+                wall_time = EXCLUDED.wall_time,
+                cpu_time = EXCLUDED.cpu_time,
+                max_rss = EXCLUDED.max_rss,
+                exit_code = EXCLUDED.exit_code
+            """.format(self.table_name)
+            cursor.executemany(query,
+                               [row[:5] + tuple(row[5]) for row in rows])
+
+    def durations(self, commands):
+        """Return the average wall time of the commands already executed
+
+        :return: dict with the commands as keys, the commands never
+                 executed are missing
+        """
+        with self.database.cursor_autocommit() as cursor:
+            if not table_exists(cursor, self.table_name):
+                return {}
+            query = """
+            SELECT command,
+                   avg(wall_time)
+            FROM {}
+            WHERE command = ANY(%s)
+            AND exit_code = 0
+            GROUP BY command
+            """.format(self.table_name)
+            cursor.execute(query, (list(commands),))
+            return dict(cursor.fetchall())
+
+    def stage_duration(self, stage):
+        """Return the average wall time of the operations of a stage
+
+        Used to estimate the duration of the installation / upgrade of
+        addons, whose command differs on each version.
+        """
+        with self.database.cursor_autocommit() as cursor:
+            if not table_exists(cursor, self.table_name):
+                return None
+            query = """
+            SELECT avg(wall_time)
+            FROM {}
+            WHERE operation LIKE %s
+            AND exit_code = 0
+            """.format(self.table_name)
+            cursor.execute(query, (stage + u':%',))
+            return cursor.fetchone()[0]
+
+
+class CompletionTable(object):
+    """Marker of the last successful run for a migration file
+
+    A row is written once all the versions of a migration file have been
+    applied. It allows to know, with a single query, that there is nothing
+    left to do for a migration file, without having to parse it.
+
+    The hash of the file is also sent as a notification on the
+    ``marabunta_completion`` channel, so processes waiting for a concurrent
+    migration know immediately that it has been done.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.table_name = 'marabunta_completion'
+        self.version_table_name = 'marabunta_version'
+        self.channel = 'marabunta_completion'
+
+    def create_if_not_exists(self):
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            CREATE TABLE IF NOT EXISTS {} (
+                hash VARCHAR NOT NULL,
+                version VARCHAR NOT NULL,
+                date_done TIMESTAMP NOT NULL,
+
+                CONSTRAINT completion_pk PRIMARY KEY (hash)
+            );
+            """.format(self.table_name)
+            cursor.execute(query)
+
+    def is_up_to_date(self, file_hash):
+        """Return True when the migration file has been fully applied
+
+        The marker of the file must exist, the version it recorded must
+        still be done and no version must be left unfinished (which would
+        require to stop the migration with an error).
+        """
+        with self.database.cursor_autocommit() as cursor:
+            query = """
+            SELECT EXISTS (
+                SELECT 1
+                FROM {completion} c
+                JOIN {version} v
+                ON v.number = c.version
+                AND v.date_done IS NOT NULL
+                WHERE c.hash = %s
+            ) AND NOT EXISTS (
+                SELECT 1
+                FROM {version}
+                WHERE date_done IS NULL
+            )
+            """.format(completion=self.table_name,
+                       version=self.version_table_name)
+            try:
+                cursor.execute(query, (file_hash,))
+            except psycopg2.ProgrammingError:
+                # the tables do not exist yet, nothing has ever been done
+                return False
+            return cursor.fetchone()[0]
+
+    def mark_done(self, file_hash, number, end):
+        with self.database.cursor_autocommit() as cursor:
+            # both statements are sent at once and run in the same
+            # transaction, the notification is sent on commit
+            query = """
+            INSERT INTO {}
+            (hash, version, date_done)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (hash) DO UPDATE
+            SET version = EXCLUDED.version,
+                date_done = EXCLUDED.date_done;
+            SELECT pg_notify(%s, %s);
+            """.format(self.table_name)
+            cursor.execute(query, (file_hash, number, end,
+                                   self.channel, file_hash))
+
+    def wait_done(self, file_hash, stop):
+        """Wait until a concurrent process has applied the migration file
+
+        Nothing is sent to the server while waiting, we listen for the
+        notification sent by :meth:`mark_done`.
+
+        :param file_hash: hash of the migration file
+        :param stop: callable, the wait is interrupted when it returns True
+        :return: True if the migration file has been applied, False if
+                 the wait has been interrupted
+        """
+        with self.database.connect(autocommit=True) as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('LISTEN {};'.format(self.channel))
+                # the concurrent process may have finished before we
+                # started to listen
+                if self.is_up_to_date(file_hash):
+                    return True
+                while not stop():
+                    # the timeout is only there to check 'stop', it does
+                    # not query the server
+                    if select.select([conn], [], [], 0.2) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        if notify.payload == file_hash:
+                            return True
+            finally:
+                conn.close()
+        return False
 
 
 class IrModuleModule(object):
+    """State of the Odoo addons
+
+    The state is read once and kept in cache. After something that may
+    have changed it has been executed, :meth:`invalidate` must be called,
+    the next read will only fetch the addons modified since the last read.
+
+    The ``write_date`` of the rows is not changed by raw SQL queries and a
+    deleted row is not fetched: a digest of the whole state, computed by
+    the server, is compared with the one of the cache and the state is
+    read again entirely when they differ.
+    """
+
+    # digest of the state of the addons, sorted by name as in python
+    digest_query = """
+    SELECT md5(string_agg(
+        name || ':' || coalesce(state, '') || ':' ||
+        coalesce(latest_version, ''),
+        ',' ORDER BY name COLLATE "C"
+    ))
+    FROM {}
+    """
 
     def __init__(self, database):
         self.database = database
         self.table_name = 'ir_module_module'
         self.ModuleRecord = namedtuple(
             'ModuleRecord',
-            'name state'
+            'name state latest_version',
+            defaults=(None,),
         )
+        self._table_exists = False
+        self._modules = None
+        self._last_write_date = None
+        self._dirty = False
+        self._dependencies = None
+
+    def invalidate(self):
+        """Refresh the state on the next read"""
+        self._dirty = True
+
+    def read_dependencies(self):
+        """Return the dependencies of the addons
+
+        Read from ``ir_module_module_dependency`` once, read again only
+        when the state of the addons changed (installation, upgrade, ...).
+
+        :return: dict with the name of the addons as keys and the set of
+                 the names of their direct dependencies as values
+        """
+        if self._dirty:
+            self.read_state()
+        if self._dependencies is None:
+            dependencies = {}
+            with self.database.cursor_autocommit() as cursor:
+                cursor.execute('SELECT to_regclass(%s)',
+                               ('ir_module_module_dependency',))
+                if cursor.fetchone()[0] is not None:
+                    cursor.execute("""
+                    SELECT module.name, dependency.name
+                    FROM ir_module_module_dependency dependency
+                    JOIN {} module
+                    ON module.id = dependency.module_id
+                    """.format(self.table_name))
+                    for name, depends in cursor.fetchall():
+                        dependencies.setdefault(name, set()).add(depends)
+            self._dependencies = dependencies
+        return self._dependencies
 
     def read_state(self):
+        if self._modules is None or self._dirty:
+            self._refresh()
+            self._dirty = False
+        return list(self._modules.values())
+
+    def _digest(self):
+        """Digest of the cached state, as computed by :attr:`digest_query`"""
+        if not self._modules:
+            return None
+        state = u','.join(
+            u'{}:{}:{}'.format(name, module.state or u'',
+                               module.latest_version or u'')
+            for name, module in sorted(self._modules.items())
+        )
+        return hashlib.md5(state.encode('utf-8')).hexdigest()
+
+    def _refresh(self):
         with self.database.cursor_autocommit() as cursor:
-            if not table_exists(cursor, self.table_name):
-                # relation ir_module_module does not exists,
-                # this is a new DB, no addon is installed
-                return []
+            if not self._table_exists:
+                cursor.execute('SELECT to_regclass(%s)', (self.table_name,))
+                if cursor.fetchone()[0] is None:
+                    # relation ir_module_module does not exists,
+                    # this is a new DB, no addon is installed
+                    self._modules = {}
+                    return
+                self._table_exists = True
 
-            addons_query = """
-            SELECT name, state
-            FROM {}
-            """.format(self.table_name)
+            if self._modules is not None:
+                cursor.execute(self.digest_query.format(self.table_name))
+                digest = cursor.fetchone()[0]
+                if digest == self._digest():
+                    return
+                # the dependencies may have changed with the addons
+                self._dependencies = None
+                # the rows written at the same time as the last read may
+                # have been written after it: read them again
+                self._read(cursor, self._last_write_date)
+                if digest == self._digest():
+                    return
+            # rows deleted or changed without write_date
+            self._modules = {}
+            self._last_write_date = None
+            self._read(cursor)
+
+    def _read(self, cursor, since=None):
+        """Read the addons modified since a date, all of them by default"""
+        addons_query = """
+        SELECT name, state, latest_version, write_date
+        FROM {}
+        """.format(self.table_name)
+        if since is None:
             cursor.execute(addons_query)
-            rows = cursor.fetchall()
-        return [self.ModuleRecord(*row) for row in rows]
+        else:
+            addons_query += """
+            WHERE write_date >= %s
+            OR write_date IS NULL
+            """
+            cursor.execute(addons_query, (since,))
+        for name, state, latest_version, write_date in cursor.fetchall():
+            self._modules[name] = self.ModuleRecord(name, state,
+                                                    latest_version)
+            if write_date and (self._last_write_date is None or
+                               write_date > self._last_write_date):
+                self._last_write_date = write_date
 
 
 def table_exists(cursor, tablename, schema='public'):
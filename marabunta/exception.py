@@ -34,6 +34,12 @@ class OperationError(MarabuntaError):
     pass
 
 
+class OperationTimeoutError(OperationError):
+    """An operation has been terminated when its timeout expired.
+    """
+    pass
+
+
 class BackupError(MigrationError):
     """An error happened during the execution of the backup.
     """
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Streaming of the logs of the operations
+
+The output of an operation is forwarded to the log by batches of complete
+lines (:class:`LineBuffer`) as it arrives, instead of being kept until the
+command ends, in interactive mode as well (:class:`OutputLog`). The part
+of the output which is stored can be limited with :class:`BoundedLog`.
+With ``--log-storage compressed``, the log of a version is compressed by
+:func:`compress_log` and stored in ``marabunta_version.log_compressed``.
+With ``--log-storage table``, the logs of a version are written in
+``marabunta_version_log`` by :class:`LogSink` while the operations run, so
+the memory used does not depend on the size of the output and the logs of
+a running migration can be read from the database.
+"""
+
+import codecs
+import time
+import zlib
+
+from collections import deque
+
+
+class LineBuffer(object):
+    """Forward an output to a log function by batches of complete lines
+
+    A batch is sent when ``size`` characters have been buffered or after
+    ``interval`` seconds. The line endings of the pseudo-terminals
+    (``\\r\\n``) are normalized and the last line ending is removed, as the
+    log adds its own.
+    """
+
+    def __init__(self, log, size=65536, interval=1.):
+        self.log = log
+        self.size = size
+        self.interval = interval
+        self._parts = []
+        self._length = 0
+        self._last_emit = time.monotonic()
+
+    def write(self, data):
+        self._parts.append(data)
+        self._length += len(data)
+        if (self._length >= self.size or
+                time.monotonic() - self._last_emit >= self.interval):
+            self._emit()
+
+    def close(self):
+        self._emit(final=True)
+
+    def _emit(self, final=False):
+        text = u''.join(self._parts)
+        rest = u''
+        if not final:
+            end = text.rfind(u'\n') + 1
+            # a line longer than the buffer is sent as is
+            if end or len(text) < self.size:
+                text, rest = text[:end], text[end:]
+        self._parts = [rest] if rest else []
+        self._length = len(rest)
+        self._last_emit = time.monotonic()
+        if text:
+            self.log(u'\n'.join(text.splitlines()),
+                     decorated=False, stdout=False)
+
+
+class OutputLog(object):
+    """Decode the raw output of a command and send it to the log by lines
+
+    The output is decoded by blocks with an incremental decoder, so a
+    character split between two blocks is decoded once complete.
+    """
+
+    def __init__(self, log):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(
+            errors='replace'
+        )
+        self._lines = LineBuffer(log)
+
+    def write(self, data):
+        """Log a block of the output, return it decoded"""
+        text = self._decoder.decode(data)
+        if text:
+            self._lines.write(text)
+        return text
+
+    def filter(self, data):
+        """Output filter for ``pexpect.spawn.interact``
+
+        The output is logged and returned unchanged to the terminal.
+        """
+        self.write(data)
+        return data
+
+    def close(self):
+        """Log the end of the output, return it decoded"""
+        text = self._decoder.decode(b'', final=True)
+        if text:
+            self._lines.write(text)
+        self._lines.close()
+        return text
+
+
+class BoundedLog(object):
+    """Log function keeping only the beginning and the end of an output
+
+    The first ``head`` characters are logged as they arrive, the last
+    ``tail`` characters are kept in a ring buffer and logged by
+    :meth:`close`, after a marker with the number of characters dropped
+    in between.
+    """
+
+    def __init__(self, log, head, tail):
+        self.log = log
+        self.head = head
+        self.tail = tail
+        self._tail = deque()
+        self._tail_length = 0
+        self._dropped = 0
+
+    def __call__(self, message, decorated=False, stdout=False):
+        if self.head:
+            if len(message) <= self.head:
+                self.head -= len(message)
+                self.log(message, decorated=decorated, stdout=stdout)
+                return
+            self.log(message[:self.head], decorated=decorated, stdout=stdout)
+            message = message[self.head:]
+            self.head = 0
+        self._tail.append(message)
+        self._tail_length += len(message)
+        while self._tail_length > self.tail:
+            excess = self._tail_length - self.tail
+            first = self._tail[0]
+            if len(first) <= excess:
+                self._tail.popleft()
+                excess = len(first)
+            else:
+                self._tail[0] = first[excess:]
+            self._tail_length -= excess
+            self._dropped += excess
+
+    def close(self):
+        if self._dropped:
+            self.log(u'[... {} characters dropped ...]'.format(self._dropped),
+                     decorated=False, stdout=False)
+        if self._tail:
+            self.log(u''.join(self._tail), decorated=False, stdout=False)
+        self._tail.clear()
+        self._tail_length = 0
+        self._dropped = 0
+
+
+class LogSink(object):
+    """Write the log of a version in ``marabunta_version_log`` by batches
+
+    The messages are buffered until ``batch_size`` characters are waiting
+    or ``interval`` seconds have passed since the last write, then they
+    are inserted in a single statement, one chunk per operation.
+
+    :param table: the log table
+    :type table: :class:`marabunta.database.VersionLogTable`
+    :param version: number of the version
+    """
+
+    def __init__(self, table, version, batch_size=262144, interval=2.):
+        self.table = table
+        self.version = version
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = []  # list of (operation, text)
+        self._length = 0
+        self._seq = {}
+        self._last_flush = time.monotonic()
+
+    def write(self, operation, message):
+        """Add a message of an operation, followed by a line ending"""
+        self._pending.append((operation, message + u'\n'))
+        self._length += len(message) + 1
+        if (self._length >= self.batch_size or
+                time.monotonic() - self._last_flush >= self.interval):
+            self.flush()
+
+    def flush(self):
+        rows = []
+        for operation, text in self._pending:
+            if rows and rows[-1][1] == operation:
+                # merge the consecutive messages of an operation
+                rows[-1][3].append(text)
+                continue
+            seq = self._seq.get(operation, 0)
+            self._seq[operation] = seq + 1
+            rows.append([self.version, operation, seq, [text]])
+        self._pending = []
+        self._length = 0
+        self._last_flush = time.monotonic()
+        if rows:
+            self.table.write([(version, operation, seq, u''.join(texts))
+                              for version, operation, seq, texts in rows])
+
+
+# first bytes of a zstd frame
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def compress_log(text):
+    """Compress a log with zstd when ``zstandard`` is installed, else zlib"""
+    data = text.encode('utf-8')
+    try:
+        import zstandard
+    except ImportError:
+        return zlib.compress(data)
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zlib_blocks(data, size):
+    decompressor = zlib.decompressobj()
+    while data:
+        block = decompressor.decompress(data, size)
+        data = decompressor.unconsumed_tail
+        if block:
+            yield block
+    block = decompressor.flush()
+    if block:
+        yield block
+
+
+def _zstd_blocks(data, size):
+    import zstandard
+    reader = zstandard.ZstdDecompressor().stream_reader(data)
+    while True:
+        block = reader.read(size)
+        if not block:
+            break
+        yield block
+
+
+def iter_decompressed_log(data, size=65536):
+    """Yield a log compressed by :func:`compress_log` by decoded chunks
+
+    At most ``size`` bytes are decompressed at a time, a large log is never
+    entirely held in memory.
+    """
+    data = bytes(data)
+    if data.startswith(ZSTD_MAGIC):
+        blocks = _zstd_blocks(data, size)
+    else:
+        blocks = _zlib_blocks(data, size)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for block in blocks:
+        text = decoder.decode(block)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
@@ -2,16 +2,33 @@
 # Copyright 2016-2018 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import heapq
+import os
+import select
+import shlex
+import signal
 import sys
+import tempfile
+import threading
+import time
 
 from builtins import object
-from io import StringIO
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
 from string import Template
 
 import pexpect
 
-from .exception import ConfigurationError, OperationError, BackupError
+from .addons import prune_upgrades
+from .exception import (
+    ConfigurationError, OperationError, OperationTimeoutError, BackupError,
+)
 from .helpers import string_types
+from .logs import BoundedLog, OutputLog
+from .process import (
+    READ_SIZE, Command, ExecutionStats, Watchdog, children_rusage,
+    execution_stats, format_rusage, run_command,
+)
 from .version import MarabuntaVersion
 
 
@@ -28,7 +45,10 @@ class Migration(object):
 
 class MigrationOption(object):
 
-    def __init__(self, install_command=None, install_args=None, backup=None):
+    def __init__(self, install_command=None, install_args=None, backup=None,
+                 log_limit=None, batch_addons=False,
+                 skip_unchanged_addons=None, max_workers=None,
+                 timeout=None):
         """Options block in a migration.
 
         :param install_command: Command ran for addons install
@@ -37,15 +57,60 @@ class MigrationOption(object):
         :type install_args: String
         :param backup: Backup options
         :type backup: Dict
+        :param log_limit: Default limit of the log stored for an operation
+        :type log_limit: Instance of a LogLimit class
+        :param batch_addons: Install or upgrade the addons of consecutive
+                             versions without operations in one run
+        :type batch_addons: Boolean
+        :param skip_unchanged_addons: How to detect the addons which do
+                                      not need to be upgraded: 'checksum'
+                                      of their content or
+                                      'manifest_version' not bumped
+        :type skip_unchanged_addons: String
+        :param max_workers: Number of operations of a graph executed at
+                            the same time
+        :type max_workers: Integer
+        :param timeout: Default timeout of the operations, in seconds
+        :type timeout: Number
         """
         self.install_command = install_command or u'odoo'
         self.install_args = install_args or u''
         self.backup = backup
+        self.log_limit = log_limit
+        self.batch_addons = batch_addons
+        self.skip_unchanged_addons = skip_unchanged_addons
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+
+class LogLimit(object):
+
+    def __init__(self, head=0, tail=0):
+        """Limit of the log stored for the output of an operation.
+
+        Only the first ``head`` KB and the last ``tail`` KB of the output
+        are stored, the output is still fully displayed.
+
+        :param head: Size kept at the beginning of the output, in KB
+        :type head: Integer
+        :param tail: Size kept at the end of the output, in KB
+        :type tail: Integer
+        """
+        self.head = head
+        self.tail = tail
+
+    def bound(self, log):
+        """Return a log function applying the limit to ``log``"""
+        return BoundedLog(log, self.head * 1024, self.tail * 1024)
+
+    def __repr__(self):
+        return u'LogLimit<head={}, tail={}>'.format(self.head, self.tail)
 
 
 class MigrationBackupOption(object):
 
-    def __init__(self, command, ignore_if, stop_on_failure=True):
+    def __init__(self, command, ignore_if, stop_on_failure=True,
+                 log_limit=None, timeout=None):
         """Backup option in migration.
 
         Migration allows using a backup command in order to perform specific
@@ -68,11 +133,23 @@ class MigrationBackupOption(object):
         :param stop_on_failure: To either stop migration
                                 if backup commands fails or to ignore it
         :type stop_on_failure: Boolean
+        :param log_limit: Limit of the log stored for the backup command
+        :type log_limit: Instance of a LogLimit class
+        :param timeout: Timeout of the backup and ``ignore_if`` commands,
+                        in seconds
+        :type timeout: Number
         """
         self._command = command
         self._ignore_if = ignore_if
         self._stop_on_failure = stop_on_failure
         self._ignore_if = ignore_if
+        self._log_limit = log_limit
+        self._timeout = timeout
+
+    @property
+    def command(self):
+        """The backup command, without the values of the placeholders"""
+        return self._command
 
     def command_operation(self, config):
         template = Template(self._command)
@@ -87,6 +164,8 @@ class MigrationBackupOption(object):
             command,
             shell=True,
             stop_on_failure=self._stop_on_failure,
+            log_limit=self._log_limit,
+            timeout=self._timeout,
         )
 
     def ignore_if_operation(self):
@@ -96,7 +175,8 @@ class MigrationBackupOption(object):
         elif self._ignore_if is True:
             # if it is specifically True
             return SilentOperation('true', shell=True)
-        return SilentOperation(self._ignore_if, shell=True)
+        return SilentOperation(self._ignore_if, shell=True,
+                               timeout=self._timeout)
 
 
 class Version(object):
@@ -138,6 +218,16 @@ class Version(object):
         noop = not any((has_upgrade_addons, has_operations))
         return noop
 
+    def has_operations(self, mode=None):
+        """Check if the version has pre or post operations
+
+        :param mode: the operations of this mode are checked too
+        """
+        modes = [None, mode] if mode else [None]
+        return any(self.pre_operations(mode=name) or
+                   self.post_operations(mode=name)
+                   for name in modes)
+
     def skip(self, db_versions):
         """Version is either noop, or it has been processed already.
         """
@@ -253,11 +343,23 @@ class VersionMode(object):
 
 class UpgradeAddonsOperation(object):
 
-    def __init__(self, options, to_install, to_upgrade, override_translations=False):
+    def __init__(self, options, to_install, to_upgrade, override_translations=False,
+                 dependencies=None):
         self.options = options
         self.to_install = set(to_install)
         self.to_upgrade = set(to_upgrade)
         self.override_translations = override_translations
+        # direct dependencies of the addons, when known, the addons
+        # upgraded anyway with one of their dependencies are not passed
+        # to the install command
+        self.dependencies = dependencies
+
+    def upgrade_list(self, exclude_addons=None):
+        """Return the addons to pass to ``-u`` and the redundant ones"""
+        to_upgrade = self.to_upgrade - (exclude_addons or set())
+        if not self.dependencies:
+            return sorted(to_upgrade), set()
+        return prune_upgrades(to_upgrade, self.dependencies)
 
     def operation(self, exclude_addons=None):
         if exclude_addons is None:
@@ -268,9 +370,9 @@ class UpgradeAddonsOperation(object):
 
         to_install = self.to_install - exclude_addons
         if to_install:
-            install_args += [u'-i', u','.join(to_install)]
+            install_args += [u'-i', u','.join(sorted(to_install))]
 
-        to_upgrade = self.to_upgrade - exclude_addons
+        to_upgrade, __ = self.upgrade_list(exclude_addons)
         if to_upgrade:
             install_args += [u'-u', u','.join(to_upgrade)]
 
@@ -279,24 +381,60 @@ class UpgradeAddonsOperation(object):
             # be raised by Odoo if we add the `--i18n-overwrite` flag
             if self.override_translations:
                 install_args += [u'--i18n-overwrite']
-            return Operation([install_command] + install_args)
+            return Operation([install_command] + install_args,
+                             log_limit=self.options.log_limit,
+                             timeout=self.options.timeout)
         else:
             return Operation('')
 
+    def without_upgrade(self, addons):
+        """Return an operation not upgrading ``addons``"""
+        return UpgradeAddonsOperation(
+            self.options,
+            self.to_install,
+            self.to_upgrade - set(addons),
+            self.override_translations,
+            dependencies=self.dependencies,
+        )
+
+    def merge(self, other):
+        """Return an operation installing or upgrading the addons of both"""
+        return UpgradeAddonsOperation(
+            self.options,
+            self.to_install | other.to_install,
+            self.to_upgrade | other.to_upgrade,
+            self.override_translations or other.override_translations,
+            dependencies=self.dependencies,
+        )
+
 
 class Operation(object):
 
-    def __init__(self, command, shell=False):
-        """ Wrap a pexpect spawn command
+    # maximum size of the output read at once from the command
+    read_size = READ_SIZE
+
+    def __init__(self, command, shell=False, log_limit=None, timeout=None):
+        """ Wrap a command, run in a pexpect terminal in interactive mode
 
         :param command: the command to run as string
         :param shell: boolean, when True, wraps the command in ``sh -c``
                       so bash environment variables are interpolated
+        :param log_limit: limit of the output stored in the log
+        :type log_limit: Instance of a LogLimit class
+        :param timeout: the command is terminated, with its process group,
+                        after this number of seconds
+        :type timeout: Number
         """
         if not isinstance(command, string_types):
             command = u' '.join(command)
         self.command = command
         self.shell = shell
+        self.log_limit = log_limit
+        self.timeout = timeout
+        # ExecutionStats of the last execution
+        self.stats = None
+        # exit status and resources used by the last command, set by _run
+        self._exit = None
 
     def _spawn_command(self):
         if self.shell:
@@ -304,97 +442,436 @@ class Operation(object):
         else:
             return self.command, []
 
+    def _command_args(self):
+        if self.shell:
+            return ["sh", "-c", self.command]
+        else:
+            return shlex.split(self.command)
+
     def __bool__(self):
         return bool(self.command)
 
-    def _execute(self, log, interactive=True):
-        assert self.command
-        cmd, options = self._spawn_command()
-        child = pexpect.spawn(cmd, options, timeout=None, encoding='utf8')
-        # interact() will transfer the child's stdout to
-        # stdout, but we also copy the output in a buffer
-        # so we can save the logs in the database
-        log_buffer = StringIO()
-        if interactive:
-            # use the interactive mode so we can use pdb in the
-            # migration scripts
-            child.interact()
-        else:
-            # set the logfile to stdout so we have an unbuffered
-            # output
-            child.logfile = sys.stdout
-            child.expect(pexpect.EOF)
-            # child.before contains all the the output of the child program
-            # before the EOF
-            # child.before is unicode
-            log_buffer.write(child.before)
-        child.close()
-        if child.signalstatus is not None:
+    def _check_status(self, exitstatus, signalstatus=None):
+        if signalstatus is None and exitstatus < 0:
+            # subprocess returns the opposite of the signal number
+            signalstatus, exitstatus = -exitstatus, None
+        if signalstatus is not None:
             raise OperationError(
                 u"command '{}' has been interrupted by signal {}".format(
                     self.command,
-                    child.signalstatus
+                    signalstatus
                 )
             )
-        elif child.exitstatus != 0:
+        elif exitstatus != 0:
             raise OperationError(
                 u"command '{}' returned {}".format(
                     self.command,
-                    child.exitstatus
+                    exitstatus
                 )
             )
-        log_buffer.seek(0)
-        # the pseudo-tty used for the child process returns
-        # lines with \r\n endings
-        msg = '\n'.join(log_buffer.read().splitlines())
-        log(msg, decorated=False, stdout=False)
 
-    def execute(self, log):
+    def _check_command(self, command, timeout=None):
+        """Check the exit of a command run by :class:`Command`"""
+        if command.timed_out:
+            raise self._timeout_error(timeout, command.rusage)
+        self._check_status(command.process.returncode)
+
+    def _timeout_error(self, timeout, rusage=None):
+        message = u"command '{}' has been terminated after its timeout " \
+                  u"of {} seconds".format(self.command, timeout)
+        if rusage:
+            message += u' ({})'.format(format_rusage(rusage))
+        return OperationTimeoutError(message)
+
+    def _execute(self, log, interactive=True, timeout=None):
+        assert self.command
+        if self.log_limit:
+            log = self.log_limit.bound(log)
+        self.stats = self._exit = None
+        children = children_rusage()
+        start = time.monotonic()
+        try:
+            self._run(log, interactive=interactive, timeout=timeout)
+        finally:
+            if self.log_limit:
+                log.close()
+            if self._exit:
+                exit_code, rusage = self._exit
+                self.stats = execution_stats(time.monotonic() - start,
+                                             exit_code, rusage=rusage,
+                                             children=children)
+
+    def _run(self, log, interactive=True, timeout=None):
+        if interactive:
+            # use the interactive mode so we can use pdb in the
+            # migration scripts
+            cmd, options = self._spawn_command()
+            child = pexpect.spawn(cmd, options, timeout=None,
+                                  encoding='utf8')
+
+            def send_signal(signum):
+                # the child leads the session of its terminal
+                try:
+                    os.killpg(child.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+            # the output is copied to the log on its way to the terminal
+            output = OutputLog(log)
+            with Watchdog(send_signal, timeout) as watchdog:
+                child.interact(output_filter=output.filter)
+            self._drain(child, output)
+            output.close()
+            child.close()
+            if child.signalstatus is not None:
+                self._exit = (-child.signalstatus, None)
+            else:
+                self._exit = (child.exitstatus, None)
+            if watchdog.expired:
+                raise self._timeout_error(timeout)
+            self._check_status(child.exitstatus, child.signalstatus)
+        else:
+            # no terminal is needed: the outputs are read from pipes and
+            # streamed to stdout and to the log as they arrive, the
+            # command has its own process group to be terminated with its
+            # children when the timeout expires
+            command = Command(self._command_args(), new_session=bool(timeout))
+            try:
+                command.run(log, read_size=self.read_size, timeout=timeout)
+            finally:
+                if command.rusage:
+                    self._exit = (command.process.returncode, command.rusage)
+            self._check_command(command, timeout)
+
+    def _drain(self, child, output):
+        """Copy the output left in the terminal of an exited command
+
+        ``interact`` stops as soon as the command is not alive anymore,
+        the output of a command exiting before it has been read is still
+        in the terminal.
+        """
+        while select.select([child.child_fd], [], [], 0)[0]:
+            try:
+                data = os.read(child.child_fd, self.read_size)
+            except OSError:
+                # EIO once the terminal is closed
+                break
+            if not data:
+                break
+            os.write(child.STDOUT_FILENO, output.filter(data))
+
+    def execute(self, log, default_timeout=None):
+        """Execute the command
+
+        :param default_timeout: timeout used when the operation has none
+        """
         log(u'{}'.format(self.command))
-        self._execute(log, interactive=sys.stdout.isatty())
+        self._execute(log, interactive=sys.stdout.isatty(),
+                      timeout=self.timeout or default_timeout)
 
     def __repr__(self):
         return u'Operation<{}>'.format(self.command)
 
 
+class OperationGraph(object):
+
+    def __init__(self, operations, after, max_workers=None, names=None):
+        """Operations executed concurrently, after their dependencies
+
+        An operation is started as soon as all the operations it depends on
+        are done, at most ``max_workers`` at a time. Among the operations
+        ready to start, the ones heading the longest chains of dependent
+        operations (the critical path) are started first. The chains are
+        measured in operations, or in seconds once the durations of the
+        operations are known (:meth:`set_durations`).
+
+        Each operation runs in its own process group, its output is
+        written to a temporary file and logged as a block once it ends,
+        with its start and end times, so the outputs of the operations are
+        never mixed and are not kept in memory. When
+        an operation fails, the other ones are cancelled: the running ones
+        receive SIGTERM, the pending ones are not started.
+
+        As the commands are not attached to the terminal, they cannot be
+        debugged with ``pdb``.
+
+        :param operations: the operations to execute
+        :type operations: list of :class:`Operation`
+        :param after: for each operation, the set of the indexes of the
+                      operations it depends on
+        :type after: list of sets
+        :param max_workers: number of operations executed at the same
+                            time, all of them by default
+        :type max_workers: Integer
+        :param names: names of the operations in the logs, their commands
+                      by default
+        :type names: list of strings
+        """
+        self.operations = operations
+        self.after = after
+        self.max_workers = max_workers or len(operations)
+        self.names = names or [operation.command
+                               for operation in operations]
+        self.priorities = self._critical_paths()
+        # ExecutionStats of the last execution, of the whole graph and of
+        # each operation by index
+        self.stats = None
+        self.node_stats = {}
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._running = set()
+
+    def __bool__(self):
+        return bool(self.operations)
+
+    @property
+    def command(self):
+        """Names of the operations, to describe the graph"""
+        return u', '.join(self.names)
+
+    def set_durations(self, durations):
+        """Weigh the chains of operations with their durations
+
+        :param durations: durations of the operations in seconds, by
+                          command, the operations without duration weigh
+                          the average of the known ones
+        :type durations: dict
+        """
+        commands = [operation.command for operation in self.operations]
+        known = [durations[command] for command in commands
+                 if command in durations]
+        default = sum(known) / len(known) if known else 1
+        self.priorities = self._critical_paths(
+            [durations.get(command, default) for command in commands]
+        )
+
+    def _critical_paths(self, weights=None):
+        """Length of the longest chain of operations starting at each one
+
+        :param weights: weight of each operation, 1 by default
+        """
+        if weights is None:
+            weights = [1] * len(self.operations)
+        dependents = [[] for __ in self.operations]
+        waiting = [len(after) for after in self.after]
+        for index, after in enumerate(self.after):
+            for depends in after:
+                dependents[depends].append(index)
+        order = [index for index, count in enumerate(waiting) if not count]
+        for index in order:
+            for dependent in dependents[index]:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    order.append(dependent)
+        if len(order) != len(self.operations):
+            raise ConfigurationError(
+                u'circular dependencies between the operations: {}'.format(
+                    u', '.join(self.names[index] for index, count
+                               in enumerate(waiting) if count)
+                )
+            )
+        priorities = list(weights)
+        for index in reversed(order):
+            for dependent in dependents[index]:
+                priorities[index] = max(priorities[index],
+                                        priorities[dependent] + weights[index])
+        return priorities
+
+    def _run(self, operation, timeout=None):
+        """Execute an operation in a worker thread
+
+        :return: the output of the operation in a temporary file, one
+                 line per message, the error raised if any, its start and
+                 end times and its ExecutionStats, or None when it has
+                 been cancelled before its start
+        """
+        output = tempfile.TemporaryFile(mode='w+', encoding='utf-8',
+                                        errors='surrogateescape')
+
+        def log(message, decorated=True, stdout=True):
+            output.write(message + u'\n')
+
+        bounded = operation.log_limit.bound(log) if operation.log_limit else log
+        command = Command(operation._command_args(), new_session=True)
+        try:
+            with self._lock:
+                if self._cancelled:
+                    output.close()
+                    return None
+                started = datetime.now()
+                command.start()
+                self._running.add(command)
+            try:
+                command.stream(bounded, read_size=operation.read_size,
+                               echo=False, timeout=timeout)
+            finally:
+                with self._lock:
+                    self._running.discard(command)
+                if operation.log_limit:
+                    bounded.close()
+        except BaseException:
+            output.close()
+            raise
+        ended = datetime.now()
+        stats = execution_stats((ended - started).total_seconds(),
+                                command.process.returncode,
+                                rusage=command.rusage)
+        try:
+            operation._check_command(command, timeout)
+        except OperationError as err:
+            # the worker cancels the other operations before one more of
+            # them is started
+            self.cancel()
+            return output, err, started, ended, stats
+        return output, None, started, ended, stats
+
+    def cancel(self):
+        """Do not start the pending operations, terminate the running ones"""
+        with self._lock:
+            self._cancelled = True
+            for command in self._running:
+                command.signal(signal.SIGTERM)
+
+    def execute(self, log, default_timeout=None):
+        """Execute the operations
+
+        :param default_timeout: timeout of the operations having none
+        """
+        log(u'execute {} operations in parallel ({} at a time)'.format(
+            len(self.operations), self.max_workers,
+        ))
+        self._cancelled = False
+        self.stats = None
+        self.node_stats = {}
+        start = time.monotonic()
+        dependents = [[] for __ in self.operations]
+        waiting = [len(after) for after in self.after]
+        for index, after in enumerate(self.after):
+            for depends in after:
+                dependents[depends].append(index)
+        ready = [(-self.priorities[index], index)
+                 for index, count in enumerate(waiting) if not count]
+        heapq.heapify(ready)
+        done = set()
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            try:
+                while ready or running:
+                    while (ready and len(running) < self.max_workers and
+                           not self._cancelled):
+                        __, index = heapq.heappop(ready)
+                        operation = self.operations[index]
+                        future = executor.submit(
+                            self._run, operation,
+                            operation.timeout or default_timeout,
+                        )
+                        running[future] = index
+                    if not running:
+                        break
+                    finished, __ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        index = running.pop(future)
+                        done.add(index)
+                        error = self._log_result(log, index, future.result())
+                        if error:
+                            errors.append(error)
+                            continue
+                        for dependent in dependents[index]:
+                            waiting[dependent] -= 1
+                            if not waiting[dependent]:
+                                heapq.heappush(ready, (
+                                    -self.priorities[dependent], dependent,
+                                ))
+            finally:
+                self.cancel()
+        self.stats = ExecutionStats(
+            time.monotonic() - start,
+            sum(stats.cpu_time for stats in self.node_stats.values()),
+            max([stats.max_rss for stats in self.node_stats.values()
+                 if stats.max_rss is not None] or [None]),
+            next((stats.exit_code for stats in self.node_stats.values()
+                  if stats.exit_code), 0),
+        )
+        for index, name in enumerate(self.names):
+            if index not in done:
+                log(u'{}: cancelled'.format(name))
+        if errors:
+            raise errors[0]
+
+    def _log_result(self, log, index, result):
+        """Log the output of an operation, return its error if any"""
+        name = self.names[index]
+        if result is None:
+            log(u'{}: cancelled'.format(name))
+            return None
+        output, error, started, ended, stats = result
+        self.node_stats[index] = stats
+        log(u'{}'.format(self.operations[index].command))
+        with output:
+            output.seek(0)
+            while True:
+                lines = output.readlines(self.operations[index].read_size)
+                if not lines:
+                    break
+                log(u''.join(lines)[:-1], decorated=False)
+        if error:
+            log(u'{}'.format(error))
+        log(u'{}: started at {:%H:%M:%S}, ended at {:%H:%M:%S} ({:.1f}s)'
+            .format(name, started, ended,
+                    (ended - started).total_seconds()))
+        return error
+
+    def __repr__(self):
+        return u'{}<{}>'.format(self.__class__.__name__,
+                                u', '.join(self.names))
+
+
+class ParallelOperation(OperationGraph):
+
+    def __init__(self, operations, max_workers=None):
+        """Group of independent operations executed concurrently
+
+        See :class:`OperationGraph`.
+
+        :param operations: the operations to execute
+        :type operations: list of :class:`Operation`
+        :param max_workers: number of operations executed at the same
+                            time, all of them by default
+        :type max_workers: Integer
+        """
+        super(ParallelOperation, self).__init__(
+            operations, [set() for __ in operations], max_workers=max_workers,
+        )
+
+
 class SilentOperation(Operation):
     """Operation that does not require logging or interactivity. """
 
-    def _execute(self):
+    def _execute(self, timeout=None):
         assert self.command
-        cmd, options = self._spawn_command()
-        child = pexpect.spawn(cmd, options, timeout=None, encoding='utf8')
-        child.expect(pexpect.EOF)
-        child.close()
-        if child.signalstatus is not None:
-            raise OperationError(
-                u"command '{}' has been interrupted by signal {}".format(
-                    ' '.join(self.command),
-                    child.signalstatus
-                )
-            )
-        elif child.exitstatus != 0:
-            raise OperationError(
-                u"command '{}' returned {}".format(
-                    ' '.join(self.command),
-                    child.exitstatus
-                )
-            )
+        self._check_command(
+            run_command(self._command_args(), timeout=timeout), timeout,
+        )
 
-    def execute(self):
-        self._execute()
+    def execute(self, default_timeout=None):
+        self._execute(timeout=self.timeout or default_timeout)
 
 
 class BackupOperation(Operation):
 
-    def __init__(self, command, shell=False, stop_on_failure=True):
-        super(BackupOperation, self).__init__(command, shell=shell)
+    def __init__(self, command, shell=False, stop_on_failure=True,
+                 log_limit=None, timeout=None):
+        super(BackupOperation, self).__init__(command, shell=shell,
+                                              log_limit=log_limit,
+                                              timeout=timeout)
         self.stop_on_failure = stop_on_failure
 
-    def execute(self, log):
+    def execute(self, log, default_timeout=None):
         log('Backing up...')
         try:
-            self._execute(log, interactive=sys.stdout.isatty())
+            self._execute(log, interactive=sys.stdout.isatty(),
+                          timeout=self.timeout or default_timeout)
         except OperationError:
             if self.stop_on_failure:
                 raise BackupError(
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Run the same migration on several databases in parallel.
+
+The migration file is parsed once, then each database is migrated in its
+own process, at most ``--jobs`` at the same time. The backups are throttled
+separately (``--backup-jobs``) as they are usually the heaviest part for
+the database server. A summary with the status and the duration of each
+database is printed at the end.
+
+No maintenance page is published, the web server is left to the
+``marabunta`` command.
+
+"""
+
+import copy
+import io
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .config import Config, get_multi_args_parser
+from .core import apply_migration, is_up_to_date, migration_file_hash
+from .database import Database
+from .output import print_decorated, safe_print
+from .parser import YamlParser
+
+DatabaseResult = namedtuple('DatabaseResult',
+                            'database status duration error')
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+class PrefixedStream(object):
+    """Stream prefixing each line with the name of the database
+
+    Used as ``sys.stdout`` in the workers, so the outputs of the databases
+    migrated concurrently can be told apart.
+    """
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self._line_start = True
+
+    @property
+    def encoding(self):
+        return self.stream.encoding
+
+    def write(self, data):
+        parts = []
+        for line in data.splitlines(True):
+            if self._line_start:
+                parts.append(self.prefix)
+            parts.append(line)
+            self._line_start = line.endswith('\n')
+        self.stream.write(u''.join(parts))
+        if self._line_start:
+            # limit the interleaving of the lines of the other workers
+            self.stream.flush()
+        return len(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        # several processes cannot share the terminal in interactive mode
+        return False
+
+
+def list_databases(config, pattern, maintenance_database):
+    """Return the names of the databases matching a LIKE pattern"""
+    maintenance_config = copy.copy(config)
+    maintenance_config.database = maintenance_database
+    database = Database(maintenance_config)
+    try:
+        with database.cursor_autocommit() as cursor:
+            cursor.execute("""
+            SELECT datname
+            FROM pg_database
+            WHERE datname LIKE %s
+            AND datallowconn
+            AND NOT datistemplate
+            ORDER BY datname
+            """, (pattern,))
+            return [row[0] for row in cursor.fetchall()]
+    finally:
+        # must not be inherited by the workers
+        database.close()
+
+
+def _init_worker(config, migration, migration_hash, backup_lock, log_dir):
+    _worker.update(
+        config=config,
+        migration=migration,
+        migration_hash=migration_hash,
+        backup_lock=backup_lock,
+        log_dir=log_dir,
+    )
+
+
+def _migrate_database(name):
+    """Migrate one database, executed in a worker process"""
+    config = copy.copy(_worker['config'])
+    config.database = name
+    migration_hash = _worker['migration_hash']
+    log_dir = _worker['log_dir']
+    if log_dir:
+        stream = io.open(os.path.join(log_dir, u'{}.log'.format(name)), 'a',
+                         encoding='utf-8')
+    else:
+        stream = PrefixedStream(sys.stdout, u'[{}] '.format(name))
+
+    start = time.time()
+    error = None
+    stdout, sys.stdout = sys.stdout, stream
+    database = Database(config)
+    try:
+        if is_up_to_date(config, database, migration_hash):
+            status = u'up to date'
+        elif apply_migration(config, database, migration_hash,
+                             lambda: _worker['migration'],
+                             backup_lock=_worker['backup_lock']):
+            status = u'done'
+        else:
+            status = u'applied by a concurrent process'
+    except Exception as err:
+        traceback.print_exc(file=stream)
+        status = u'failed'
+        error = u'{}'.format(err)
+    finally:
+        database.close()
+        sys.stdout = stdout
+        if log_dir:
+            stream.close()
+        else:
+            stream.flush()
+    return DatabaseResult(name, status, time.time() - start, error)
+
+
+def migrate_databases(config, databases, jobs=4, backup_jobs=1,
+                      log_dir=None):
+    """Migrate several databases in parallel
+
+    :param config: configuration, its database is replaced by each
+                   of ``databases``
+    :type config: Config
+    :return: list of :class:`DatabaseResult`, in the order of ``databases``
+    """
+    migration_parser = YamlParser.parse_from_file(config.migration_file)
+    migration = migration_parser.parse()
+    migration_hash = migration_file_hash(config.migration_file)
+
+    context = multiprocessing.get_context()
+    backup_lock = context.BoundedSemaphore(backup_jobs)
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(config, migration, migration_hash, backup_lock,
+                      log_dir)) as executor:
+        return list(executor.map(_migrate_database, databases))
+
+
+def print_summary(results):
+    print_decorated(u'summary')
+    width = max(len(result.database) for result in results)
+    for result in results:
+        line = u'{:<{width}}  {:>8.1f}s  {}'.format(
+            result.database, result.duration, result.status, width=width,
+        )
+        if result.error:
+            line += u': {}'.format(result.error.splitlines()[0])
+        safe_print(line)
+
+
+def main():
+    """Parse the command line and run :func:`migrate_databases`."""
+    parser = get_multi_args_parser()
+    args = parser.parse_args()
+    config = Config(args.migration_file,
+                    None,
+                    db_user=args.db_user,
+                    db_password=args.db_password,
+                    db_port=args.db_port,
+                    db_host=args.db_host,
+                    mode=args.mode,
+                    allow_serie=args.allow_serie,
+                    force_version=args.force_version,
+                    resume=args.resume,
+                    override_translations=args.override_translations,
+                    lock_timeout=args.lock_timeout,
+                    lock_namespace=args.lock_namespace,
+                    operation_timeout=args.operation_timeout,
+                    addons_snapshot=args.addons_snapshot,
+                    log_storage=args.log_storage,
+                    addons_path=args.addons_path,
+                    )
+    databases = [name.strip() for name in (args.databases or '').split(',')
+                 if name.strip()]
+    if args.database_pattern:
+        for name in list_databases(config, args.database_pattern,
+                                   args.maintenance_database):
+            if name not in databases:
+                databases.append(name)
+    if not databases:
+        parser.error('no database to migrate, use --databases '
+                     'or --database-pattern')
+    if args.log_dir and not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    results = migrate_databases(config, databases,
+                                jobs=args.jobs,
+                                backup_jobs=args.backup_jobs,
+                                log_dir=args.log_dir)
+    print_summary(results)
+    if any(result.status == u'failed' for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
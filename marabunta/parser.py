@@ -6,13 +6,16 @@ import io
 from ruamel.yaml import YAML
 import warnings
 
-from .exception import ParseError
+from .exception import ConfigurationError, ParseError
 from .model import (
+    LogLimit,
     Migration,
     MigrationOption,
     Version,
     Operation,
     MigrationBackupOption,
+    OperationGraph,
+    ParallelOperation,
 )
 from .version import FIRST_VERSION
 
@@ -27,6 +30,26 @@ migration:
       command: echo "backup command on $database $db_user $db_password $db_host $db_port"
       stop_on_failure: true
       ignore_if: test "${RUNNING_ENV}" != "prod"
+      # timeout: can be overridden for the backup and ignore_if commands
+    # default timeout of the operations in seconds, their command is
+    # terminated with its process group when it expires (no timeout by
+    # default, see also --operation-timeout)
+    timeout: 3600
+    # install / upgrade the addons of consecutive versions without
+    # operations in a single run of the install command
+    batch_addons: false
+    # do not upgrade the addons whose code did not change since their last
+    # installation or upgrade ('checksum') or whose manifest version has
+    # not been bumped ('manifest_version'), requires --addons-path
+    # skip_unchanged_addons: checksum
+    # number of operations with ids (see version 0.0.4) executed at the
+    # same time, all the ready ones by default
+    max_workers: 4
+    # size in KB of the beginning and the end of the output stored in the
+    # logs for each operation, the output is always fully displayed
+    log_limit:
+      head: 512
+      tail: 2048
   versions:
     - version: setup
       operations:
@@ -66,6 +89,20 @@ migration:
           - bin/script_test.sh
         post:
           - echo 'post-op'
+          - command: anthem songs::verbose
+            timeout: 600
+            log_limit:
+              head: 0
+              tail: 64
+          # executed concurrently, each one in its own process, their
+          # outputs are logged separately once they are done, the other
+          # ones are cancelled when one fails
+          - parallel:
+              max_workers: 2  # all at the same time by default
+              operations:
+                - anthem songs::load_company_a
+                - anthem songs::load_company_b
+                - anthem songs::load_company_c
 
     - version: 0.0.4
       backup: false
@@ -73,6 +110,19 @@ migration:
       addons:
         upgrade:
           - popeye
+      operations:
+        # when operations have an 'id', they are executed concurrently as
+        # soon as the operations listed in their 'after' key are done
+        post:
+          - id: partners
+            command: anthem songs::fix_partners
+          - id: products
+            command: anthem songs::fix_products
+          - id: orders
+            command: anthem songs::fix_orders
+            after: [partners, products]
+          - command: anthem songs::fix_invoices
+            after: partners
 
 """  # noqa
 
@@ -137,22 +187,88 @@ class YamlParser(object):
         :class:`MigrationBackupOption` instances."""
         options = migration.get('options', {})
         install_command = options.get('install_command')
+        log_limit = self._parse_log_limit(options.get('log_limit'))
+        timeout = self._parse_timeout(options.get('timeout'))
         backup = options.get('backup')
         if backup:
             self.check_dict_expected_keys(
-                {'command', 'ignore_if', 'stop_on_failure'},
+                {'command', 'ignore_if', 'stop_on_failure', 'log_limit',
+                 'timeout'},
                 options['backup'], 'backup',
             )
+            backup_log_limit = log_limit
+            if 'log_limit' in backup:
+                backup_log_limit = self._parse_log_limit(backup['log_limit'])
             backup = MigrationBackupOption(
                 command=backup.get('command'),
                 ignore_if=backup.get('ignore_if'),
                 stop_on_failure=backup.get('stop_on_failure', True),
+                log_limit=backup_log_limit,
+                timeout=self._parse_timeout(backup.get('timeout', timeout)),
+            )
+        batch_addons = options.get('batch_addons', False)
+        if not isinstance(batch_addons, bool):
+            raise ParseError(u"'batch_addons' key must be a boolean",
+                             YAML_EXAMPLE)
+        max_workers = options.get('max_workers')
+        if max_workers is not None:
+            self._check_max_workers(max_workers, 'max_workers')
+        skip_unchanged_addons = options.get('skip_unchanged_addons')
+        if skip_unchanged_addons not in (None, 'checksum',
+                                         'manifest_version'):
+            raise ParseError(
+                u"'skip_unchanged_addons' key must be 'checksum' or "
+                u"'manifest_version'",
+                YAML_EXAMPLE,
             )
         return MigrationOption(
             install_command=install_command,
             backup=backup,
+            log_limit=log_limit,
+            batch_addons=batch_addons,
+            skip_unchanged_addons=skip_unchanged_addons,
+            max_workers=max_workers,
+            timeout=timeout,
         )
 
+    def _parse_timeout(self, timeout):
+        """Check a timeout in seconds"""
+        if timeout is None:
+            return None
+        if (not isinstance(timeout, (int, float)) or
+                isinstance(timeout, bool) or timeout <= 0):
+            raise ParseError(
+                u"'timeout' key must be a positive number of seconds",
+                YAML_EXAMPLE,
+            )
+        return timeout
+
+    def _check_max_workers(self, max_workers, key):
+        if (not isinstance(max_workers, int) or
+                isinstance(max_workers, bool) or max_workers < 1):
+            raise ParseError(
+                u"'{}' key must be a positive integer".format(key),
+                YAML_EXAMPLE,
+            )
+
+    def _parse_log_limit(self, log_limit):
+        """Build a :class:`LogLimit` instance, sizes are in KB"""
+        if log_limit is None:
+            return None
+        self.check_dict_expected_keys({'head', 'tail'}, log_limit,
+                                      'log_limit')
+        for key in ('head', 'tail'):
+            value = log_limit.get(key, 0)
+            if (not isinstance(value, int) or isinstance(value, bool) or
+                    value < 0):
+                raise ParseError(
+                    u"'log_limit' '{}' key must be a positive integer (KB)"
+                    .format(key),
+                    YAML_EXAMPLE,
+                )
+        return LogLimit(head=log_limit.get('head', 0),
+                        tail=log_limit.get('tail', 0))
+
     def _parse_versions(self, migration, options):
         versions = migration.get('versions') or []
         if not isinstance(versions, list):
@@ -170,12 +286,134 @@ class YamlParser(object):
             if not isinstance(commands, list):
                 raise ParseError(u"'%s' key must be a list" %
                                  (operation_type,), YAML_EXAMPLE)
-            for command in commands:
+            if any(isinstance(command, dict) and 'id' in command
+                   for command in commands):
                 version.add_operation(
                     operation_type,
-                    Operation(command),
+                    self._parse_graph(version, commands, operation_type),
                     mode=mode,
                 )
+                continue
+            for command in commands:
+                if isinstance(command, dict) and 'parallel' in command:
+                    operation = self._parse_parallel(
+                        version, command, operation_type,
+                    )
+                else:
+                    operation = self._parse_operation(
+                        version, command, operation_type,
+                    )
+                version.add_operation(operation_type, operation, mode=mode)
+
+    def _parse_operation(self, version, command, operation_type,
+                         extra_keys=()):
+        """Build an :class:`Operation` from a command or a dict"""
+        log_limit = version.options.log_limit
+        timeout = version.options.timeout
+        if isinstance(command, dict):
+            self.check_dict_expected_keys(
+                {'command', 'log_limit', 'timeout'} | set(extra_keys),
+                command, operation_type,
+            )
+            if 'log_limit' in command:
+                log_limit = self._parse_log_limit(command['log_limit'])
+            if 'timeout' in command:
+                timeout = self._parse_timeout(command['timeout'])
+            if not command.get('command'):
+                raise ParseError(
+                    u"version {}: an operation of '{}' has no 'command' "
+                    u"key".format(version.number, operation_type),
+                    YAML_EXAMPLE,
+                )
+            command = command['command']
+        return Operation(command, log_limit=log_limit, timeout=timeout)
+
+    def _parse_graph(self, version, commands, operation_type):
+        """Build an :class:`OperationGraph` from operations with ids
+
+        The operations are executed after the ones listed in their
+        ``after`` key, those without ``after`` are started first. Each
+        operation must have an ``id`` or an ``after`` key: an operation
+        without them would not be ordered with the others.
+        """
+        operations = []
+        names = []
+        ids = {}
+        for index, command in enumerate(commands):
+            if not isinstance(command, dict) or not (
+                    {'id', 'after'} & set(command)):
+                raise ParseError(
+                    u"version {}: operation {!r} has no 'id' nor 'after' "
+                    u"key, it is required when operations of the list have "
+                    u"an 'id'".format(version.number, command),
+                    YAML_EXAMPLE,
+                )
+            operations.append(self._parse_operation(
+                version, command, operation_type, extra_keys={'id', 'after'},
+            ))
+            name = operations[-1].command
+            if 'id' in command:
+                name = command['id']
+                if not isinstance(name, str):
+                    raise ParseError(
+                        u"version {}: 'id' key must be a string, got "
+                        u"{!r}".format(version.number, name),
+                        YAML_EXAMPLE,
+                    )
+                if name in ids:
+                    raise ParseError(
+                        u"operation id '{}' is duplicated".format(name),
+                        YAML_EXAMPLE,
+                    )
+                ids[name] = index
+            names.append(u'{}'.format(name))
+        after = []
+        for command in commands:
+            depends = command.get('after') or []
+            if isinstance(depends, str):
+                depends = [depends]
+            if not (isinstance(depends, list) and
+                    all(isinstance(name, str) for name in depends)):
+                raise ParseError(
+                    u"version {}: 'after' key must be an id or a list of "
+                    u"ids, got {!r}".format(version.number, depends),
+                    YAML_EXAMPLE,
+                )
+            unknown = [name for name in depends if name not in ids]
+            if unknown:
+                raise ParseError(
+                    u"'after' key: unknown operation ids {}".format(unknown),
+                    YAML_EXAMPLE,
+                )
+            after.append({ids[name] for name in depends})
+        try:
+            return OperationGraph(operations, after,
+                                  max_workers=version.options.max_workers,
+                                  names=names)
+        except ConfigurationError as err:
+            raise ParseError(u'{}'.format(err), YAML_EXAMPLE)
+
+    def _parse_parallel(self, version, command, operation_type):
+        """Build a :class:`ParallelOperation` from a 'parallel' dict"""
+        self.check_dict_expected_keys({'parallel'}, command, operation_type)
+        parallel = command['parallel']
+        self.check_dict_expected_keys(
+            {'max_workers', 'operations'}, parallel, 'parallel',
+        )
+        max_workers = parallel.get('max_workers')
+        if max_workers is not None:
+            self._check_max_workers(max_workers, 'max_workers')
+        commands = parallel.get('operations')
+        if not commands or not isinstance(commands, list):
+            raise ParseError(
+                u"'parallel' 'operations' key must be a non-empty list",
+                YAML_EXAMPLE,
+            )
+        return ParallelOperation(
+            [self._parse_operation(version, command, 'parallel')
+             for command in commands],
+            max_workers=max_workers,
+        )
 
     def _parse_addons(self, version, addons, mode=None):
         self.check_dict_expected_keys(
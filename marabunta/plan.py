@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Plan of a migration, without executing it
+
+The versions are selected by the :class:`marabunta.runner.Runner`, as for
+a migration, and the steps they would execute are listed with an estimate
+of their duration, the average duration of the same commands in
+``marabunta_operation_stats``. Nothing is executed nor written in the
+database: the ``ignore_if`` command of the backup is not evaluated and the
+addons whose code did not change (``skip_unchanged_addons``) are not
+detected.
+"""
+
+from datetime import timedelta
+
+from .runner import AddonsBatchRunner, VersionRunner
+
+
+class Plan(object):
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.config = runner.config
+        self.migration = runner.migration
+
+    def db_versions(self):
+        """Versions of the database, none before the first migration"""
+        if not self.runner.table.exists():
+            return []
+        return self.runner.table.versions()
+
+    def build(self):
+        """Return the plan as a dict, see :func:`format_plan`
+
+        :raise MigrationError: when the migration cannot be run, see
+                               :meth:`marabunta.runner.Runner.check_versions`
+        """
+        runner = self.runner
+        db_versions = self.db_versions()
+        runner.check_versions(db_versions)
+        plan = {
+            'database': self.config.database,
+            'mode': self.config.mode,
+            'backup': None,
+            'versions': [],
+        }
+        backup_options = self.migration.options.backup
+        if runner.backup_required(db_versions):
+            ignore_if = backup_options.ignore_if_operation().command
+            plan['backup'] = {
+                'command': backup_options.command,
+                'ignore_if': ignore_if if ignore_if != 'false' else None,
+            }
+        addons_state = runner.module_table.read_state()
+        dependencies = runner.read_dependencies()
+        # addons installed or upgraded by the previous versions of the plan
+        upgraded = set(runner.upgraded_addons)
+        for versions in runner.version_batches(db_versions):
+            if (len(versions) == 1 and
+                    versions[0].is_processed(db_versions) and
+                    self.config.force_version != versions[0].number):
+                continue
+            plan['versions'].append(self._version_plan(
+                versions, db_versions, addons_state, dependencies, upgraded,
+            ))
+        self._estimate(plan)
+        return plan
+
+    def _version_plan(self, versions, db_versions, addons_state,
+                      dependencies, upgraded):
+        mode = self.config.mode
+        version_runner = VersionRunner(self.runner, versions[-1])
+        if self.config.resume and version_runner.failed(db_versions):
+            version_runner.steps_done = set()
+            if self.runner.checkpoint_table.exists():
+                version_runner.steps_done = \
+                    self.runner.checkpoint_table.read(versions[-1].number)
+        steps = []
+
+        def add_step(step, command):
+            steps.append({
+                'stage': step[0],
+                'command': command,
+                'done': version_runner.is_done(step),
+                'estimate': None,
+            })
+
+        version = versions[-1]
+        noop = len(versions) == 1 and version.is_noop()
+        if len(versions) == 1 and not noop:
+            for index, operation in enumerate(version.pre_operations()):
+                add_step((u'pre', index, operation), operation.command)
+            if mode:
+                for index, operation in enumerate(
+                        version.pre_operations(mode=mode)):
+                    add_step((u'pre:' + mode, index, operation),
+                             operation.command)
+        if not noop:
+            upgrade_operation = AddonsBatchRunner(
+                self.runner, versions,
+            ).upgrade_operation(addons_state)
+            upgrade_operation.dependencies = dependencies
+            addons = (upgrade_operation.to_install |
+                      upgrade_operation.to_upgrade)
+            operation = upgrade_operation.operation(exclude_addons=upgraded)
+            if operation:
+                add_step((u'addons', 0, u','.join(sorted(addons))),
+                         operation.command)
+            upgraded |= addons
+        if len(versions) == 1 and not noop:
+            for index, operation in enumerate(version.post_operations()):
+                add_step((u'post', index, operation), operation.command)
+            if mode:
+                for index, operation in enumerate(
+                        version.post_operations(mode)):
+                    add_step((u'post:' + mode, index, operation),
+                             operation.command)
+        return {
+            'versions': [version.number for version in versions],
+            'noop': noop,
+            'steps': steps,
+            'estimate': None,
+        }
+
+    def _estimate(self, plan):
+        """Set the estimated durations in seconds, None when unknown"""
+        stats_table = self.runner.stats_table
+        steps = [step for version in plan['versions']
+                 for step in version['steps']]
+        commands = {step['command'] for step in steps}
+        if plan['backup']:
+            commands.add(plan['backup']['command'])
+        durations = stats_table.durations(commands) if commands else {}
+        addons_duration = None
+        if any(step['stage'] == u'addons' and
+               step['command'] not in durations for step in steps):
+            addons_duration = stats_table.stage_duration(u'addons')
+        if plan['backup']:
+            plan['backup']['estimate'] = durations.get(
+                plan['backup']['command']
+            )
+        for version in plan['versions']:
+            for step in version['steps']:
+                if step['done']:
+                    step['estimate'] = 0.
+                elif step['command'] in durations:
+                    step['estimate'] = durations[step['command']]
+                elif step['stage'] == u'addons':
+                    step['estimate'] = addons_duration
+            version['estimate'] = sum(step['estimate'] or 0.
+                                      for step in version['steps'])
+        plan['estimate'] = sum(version['estimate']
+                               for version in plan['versions'])
+        if plan['backup'] and plan['backup']['estimate']:
+            plan['estimate'] += plan['backup']['estimate']
+        plan['unknown'] = len([step for step in steps
+                               if step['estimate'] is None])
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return u'unknown'
+    return u'{}'.format(timedelta(seconds=round(seconds)))
+
+
+def format_plan(plan):
+    """Return the plan as text, one line per step"""
+    lines = [u'migration plan of database {}{}'.format(
+        plan['database'],
+        u' in mode {}'.format(plan['mode']) if plan['mode'] else u'',
+    )]
+    backup = plan['backup']
+    if backup:
+        lines.append(u'backup: {} [{}]'.format(
+            backup['command'], format_duration(backup['estimate']),
+        ))
+        if backup['ignore_if']:
+            lines.append(u'  skipped if succeeds: {}'.format(
+                backup['ignore_if']
+            ))
+    if not plan['versions']:
+        lines.append(u'nothing to migrate')
+    for version in plan['versions']:
+        lines.append(u'version {} [{}]{}'.format(
+            u', '.join(version['versions']),
+            format_duration(version['estimate']),
+            u' noop' if version['noop'] else u'',
+        ))
+        for step in version['steps']:
+            lines.append(u'  {:<8} {} [{}]'.format(
+                step['stage'], step['command'],
+                u'done' if step['done'] else
+                format_duration(step['estimate']),
+            ))
+    lines.append(u'estimated duration: {}{}'.format(
+        format_duration(plan['estimate']),
+        u' ({} steps without history)'.format(plan['unknown'])
+        if plan['unknown'] else u'',
+    ))
+    return u'\n'.join(lines)
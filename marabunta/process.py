@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Execution of the commands without a terminal
+
+The standard and error outputs of the command are read through pipes,
+by blocks of ``read_size`` bytes, as soon as they are available. Each
+block is decoded once, then written to the console and to the log.
+
+A command can be given a timeout, a :class:`Watchdog` thread terminates
+it when it expires.
+"""
+
+import os
+import resource
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+
+from collections import namedtuple
+
+from .logs import OutputLog
+
+READ_SIZE = 65536
+# seconds between SIGTERM and SIGKILL when a timeout expires
+TERMINATE_GRACE = 10
+
+
+class Watchdog(object):
+    """Terminate a command when its timeout expires
+
+    The command receives SIGTERM once ``timeout`` seconds have elapsed,
+    then SIGKILL if it is still running ``grace`` seconds later. Used as a
+    context manager around the execution of the command, nothing is done
+    without timeout.
+
+    :param send_signal: function sending a signal to the command
+    :param timeout: timeout in seconds
+    """
+
+    def __init__(self, send_signal, timeout, grace=TERMINATE_GRACE):
+        self.send_signal = send_signal
+        self.timeout = timeout
+        self.grace = grace
+        self.expired = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _watch(self):
+        if self._stopped.wait(self.timeout):
+            return
+        self.expired = True
+        self.send_signal(signal.SIGTERM)
+        if not self._stopped.wait(self.grace):
+            self.send_signal(signal.SIGKILL)
+
+    def __enter__(self):
+        if self.timeout:
+            self._thread = threading.Thread(target=self._watch, daemon=True,
+                                            name='marabunta-watchdog')
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+
+# resources used by the execution of an operation, the CPU time in seconds
+# and the maximum resident set size in KB, None when unknown
+ExecutionStats = namedtuple('ExecutionStats',
+                            'wall_time cpu_time max_rss exit_code')
+
+
+def children_rusage():
+    """Resources used by the terminated children of this process"""
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def execution_stats(wall_time, exit_code, rusage=None, children=None):
+    """Build the :class:`ExecutionStats` of a command
+
+    :param rusage: resources used by the command, when it has been waited
+                   for by :meth:`Command.wait`
+    :param children: when ``rusage`` is unknown, the resources used by the
+                     children before the command (:func:`children_rusage`),
+                     the difference of CPU time is attributed to the
+                     command, its maximum resident set size is unknown
+    """
+    if rusage is None:
+        after = children_rusage()
+        cpu_time = after.ru_utime + after.ru_stime
+        if children is not None:
+            cpu_time -= children.ru_utime + children.ru_stime
+        # the maximum of all the children terminated so far, not the one
+        # of the command
+        max_rss = None
+    else:
+        cpu_time = rusage.ru_utime + rusage.ru_stime
+        max_rss = rusage.ru_maxrss
+    return ExecutionStats(wall_time, cpu_time, max_rss, exit_code)
+
+
+def format_rusage(rusage):
+    """Describe the resources used by a command"""
+    # ru_maxrss is in KB on Linux
+    return u'user {:.1f}s, system {:.1f}s, max RSS {:.1f} MB'.format(
+        rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss / 1024.,
+    )
+
+
+class Command(object):
+    """A command whose outputs are read from pipes
+
+    :param args: the command and its arguments
+    :param new_session: run the command in its own session, so the whole
+                        process group can be signaled (:meth:`signal`)
+    """
+
+    def __init__(self, args, new_session=False):
+        self.args = args
+        self.new_session = new_session
+        self.process = None
+        # resources used by the command, once it exited
+        self.rusage = None
+        # the command has been terminated by the watchdog
+        self.timed_out = False
+
+    def start(self):
+        self.process = subprocess.Popen(args=self.args,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        start_new_session=self.new_session)
+
+    def signal(self, signum):
+        """Send a signal to the command, to its process group if any"""
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            if self.new_session:
+                os.killpg(self.process.pid, signum)
+            else:
+                self.process.send_signal(signum)
+        except ProcessLookupError:
+            pass
+
+    def wait(self):
+        """Wait for the end of the command, keep the resources it used"""
+        __, status, self.rusage = os.wait4(self.process.pid, 0)
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        return self.process.returncode
+
+    def run(self, log, read_size=READ_SIZE, echo=True, timeout=None):
+        """Start the command and read its outputs, see :meth:`stream`"""
+        self.start()
+        return self.stream(log, read_size=read_size, echo=echo,
+                           timeout=timeout)
+
+    def stream(self, log, read_size=READ_SIZE, echo=True, timeout=None):
+        """Read the outputs of the started command until it exits
+
+        :param log: log function receiving the outputs
+        :param echo: write the outputs to ``sys.stdout`` as well
+        :param timeout: the command is terminated after this number of
+                        seconds, :attr:`timed_out` is then set
+        :return: the exit status of the command, negative when it has been
+                 killed by a signal (see :attr:`subprocess.Popen.returncode`)
+        """
+        process = self.process
+        outputs = {
+            process.stdout.fileno(): OutputLog(log),
+            process.stderr.fileno(): OutputLog(log),
+        }
+        watchdog = Watchdog(self.signal, timeout)
+        try:
+            with watchdog, selectors.DefaultSelector() as selector:
+                for fd in outputs:
+                    selector.register(fd, selectors.EVENT_READ)
+                while selector.get_map():
+                    for key, __ in selector.select():
+                        data = os.read(key.fd, read_size)
+                        output = outputs[key.fd]
+                        if data:
+                            text = output.write(data)
+                        else:
+                            selector.unregister(key.fd)
+                            text = output.close()
+                        if text and echo:
+                            sys.stdout.write(text)
+                            sys.stdout.flush()
+                returncode = self.wait()
+            return returncode
+        finally:
+            self.timed_out = watchdog.expired
+            if process.returncode is None:
+                self.signal(signal.SIGKILL)
+                self.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+
+def run_command(args, timeout=None):
+    """Run a command without output
+
+    :return: the :class:`Command`, once it exited
+    """
+    command = Command(args, new_session=bool(timeout))
+    command.run(lambda *args, **kwargs: None, echo=False, timeout=timeout)
+    return command
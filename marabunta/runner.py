@@ -2,13 +2,22 @@
 # Copyright 2016-2017 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import hashlib
 import traceback
 import sys
 
+from contextlib import nullcontext
 from datetime import datetime
 
-from .database import IrModuleModule
+from .addons import (
+    AddonsChecksum, ManifestReader, ManifestVersions, upgrade_closure,
+)
+from .database import (
+    CheckpointTable, IrModuleModule, OperationStatsTable, VersionLogTable,
+)
 from .exception import MigrationError, OperationError
+from .logs import LogSink
+from .model import OperationGraph
 from .output import print_decorated, safe_print
 from .version import MarabuntaVersion
 
@@ -17,16 +26,49 @@ LOG_DECORATION = u'|> '
 
 class Runner(object):
 
-    def __init__(self, config, migration, database, table):
+    def __init__(self, config, migration, database, table, backup_lock=None):
         self.config = config
         self.migration = migration
         self.database = database
         self.table = table
+        # limits the number of concurrent backups when several databases
+        # are migrated in parallel
+        self.backup_lock = backup_lock or nullcontext()
+        # state of the addons, shared by the versions
+        self.module_table = IrModuleModule(database)
+        # logs written while the versions are applied
+        self.log_table = None
+        if config.log_storage == 'table':
+            self.log_table = VersionLogTable(database)
+        # steps of the versions already done, see VersionRunner.execute
+        self.checkpoint_table = CheckpointTable(database)
+        self.stats_table = OperationStatsTable(database)
         # we keep the addons upgrading during a run in this set,
         # this is only useful when using 'allow_serie',
         # if an addon has just been installed or updated,
         # we don't want to do it again for another version
         self.upgraded_addons = set()
+        # detects the addons which do not need to be upgraded
+        self.unchanged_addons = None
+        addons_path = [path.strip() for path
+                       in (config.addons_path or '').split(',')
+                       if path.strip()]
+        # manifests of the addons, read in the addons path if any
+        self.manifests = None
+        if addons_path:
+            self.manifests = ManifestReader(database, addons_path)
+        skip_unchanged_addons = migration.options.skip_unchanged_addons
+        if skip_unchanged_addons:
+            if not addons_path:
+                raise MigrationError(
+                    u"The 'skip_unchanged_addons' option requires the "
+                    u"addons path (--addons-path)"
+                )
+            if skip_unchanged_addons == 'manifest_version':
+                self.unchanged_addons = ManifestVersions(self.module_table,
+                                                         self.manifests)
+            else:
+                self.unchanged_addons = AddonsChecksum(database, addons_path)
 
     def log(self, message, decorated=True, stdout=True):
         if not stdout:
@@ -41,10 +83,68 @@ class Runner(object):
 
     def perform(self):
         self.table.create_if_not_exists()
+        if self.log_table:
+            self.log_table.create_if_not_exists()
+        self.checkpoint_table.create_if_not_exists()
+        self.stats_table.create_if_not_exists()
 
         db_versions = self.table.versions()
+        self.check_versions(db_versions)
 
-        if not self.config.force_version:
+        backup_options = self.migration.options.backup
+        run_backup = self.backup_required(db_versions)
+        if run_backup:
+            try:
+                backup_options.ignore_if_operation().execute(
+                    default_timeout=self.config.operation_timeout,
+                )
+            except OperationError:
+                pass
+            else:
+                run_backup = False
+        if run_backup:
+            backup_operation = backup_options.command_operation(self.config)
+            started = datetime.now()
+            # the command may contain the password of the database, the
+            # template is stored in the statistics
+            with self.backup_lock:
+                try:
+                    backup_operation.execute(
+                        self.log,
+                        default_timeout=self.config.operation_timeout,
+                    )
+                except Exception:
+                    self.record_stats(u'', u'backup:0', backup_operation,
+                                      started, command=backup_options.command,
+                                      failed=True)
+                    raise
+                self.record_stats(u'', u'backup:0', backup_operation,
+                                  started, command=backup_options.command)
+
+        for versions in self.version_batches(db_versions):
+            if len(versions) > 1:
+                self.log(u'processing versions {} in a batch'.format(
+                    u', '.join(version.number for version in versions)
+                ))
+                AddonsBatchRunner(self, versions).perform()
+                continue
+            version, = versions
+            if self.config.force_version:
+                self.log(u'force-execute version {}'.format(version.number))
+            self.log(u'processing version {}'.format(version.number))
+            VersionRunner(self, version).perform()
+
+    def check_versions(self, db_versions):
+        """Check that the versions of the migration can be applied
+
+        :param db_versions: the versions of ``marabunta_version``
+        :return: the versions not applied yet
+        :raise MigrationError: when a version failed, when several versions
+                               have to be applied without ``allow_serie``
+                               or when a version is below the database
+                               version
+        """
+        if not self.config.force_version and not self.config.resume:
             unfinished = [db_version for db_version
                           in db_versions
                           if not db_version.date_done]
@@ -53,7 +153,8 @@ class Runner(object):
                     u'Upgrade of version {} has been attempted and failed. '
                     u'You may want to restore the backup or to run again the '
                     u'migration with the MARABUNTA_FORCE_VERSION '
-                    u'environment variable '
+                    u'environment variable, to resume it with the '
+                    u'MARABUNTA_RESUME environment variable '
                     u'or to fix it manually (in that case, you will have to '
                     u'update the  \'marabunta_version\' table yourself.'
                     .format(u','.join(v.number for v in unfinished))
@@ -71,8 +172,10 @@ class Runner(object):
                     )
                 )
 
-        if not self.config.force_version and db_versions and unprocessed:
-            installed = max(MarabuntaVersion(v.number) for v in db_versions)
+        # the versions of a failed batch are all unfinished when resumed
+        done = [v for v in db_versions if v.date_done]
+        if not self.config.force_version and done and unprocessed:
+            installed = max(MarabuntaVersion(v.number) for v in done)
             next_unprocess = min(
                 MarabuntaVersion(v.number) for v in unprocessed
             )
@@ -83,43 +186,161 @@ class Runner(object):
                         next_unprocess, installed
                     )
                 )
+        return unprocessed
 
-        backup_options = self.migration.options.backup
-        run_backup = False
-        if backup_options:
-            run_backup = (
-                # If we are forcing a version, we want a backup
-                self.config.force_version
-                # If any of the version not yet processed, including the noop
-                # versions, need a backup, we run it. (note: by default,
-                # noop versions don't trigger a backup but it can be
-                # explicitly activated)
-                or any(version.backup for version in self.migration.versions
-                       if not version.is_processed(db_versions))
-            )
-            if run_backup:
-                try:
-                    backup_options.ignore_if_operation().execute()
-                except OperationError:
-                    pass
-                else:
-                    run_backup = False
-        if run_backup:
-            backup_operation = backup_options.command_operation(self.config)
-            backup_operation.execute(self.log)
+    def backup_required(self, db_versions):
+        """Return True if the backup has to be done before the versions
 
-        for version in self.migration.versions:
-            # when we force-execute one version, we skip all the others
-            if self.config.force_version:
-                if self.config.force_version != version.number:
-                    continue
-                else:
-                    self.log(
-                        u'force-execute version {}'.format(version.number)
-                    )
+        The backup is still skipped when its ``ignore_if`` command succeeds.
+        """
+        if not self.migration.options.backup:
+            return False
+        return bool(
+            # If we are forcing a version, we want a backup
+            self.config.force_version
+            # If any of the version not yet processed, including the noop
+            # versions, need a backup, we run it. (note: by default,
+            # noop versions don't trigger a backup but it can be
+            # explicitly activated)
+            or any(version.backup for version in self.migration.versions
+                   if not version.is_processed(db_versions))
+        )
 
-            self.log(u'processing version {}'.format(version.number))
-            VersionRunner(self, version).perform()
+    def version_batches(self, db_versions):
+        """Yield the versions to perform, by lists
+
+        Only the forced version is yielded when a version is forced.
+        Otherwise, with the ``batch_addons`` option, consecutive versions to
+        apply having no pre or post operations are yielded together: they
+        have their addons installed or upgraded by a single run of the
+        install command, the registry of Odoo is loaded once for all of
+        them.
+        """
+        if self.config.force_version:
+            # when we force-execute one version, we skip all the others
+            for version in self.migration.versions:
+                if self.config.force_version == version.number:
+                    yield [version]
+            return
+        if not self.migration.options.batch_addons:
+            for version in self.migration.versions:
+                yield [version]
+            return
+        batch = []
+        for version in self.migration.versions:
+            if (not version.is_processed(db_versions) and
+                    not version.has_operations(mode=self.config.mode)):
+                batch.append(version)
+                continue
+            if batch:
+                yield batch
+            batch = []
+            yield [version]
+        if batch:
+            yield batch
+
+    def record_stats(self, version, key, operation, started, command=None,
+                     failed=False, log=None):
+        """Store the statistics of an executed operation
+
+        :param key: identifies the operation in the version, such as
+                    ``post:3``
+        :param command: the command stored, the one of the operation by
+                        default
+        :param failed: the operation failed, an error while storing the
+                       statistics is only logged, it must not hide the
+                       error of the operation
+        :param log: logs the error, the one of the runner by default
+        """
+        mode = self.config.mode or u''
+        rows = []
+        if operation.stats:
+            rows.append((version, mode, key, command or operation.command,
+                         started, operation.stats))
+        # the operations of a group or graph by their index in it
+        for index, stats in sorted(
+                getattr(operation, 'node_stats', {}).items()):
+            rows.append((version, mode, u'{}:{}'.format(key, index),
+                         operation.operations[index].command, started,
+                         stats))
+        if not rows:
+            return
+        try:
+            self.stats_table.write(rows)
+        except Exception as error:
+            if not failed:
+                raise
+            (log or self.log)(u'statistics of {} not stored: {}'.format(
+                key, error,
+            ))
+
+    def skip_unchanged_addons(self, upgrade_operation, log):
+        """Remove from an upgrade the addons whose code did not change"""
+        if not self.unchanged_addons:
+            return upgrade_operation
+        unchanged = self.unchanged_addons.unchanged(
+            upgrade_operation.to_upgrade - self.upgraded_addons
+        )
+        if unchanged:
+            log(u'addons not upgraded, their code did not change: {}'.format(
+                u', '.join(sorted(unchanged))
+            ))
+        return upgrade_operation.without_upgrade(unchanged)
+
+    def read_dependencies(self, names=()):
+        """Return the direct dependencies of the addons
+
+        They are read from ``ir_module_module_dependency``, the ones
+        declared in the manifests found in the addons path replace them:
+        Odoo updates the dependencies from the manifests before upgrading,
+        a dependency added since the last upgrade changes the addons it
+        upgrades.
+
+        :param names: addons whose manifest is read in addition to the
+                      ones known by the database, such as the addons to
+                      install
+        """
+        dependencies = self.module_table.read_dependencies()
+        if not self.manifests:
+            return dependencies
+        return self.manifests.dependencies(dependencies, names=names)
+
+    def prepare_addons(self, upgrade_operation, log):
+        """Adapt an installation / upgrade of addons before its execution
+
+        The addons whose code did not change are removed and the addons
+        upgraded anyway with one of their dependencies are not passed to
+        the install command. The addons which will be upgraded by Odoo
+        are logged.
+        """
+        upgrade_operation = self.skip_unchanged_addons(upgrade_operation, log)
+        dependencies = self.read_dependencies(
+            upgrade_operation.to_install | upgrade_operation.to_upgrade
+        )
+        upgrade_operation.dependencies = dependencies
+        to_upgrade, covered = upgrade_operation.upgrade_list(
+            self.upgraded_addons
+        )
+        if covered:
+            log(u'addons upgraded with their dependencies: {}'.format(
+                u', '.join(sorted(covered))
+            ))
+        if to_upgrade:
+            installed = {addon.name for addon
+                         in self.module_table.read_state()
+                         if addon.state in ('installed', 'to upgrade')}
+            effective = upgrade_closure(to_upgrade, dependencies, installed)
+            log(u'addons upgraded by odoo: {}'.format(
+                u', '.join(sorted(effective))
+            ))
+        return upgrade_operation
+
+    def addons_done(self, addons):
+        """Called once addons have been installed or upgraded"""
+        if self.unchanged_addons:
+            self.unchanged_addons.record(addons)
+        if self.manifests:
+            self.manifests.save()
 
 
 class VersionRunner(object):
@@ -130,11 +351,24 @@ class VersionRunner(object):
         self.migration = runner.migration
         self.config = runner.config
         self.database = runner.database
+        self.module_table = runner.module_table
         self.version = version
         self.logs = []
+        # index of the operation being executed, 0 for the messages
+        # outside of the operations
+        self.operation_index = 0
+        # fingerprints of the steps already done when the version is
+        # resumed
+        self.steps_done = None
+        self.sink = None
+        if runner.log_table:
+            self.sink = LogSink(runner.log_table, version.number)
 
     def log(self, message, decorated=True, stdout=True):
-        self.logs.append(message)
+        if self.sink:
+            self.sink.write(self.operation_index, message)
+        else:
+            self.logs.append(message)
         if not stdout:
             return
         if decorated:
@@ -147,16 +381,117 @@ class VersionRunner(object):
             safe_print(message)
 
     def start(self):
+        if self.steps_done is None:
+            self.runner.checkpoint_table.clear(self.version.number)
+            if self.sink:
+                self.runner.log_table.clear(self.version.number)
         self.log(u'start')
-        self.table.start_version(self.version.number, datetime.now())
+        self.table.start_version(self.version.number, datetime.now(),
+                                 keep_log=self.steps_done is not None)
+
+    def failed(self, db_versions):
+        """Return True if the version has been started and not finished"""
+        return any(db_version.number == self.version.number and
+                   not db_version.date_done for db_version in db_versions)
+
+    def resume(self):
+        """Resume a version which failed, its done steps are skipped"""
+        self.steps_done = self.runner.checkpoint_table.read(
+            self.version.number
+        )
+        # the log of the failed run is kept, the new one follows it
+        if self.sink:
+            self.operation_index = self.runner.log_table.last_operation(
+                self.version.number,
+            ) + 1
+        else:
+            previous = next((db_version.log for db_version
+                             in self.table.versions()
+                             if db_version.number == self.version.number),
+                            None)
+            if previous:
+                self.logs[:0] = [previous, u'']
+        self.log(u'resume, {} steps already done'.format(
+            len(self.steps_done)
+        ))
 
     def finish(self):
         self.log(u'done')
-        module_table = IrModuleModule(self.database)
-        addons_state = module_table.read_state()
+        addons_state = self.module_table.read_state()
+        delta = self.config.addons_snapshot == 'delta'
+        if self.sink:
+            self.sink.flush()
         self.table.finish_version(self.version.number, datetime.now(),
-                                  u'\n'.join(self.logs),
-                                  [state._asdict() for state in addons_state])
+                                  u'\n'.join(self.logs) or None,
+                                  [{'name': state.name, 'state': state.state}
+                                   for state in addons_state],
+                                  delta=delta,
+                                  compress=self.config.log_storage ==
+                                  'compressed')
+        self.runner.checkpoint_table.clear(self.version.number)
+
+    def fingerprint(self, step):
+        """Identify a step of the version between runs
+
+        :param step: stage (such as 'pre' or 'post:full'), position in the
+                     stage and command of the step
+        """
+        return hashlib.sha1(
+            u'\0'.join(u'{}'.format(part) for part in step).encode('utf-8')
+        ).hexdigest()
+
+    def is_done(self, step):
+        """Return True if the step has been done before the version failed"""
+        return bool(self.steps_done) and \
+            self.fingerprint(step) in self.steps_done
+
+    def step_done(self, step):
+        """Record a step as done, so it is skipped if the version fails"""
+        self.runner.checkpoint_table.record(
+            self.version.number, self.fingerprint(step),
+            u' '.join(u'{}'.format(part) for part in step), datetime.now(),
+        )
+
+    def execute(self, operation, step=None):
+        """Execute an operation of the version
+
+        Any operation may install or upgrade addons (scripts, ...), the
+        state of the addons has to be read again after it.
+
+        The critical paths of a graph of operations are measured with the
+        durations of their previous executions.
+
+        :param step: identifies the operation in the version, see
+                     :meth:`fingerprint`, the operation is skipped when it
+                     has already been done and recorded as done after it
+        """
+        self.operation_index += 1
+        if step and self.is_done(step):
+            self.log(u'skip {!r}, already done'.format(operation))
+            return
+        if isinstance(operation, OperationGraph):
+            operation.set_durations(self.runner.stats_table.durations(
+                [node.command for node in operation.operations]
+            ))
+        started = datetime.now()
+        try:
+            operation.execute(self.log,
+                              default_timeout=self.config.operation_timeout)
+        except Exception:
+            self.module_table.invalidate()
+            if step:
+                self.record_stats(step, operation, started, failed=True)
+            raise
+        self.module_table.invalidate()
+        if step:
+            self.record_stats(step, operation, started)
+            self.step_done(step)
+
+    def record_stats(self, step, operation, started, failed=False):
+        self.runner.record_stats(
+            self.version.number, u'{}:{}'.format(step[0], step[1]),
+            operation, started, failed=failed, log=self.log,
+        )
 
     def perform(self):
         """Perform the version upgrade on the database.
@@ -171,19 +506,31 @@ class VersionRunner(object):
             )
             return
 
+        if self.config.resume and self.failed(db_versions):
+            self.resume()
         self.start()
         try:
             self._perform_version(version)
         except Exception:
-            if sys.version_info < (3, 4):
-                msg = traceback.format_exc().decode('utf8', errors='ignore')
-            else:
-                msg = traceback.format_exc()
-            error = u'\n'.join(self.logs + [u'\n', msg])
-            self.table.record_log(version.number, error)
+            self.record_error()
             raise
         self.finish()
 
+    def record_error(self):
+        """Store the log of the version with the current exception"""
+        if sys.version_info < (3, 4):
+            msg = traceback.format_exc().decode('utf8', errors='ignore')
+        else:
+            msg = traceback.format_exc()
+        if self.sink:
+            self.sink.write(self.operation_index, msg)
+            self.sink.flush()
+        error = u'\n'.join(self.logs + [u'\n', msg])
+        self.table.record_log(
+            self.version.number, error,
+            compress=self.config.log_storage == 'compressed',
+        )
+
     def _perform_version(self, version):
         """Inner method for version upgrade.
 
@@ -196,40 +543,148 @@ class VersionRunner(object):
         if version.is_noop():
             self.log(u'version {} is a noop'.format(version.number))
         else:
+            mode = self.config.mode
             self.log(u'execute base pre-operations')
-            for operation in version.pre_operations():
-                operation.execute(self.log)
-            if self.config.mode:
-                self.log(u'execute %s pre-operations' % self.config.mode)
-                for operation in version.pre_operations(mode=self.config.mode):
-                    operation.execute(self.log)
+            for index, operation in enumerate(version.pre_operations()):
+                self.execute(operation, step=(u'pre', index, operation))
+            if mode:
+                self.log(u'execute %s pre-operations' % mode)
+                for index, operation in enumerate(
+                        version.pre_operations(mode=mode)):
+                    self.execute(operation,
+                                 step=(u'pre:' + mode, index, operation))
 
             self.perform_addons()
 
             self.log(u'execute base post-operations')
-            for operation in version.post_operations():
-                operation.execute(self.log)
-            if self.config.mode:
-                self.log(u'execute %s post-operations' % self.config.mode)
-                for operation in version.post_operations(self.config.mode):
-                    operation.execute(self.log)
+            for index, operation in enumerate(version.post_operations()):
+                self.execute(operation, step=(u'post', index, operation))
+            if mode:
+                self.log(u'execute %s post-operations' % mode)
+                for index, operation in enumerate(
+                        version.post_operations(mode)):
+                    self.execute(operation,
+                                 step=(u'post:' + mode, index, operation))
 
     def perform_addons(self):
         version = self.version
 
-        module_table = IrModuleModule(self.database)
-        addons_state = module_table.read_state()
+        addons_state = self.module_table.read_state()
 
         upgrade_operation = version.upgrade_addons_operation(
             addons_state,
             mode=self.config.mode
         )
+        # the addons of the version, whatever their state
+        step = (u'addons', 0, u','.join(sorted(
+            upgrade_operation.to_install | upgrade_operation.to_upgrade
+        )))
+        if self.is_done(step):
+            self.log(u'skip installation / upgrade of addons, already done')
+            self.runner.upgraded_addons |= (upgrade_operation.to_install |
+                                            upgrade_operation.to_upgrade)
+            return
+        upgrade_operation = self.runner.prepare_addons(
+            upgrade_operation, self.log,
+        )
         # exclude the addons already installed or updated during this run
         # when 'allow_serie' is active
         exclude = self.runner.upgraded_addons
         self.log(u'installation / upgrade of addons')
         operation = upgrade_operation.operation(exclude_addons=exclude)
         if operation:
-            operation.execute(self.log)
+            self.execute(operation, step=step)
+            self.runner.addons_done(
+                (upgrade_operation.to_install |
+                 upgrade_operation.to_upgrade) - exclude
+            )
+        self.runner.upgraded_addons |= (upgrade_operation.to_install |
+                                        upgrade_operation.to_upgrade)
+
+
+class AddonsBatchRunner(object):
+    """Install or upgrade the addons of several versions in a single run
+
+    The versions must not have pre or post operations. They are all
+    started, then the addons of all the versions are installed or upgraded
+    by one run of the install command, logged in the last version, and the
+    versions are all marked as done.
+
+    With ``--resume``, the installation / upgrade is skipped when it has
+    been done before the versions failed, as for a single version.
+    """
+
+    def __init__(self, runner, versions):
+        self.runner = runner
+        self.config = runner.config
+        self.module_table = runner.module_table
+        self.version_runners = [VersionRunner(runner, version)
+                                for version in versions]
+
+    def perform(self):
+        version_runners = self.version_runners
+        last = version_runners[-1]
+        db_versions = self.runner.table.versions()
+        for version_runner in version_runners:
+            if self.config.resume and version_runner.failed(db_versions):
+                version_runner.resume()
+            version_runner.start()
+        try:
+            self.perform_addons(last)
+        except Exception:
+            for version_runner in version_runners:
+                version_runner.record_error()
+            raise
+        for version_runner in version_runners[:-1]:
+            version_runner.log(u'addons installed / upgraded with version {}'
+                               .format(last.version.number))
+            version_runner.finish()
+        last.finish()
+
+    def upgrade_operation(self, addons_state):
+        """Return the installation / upgrade of the addons of the versions"""
+        upgrade_operation = None
+        for batched in self.version_runners:
+            operation = batched.version.upgrade_addons_operation(
+                addons_state,
+                mode=self.config.mode,
+            )
+            if upgrade_operation is None:
+                upgrade_operation = operation
+            else:
+                upgrade_operation = upgrade_operation.merge(operation)
+        return upgrade_operation
+
+    def perform_addons(self, version_runner):
+        addons_state = self.module_table.read_state()
+        upgrade_operation = self.upgrade_operation(addons_state)
+        # the addons of the versions, whatever their state
+        step = (u'addons', 0, u','.join(sorted(
+            upgrade_operation.to_install | upgrade_operation.to_upgrade
+        )))
+        if version_runner.is_done(step):
+            version_runner.log(
+                u'skip installation / upgrade of addons, already done'
+            )
+            self.runner.upgraded_addons |= (upgrade_operation.to_install |
+                                            upgrade_operation.to_upgrade)
+            return
+        upgrade_operation = self.runner.prepare_addons(
+            upgrade_operation, version_runner.log,
+        )
+        exclude = self.runner.upgraded_addons
+        version_runner.log(
+            u'installation / upgrade of addons of versions {}'.format(
+                u', '.join(batched.version.number
+                           for batched in self.version_runners)
+            )
+        )
+        operation = upgrade_operation.operation(exclude_addons=exclude)
+        if operation:
+            version_runner.execute(operation, step=step)
+            self.runner.addons_done(
+                (upgrade_operation.to_install |
+                 upgrade_operation.to_upgrade) - exclude
+            )
         self.runner.upgraded_addons |= (upgrade_operation.to_install |
                                         upgrade_operation.to_upgrade)
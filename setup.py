@@ -19,6 +19,8 @@ test_deps = [
 
 extras = {
     'test': test_deps,
+    # compression of the logs with zstd instead of zlib
+    'zstd': ['zstandard'],
 }
 
 setup(
@@ -63,6 +65,9 @@ setup(
         'Programming Language :: Python :: Implementation :: PyPy',
     ),
     entry_points={
-        'console_scripts': ['marabunta = marabunta.core:main']
+        'console_scripts': [
+            'marabunta = marabunta.core:main',
+            'marabunta-multi = marabunta.multi:main',
+        ]
     },
 )
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from collections import namedtuple
+from io import StringIO
+
+import mock
+import pytest
+
+from marabunta import addons
+from marabunta.addons import (
+    AddonsChecksum, ManifestReader, ManifestVersions, find_addons,
+    prune_upgrades, upgrade_closure, version_bumped,
+)
+from marabunta.config import Config
+from marabunta.database import (
+    AddonChecksumTable, AddonManifestTable, Database, IrModuleModule,
+    MigrationTable,
+)
+from marabunta.exception import MigrationError
+from marabunta.parser import YamlParser
+from marabunta.runner import Runner
+
+ModuleRecord = namedtuple('ModuleRecord', 'name state latest_version',
+                          defaults=(None,))
+
+YAML_SKIP_UNCHANGED = u"""
+migration:
+  options:
+    install_command: echo
+    skip_unchanged_addons: checksum
+  versions:
+    - version: setup
+      addons:
+        upgrade:
+          - base
+          - sale
+          - stock
+"""
+
+
+@pytest.fixture
+def addons_path(tmp_path):
+    for path, name in (('odoo', 'base'), ('odoo', 'sale'),
+                       ('custom', 'sale'), ('custom', 'stock')):
+        addon = tmp_path / path / name
+        addon.mkdir(parents=True)
+        (addon / '__manifest__.py').write_text(u"{'name': '%s'}" % name)
+        (addon / 'models.py').write_text(u'# %s' % name)
+        (addon / '__pycache__').mkdir()
+        (addon / '__pycache__' / 'models.pyc').write_bytes(b'\0')
+    return [str(tmp_path / 'custom'), str(tmp_path / 'odoo')]
+
+
+def test_find_addons(addons_path):
+    directories = find_addons(addons_path, ['base', 'sale', 'missing'])
+    assert sorted(directories) == ['base', 'sale']
+    # the first directory of the addons path wins
+    assert directories['sale'].startswith(addons_path[0])
+
+
+def test_addons_checksum(addons_path):
+    checksums = AddonsChecksum(mock.MagicMock(spec=Database), addons_path)
+    checksums.table = mock.Mock(spec=AddonChecksumTable)
+    checksums.table.read.return_value = {}
+    # nothing stored yet
+    assert checksums.unchanged(['base', 'sale']) == set()
+    checksums.record(['base', 'sale', 'stock'])
+    rows = checksums.table.write.call_args[0][0]
+    assert [row[0] for row in rows] == ['base', 'sale', 'stock']
+    stored = {name: (checksum, fingerprint)
+              for name, checksum, fingerprint in rows}
+
+    checksums = AddonsChecksum(mock.MagicMock(spec=Database), addons_path)
+    checksums.table = mock.Mock(spec=AddonChecksumTable)
+    checksums.table.read.return_value = stored
+    # the files did not change, the content is not read
+    with mock.patch.object(addons, 'addon_checksum') as addon_checksum:
+        assert checksums.unchanged(['base', 'sale']) == {'base', 'sale'}
+    assert not addon_checksum.called
+
+    # same content, other modification time: the content is compared
+    stored['base'] = (stored['base'][0], 'other fingerprint')
+    with open(find_addons(addons_path, ['sale'])['sale'] + '/models.py',
+              'a') as source:
+        source.write(u'\n# changed')
+    assert checksums.unchanged(['base', 'sale']) == {'base'}
+
+
+def test_version_bumped():
+    assert not version_bumped(u'1.0.3', u'16.0.1.0.3')
+    assert not version_bumped(u'16.0.1.0.3', u'16.0.1.0.3')
+    assert version_bumped(u'1.0.4', u'16.0.1.0.3')
+    assert version_bumped(u'0.3', u'16.0.1.0.3')
+    assert version_bumped(u'1.0.3', None)
+    assert version_bumped(None, u'16.0.1.0.3')
+
+
+def test_manifest_versions(addons_path):
+    sale = find_addons(addons_path, ['sale'])['sale']
+    with open(sale + '/__manifest__.py', 'w') as manifest:
+        manifest.write(u"# comment\n{'name': 'sale', 'version': '1.0.1',\n"
+                       u" 'depends': ['base']}\n")
+    module_table = mock.Mock()
+    module_table.read_state.return_value = [
+        ModuleRecord('base', 'installed', u'16.0.1.0'),
+        ModuleRecord('sale', 'installed', u'16.0.1.0.0'),
+        ModuleRecord('stock', 'uninstalled'),
+    ]
+    manifests = ManifestReader(mock.MagicMock(spec=Database), addons_path)
+    manifests.table = mock.Mock(spec=AddonManifestTable)
+    manifests.table.read.return_value = {}
+    versions = ManifestVersions(module_table, manifests)
+    assert versions.manifest_versions(['base', 'sale', 'missing']) == {
+        'base': None, 'sale': u'1.0.1',
+    }
+    assert versions.unchanged(['base', 'sale', 'stock']) == set()
+
+    module_table.read_state.return_value[1] = ModuleRecord(
+        'sale', 'installed', u'16.0.1.0.1'
+    )
+    # the manifest did not change, it is not parsed again
+    with mock.patch('ast.parse') as parse:
+        assert versions.unchanged(['sale']) == {'sale'}
+    assert not parse.called
+    assert manifests.table.read.call_count == 2
+
+    # the parsed manifests are stored for the next runs
+    manifests.save()
+    rows = manifests.table.write.call_args[0][0]
+    assert [row[0] for row in rows] == sorted(
+        directory + '/__manifest__.py' for directory
+        in find_addons(addons_path, ['base', 'sale', 'stock']).values()
+    )
+    path = find_addons(addons_path, ['sale'])['sale'] + '/__manifest__.py'
+    stored = {row[0]: row[1:] for row in rows}
+    assert stored[path][2:] == (u'1.0.1', {'base'})
+    manifests.save()
+    assert manifests.table.write.call_count == 1
+
+    # a new run reads them from the table
+    manifests = ManifestReader(mock.MagicMock(spec=Database), addons_path)
+    manifests.table = mock.Mock(spec=AddonManifestTable)
+    manifests.table.read.return_value = stored
+    with mock.patch('ast.parse') as parse:
+        assert manifests.read(['sale']) == {'sale': (u'1.0.1', {'base'})}
+    assert not parse.called
+    # unless they changed
+    stored[path] = (0,) + stored[path][1:]
+    manifests = ManifestReader(mock.MagicMock(spec=Database), addons_path)
+    manifests.table = mock.Mock(spec=AddonManifestTable)
+    manifests.table.read.return_value = stored
+    with mock.patch('marabunta.addons.parse_manifest') as parse:
+        parse.return_value = (u'1.0.2', {'base'})
+        assert manifests.read(['sale']) == {'sale': (u'1.0.2', {'base'})}
+    assert parse.call_args == mock.call(path)
+
+
+def test_runner_skip_unchanged_addons(capfd):
+    migration = YamlParser.parser_from_buffer(
+        StringIO(YAML_SKIP_UNCHANGED)
+    ).parse()
+    table = mock.MagicMock(spec=MigrationTable)
+    table.versions.return_value = []
+    database = mock.MagicMock(spec=Database)
+    with pytest.raises(MigrationError):
+        Runner(Config('m.yml', 'test'), migration, database, table)
+
+    config = Config('m.yml', 'test', addons_path='/odoo/addons')
+    runner = Runner(config, migration, database, table)
+    runner.module_table = mock.Mock()
+    runner.module_table.read_state.return_value = [
+        ModuleRecord('base', 'installed'),
+        ModuleRecord('sale', 'installed'),
+    ]
+    runner.module_table.read_dependencies.return_value = {}
+    runner.unchanged_addons = mock.Mock(spec=AddonsChecksum)
+    runner.unchanged_addons.unchanged.return_value = {'base'}
+    runner.perform()
+    output = capfd.readouterr()[0]
+    assert u'addons not upgraded, their code did not change: base' in output
+    assert u'--no-http -i stock -u sale\n' in output
+    assert runner.unchanged_addons.record.call_args == mock.call(
+        {'sale', 'stock'}
+    )
+
+
+def test_runner_skip_unchanged_addons_manifest_version():
+    migration = YamlParser.parser_from_buffer(StringIO(
+        YAML_SKIP_UNCHANGED.replace(u'checksum', u'manifest_version')
+    )).parse()
+    table = mock.MagicMock(spec=MigrationTable)
+    table.versions.return_value = []
+    config = Config('m.yml', 'test', addons_path='/odoo/addons')
+    runner = Runner(config, migration, mock.MagicMock(spec=Database), table)
+    assert isinstance(runner.unchanged_addons, ManifestVersions)
+    assert runner.unchanged_addons.module_table is runner.module_table
+    assert runner.unchanged_addons.manifests is runner.manifests
+
+
+DEPENDENCIES = {
+    'sale': {'base'},
+    'stock': {'base'},
+    'sale_stock': {'sale', 'stock'},
+    'website_sale': {'sale'},
+    'crm': {'base'},
+}
+
+
+def test_prune_upgrades():
+    kept, covered = prune_upgrades(
+        {'crm', 'sale', 'sale_stock', 'website_sale', 'stock'},
+        DEPENDENCIES,
+    )
+    assert kept == ['crm', 'sale', 'stock']
+    assert covered == {'sale_stock', 'website_sale'}
+    kept, covered = prune_upgrades({'sale_stock', 'website_sale', 'base'},
+                                   DEPENDENCIES)
+    assert kept == ['base']
+
+
+def test_prune_upgrades_cycle():
+    kept, covered = prune_upgrades({'a', 'b', 'c'},
+                                   {'a': {'b'}, 'b': {'a'}, 'c': {'a'}})
+    assert kept == ['a', 'b']
+    assert covered == {'c'}
+
+
+def test_upgrade_closure():
+    installed = {'base', 'sale', 'stock', 'sale_stock', 'crm'}
+    assert upgrade_closure({'sale'}, DEPENDENCIES, installed) == {
+        'sale', 'sale_stock',
+    }
+    assert upgrade_closure({'base'}, DEPENDENCIES, installed) == installed
+
+
+def test_manifest_dependencies(addons_path):
+    stock = find_addons(addons_path, ['stock'])['stock']
+    with open(stock + '/__manifest__.py', 'w') as manifest:
+        manifest.write(u"{'name': 'stock', 'depends': ['base', 'product']}")
+    sale = find_addons(addons_path, ['sale'])['sale']
+    with open(sale + '/__manifest__.py', 'w') as manifest:
+        manifest.write(u"{'name': 'sale', 'depends': DEPENDS}")
+    manifests = ManifestReader(mock.MagicMock(spec=Database), addons_path)
+    manifests.table = mock.Mock(spec=AddonManifestTable)
+    manifests.table.read.return_value = {}
+    stored = {'sale': {'base'}, 'stock': {'base'}, 'crm': {'base'}}
+    assert manifests.dependencies(stored, names=['base']) == {
+        # no 'depends' key
+        'base': set(),
+        # not a literal list, the stored dependencies are kept
+        'sale': {'base'},
+        'stock': {'base', 'product'},
+        # not found in the addons path
+        'crm': {'base'},
+    }
+    assert stored['stock'] == {'base'}
+
+
+def test_runner_dependencies_from_manifests(addons_path, capfd):
+    # stock no longer depends on sale since its last upgrade
+    stock = find_addons(addons_path, ['stock'])['stock']
+    with open(stock + '/__manifest__.py', 'w') as manifest:
+        manifest.write(u"{'name': 'stock', 'depends': ['base']}")
+    migration = YamlParser.parser_from_buffer(StringIO(
+        YAML_SKIP_UNCHANGED.replace(
+            u'    skip_unchanged_addons: checksum\n', u'',
+        ).replace(u'          - base\n', u'')
+    )).parse()
+    table = mock.MagicMock(spec=MigrationTable)
+    table.versions.return_value = []
+    config = Config('m.yml', 'test', addons_path=u','.join(addons_path))
+    runner = Runner(config, migration, mock.MagicMock(spec=Database), table)
+    runner.manifests.table = mock.Mock(spec=AddonManifestTable)
+    runner.manifests.table.read.return_value = {}
+    runner.module_table = mock.Mock(spec=IrModuleModule)
+    runner.module_table.read_state.return_value = [
+        ModuleRecord('base', 'installed'),
+        ModuleRecord('sale', 'installed'),
+        ModuleRecord('stock', 'installed'),
+    ]
+    runner.module_table.read_dependencies.return_value = {
+        'sale': {'base'}, 'stock': {'sale'},
+    }
+    runner.perform()
+    output = capfd.readouterr()[0]
+    # stock is not upgraded with sale anymore, it is passed to -u
+    assert u'--no-http -u sale,stock\n' in output
+    assert u'addons upgraded with their dependencies' not in output
+    assert u'addons upgraded by odoo: sale, stock' in output
+    assert runner.manifests.table.write.called
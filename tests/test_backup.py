@@ -8,7 +8,9 @@ import pytest
 import mock
 
 from marabunta.config import Config
-from marabunta.database import Database, MigrationTable
+from marabunta.database import (
+    Database, MigrationTable, OperationStatsTable,
+)
 from marabunta.model import MigrationBackupOption
 from marabunta.parser import YamlParser
 from marabunta.runner import Runner
@@ -49,16 +51,16 @@ def test_backup(runner_gen, parse_yaml, request, capfd):
     runner.perform()
     expected = (
         u'|> migration: Backing up...\n'
-        u'backup command\r\n'
+        u'backup command\n'
         u'|> migration: processing version setup\n'
         u'|> version setup: start\n'
         u'|> version setup: execute base pre-operations\n'
         u'|> version setup: echo \'pre-operation\'\n'
-        u'pre-operation\r\n'
+        u'pre-operation\n'
         u'|> version setup: installation / upgrade of addons\n'
         u'|> version setup: execute base post-operations\n'
         u'|> version setup: echo \'post-operation\'\n'
-        u'post-operation\r\n'
+        u'post-operation\n'
         u'|> version setup: done\n'
         u'|> migration: processing version 0.0.2\n'
         u'|> version 0.0.2: start\n'
@@ -68,13 +70,13 @@ def test_backup(runner_gen, parse_yaml, request, capfd):
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u'|> version 0.0.3: echo \'foobar\'\n'
-        u'foobar\r\n'
+        u'foobar\n'
         u'|> version 0.0.3: echo \'foobarbaz\'\n'
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: done\n'
         u'|> migration: processing version 0.0.4\n'
         u'|> version 0.0.4: start\n'
@@ -98,11 +100,11 @@ def test_backup_ignore_1(runner_gen, parse_yaml, request, capfd):
         u'|> version setup: start\n'
         u'|> version setup: execute base pre-operations\n'
         u'|> version setup: echo \'pre-operation\'\n'
-        u'pre-operation\r\n'
+        u'pre-operation\n'
         u'|> version setup: installation / upgrade of addons\n'
         u'|> version setup: execute base post-operations\n'
         u'|> version setup: echo \'post-operation\'\n'
-        u'post-operation\r\n'
+        u'post-operation\n'
         u'|> version setup: done\n'
         u'|> migration: processing version 0.0.2\n'
         u'|> version 0.0.2: start\n'
@@ -112,13 +114,13 @@ def test_backup_ignore_1(runner_gen, parse_yaml, request, capfd):
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u'|> version 0.0.3: echo \'foobar\'\n'
-        u'foobar\r\n'
+        u'foobar\n'
         u'|> version 0.0.3: echo \'foobarbaz\'\n'
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: done\n'
         u'|> migration: processing version 0.0.4\n'
         u'|> version 0.0.4: start\n'
@@ -137,16 +139,16 @@ def test_backup_ignore_2(runner_gen, parse_yaml, request, capfd):
     runner.perform()
     expected = (
         u'|> migration: Backing up...\n'
-        u'backup command\r\n'
+        u'backup command\n'
         u'|> migration: processing version setup\n'
         u'|> version setup: start\n'
         u'|> version setup: execute base pre-operations\n'
         u'|> version setup: echo \'pre-operation\'\n'
-        u'pre-operation\r\n'
+        u'pre-operation\n'
         u'|> version setup: installation / upgrade of addons\n'
         u'|> version setup: execute base post-operations\n'
         u'|> version setup: echo \'post-operation\'\n'
-        u'post-operation\r\n'
+        u'post-operation\n'
         u'|> version setup: done\n'
         u'|> migration: processing version 0.0.2\n'
         u'|> version 0.0.2: start\n'
@@ -156,13 +158,13 @@ def test_backup_ignore_2(runner_gen, parse_yaml, request, capfd):
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u'|> version 0.0.3: echo \'foobar\'\n'
-        u'foobar\r\n'
+        u'foobar\n'
         u'|> version 0.0.3: echo \'foobarbaz\'\n'
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: done\n'
         u'|> migration: processing version 0.0.4\n'
         u'|> version 0.0.4: start\n'
@@ -240,11 +242,11 @@ def test_backup_stop_on_failure_false(runner_gen, parse_yaml, request, capfd):
         u'|> version setup: start\n'
         u'|> version setup: execute base pre-operations\n'
         u'|> version setup: echo \'pre-operation\'\n'
-        u'pre-operation\r\n'
+        u'pre-operation\n'
         u'|> version setup: installation / upgrade of addons\n'
         u'|> version setup: execute base post-operations\n'
         u'|> version setup: echo \'post-operation\'\n'
-        u'post-operation\r\n'
+        u'post-operation\n'
         u'|> version setup: done\n'
         u'|> migration: processing version 0.0.2\n'
         u'|> version 0.0.2: start\n'
@@ -254,13 +256,13 @@ def test_backup_stop_on_failure_false(runner_gen, parse_yaml, request, capfd):
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u'|> version 0.0.3: echo \'foobar\'\n'
-        u'foobar\r\n'
+        u'foobar\n'
         u'|> version 0.0.3: echo \'foobarbaz\'\n'
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: done\n'
         u'|> migration: processing version 0.0.4\n'
         u'|> version 0.0.4: start\n'
@@ -283,16 +285,16 @@ def test_backup_noop(runner_gen, parse_yaml, request, capfd):
 
     expected = (
         u'|> migration: Backing up...\n'
-        u'backup command\r\n'
+        u'backup command\n'
         u'|> migration: processing version setup\n'
         u'|> version setup: start\n'
         u'|> version setup: execute base pre-operations\n'
         u'|> version setup: echo \'pre-operation\'\n'
-        u'pre-operation\r\n'
+        u'pre-operation\n'
         u'|> version setup: installation / upgrade of addons\n'
         u'|> version setup: execute base post-operations\n'
         u'|> version setup: echo \'post-operation\'\n'
-        u'post-operation\r\n'
+        u'post-operation\n'
         u'|> version setup: done\n'
         u'|> migration: processing version 0.0.2\n'
         u'|> version 0.0.2: start\n'
@@ -302,13 +304,13 @@ def test_backup_noop(runner_gen, parse_yaml, request, capfd):
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u'|> version 0.0.3: echo \'foobar\'\n'
-        u'foobar\r\n'
+        u'foobar\n'
         u'|> version 0.0.3: echo \'foobarbaz\'\n'
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: done\n'
         u'|> migration: processing version 0.0.4\n'
         u'|> version 0.0.4: start\n'
@@ -380,19 +382,19 @@ def test_backup_force_version(runner_gen, parse_yaml, request, capfd):
     runner.perform()
     expected = (
         u'|> migration: Backing up...\n'
-        u'backup command\r\n'
+        u'backup command\n'
         u'|> migration: force-execute version 0.0.3\n'
         u'|> migration: processing version 0.0.3\n'
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u"|> version 0.0.3: echo 'foobar'\n"
-        u'foobar\r\n'
+        u'foobar\n'
         u"|> version 0.0.3: echo 'foobarbaz'\n"
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u"|> version 0.0.3: echo 'post-op with unicode é â'\n"
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: done\n'
     )
     out = capfd.readouterr().out
@@ -415,14 +417,31 @@ def test_backup_force_version_no_backup_command(runner_gen, parse_yaml,
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u"|> version 0.0.3: echo 'foobar'\n"
-        u'foobar\r\n'
+        u'foobar\n'
         u"|> version 0.0.3: echo 'foobarbaz'\n"
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u"|> version 0.0.3: echo 'post-op with unicode é â'\n"
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: done\n'
     )
     out = capfd.readouterr().out
     assert expected == out
+
+
+def test_backup_stats_without_password(runner_gen, parse_yaml, request,
+                                       capfd):
+    backup_params, config = parse_yaml('migration_with_backup.yml')
+    backup_params.parsed['migration']['options']['backup'].update({
+        'command': 'echo "backup $db_password"',
+    })
+    config.db_password = 'secret'
+    runner = runner_gen(backup_params, config)
+    runner.stats_table = mock.Mock(spec=OperationStatsTable)
+    runner.perform()
+    assert u'backup secret' in capfd.readouterr().out
+    rows = [row for call in runner.stats_table.write.call_args_list
+            for row in call[0][0]]
+    assert rows[0][:4] == (u'', u'', u'backup:0',
+                           u'echo "backup $db_password"')
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import hashlib
+import os
+
+import mock
+import pytest
+
+from marabunta import core
+from marabunta.config import Config
+
+
+def example_config(request, filename='migration.yml', **kwargs):
+    migration_file = os.path.join(request.fspath.dirname,
+                                  'examples', filename)
+    return Config(migration_file, 'test', **kwargs)
+
+
+def test_migration_file_hash(request):
+    config = example_config(request)
+    with open(config.migration_file, 'rb') as fh:
+        expected = hashlib.sha1(fh.read()).hexdigest()
+    assert core.migration_file_hash(config.migration_file) == expected
+
+
+def test_migrate_nothing_to_do(request, capfd):
+    config = example_config(request)
+    with mock.patch.object(core.CompletionTable, 'is_up_to_date',
+                           return_value=True) as is_up_to_date, \
+            mock.patch.object(core, 'WebServer') as webserver:
+        core.migrate(config)
+    is_up_to_date.assert_called_once_with(
+        core.migration_file_hash(config.migration_file)
+    )
+    assert not webserver.called
+    assert capfd.readouterr().out == u'|> migration: nothing to migrate\n'
+
+
+def test_migrate_force_version_bypass_fast_path(request):
+    config = example_config(request, force_version='0.0.3')
+    with mock.patch.object(core.CompletionTable,
+                           'is_up_to_date') as is_up_to_date, \
+            mock.patch.object(core, 'WebServer'), \
+            mock.patch.object(core.Database, 'connect',
+                              side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            core.migrate(config)
+    assert not is_up_to_date.called
+
+
+def lock_connection(try_lock_result):
+    connection = mock.MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.fetchone.return_value = (try_lock_result,)
+    return connection, cursor
+
+
+def test_application_lock_acquired():
+    connection, cursor = lock_connection(True)
+    lock = core.ApplicationLock(connection, 42)
+    lock.start()
+    lock.wait_acquired()
+    assert lock.acquired
+    assert not lock.replica
+    lock.release()
+    cursor.execute.assert_called_once_with(
+        'SELECT pg_try_advisory_xact_lock(%s);', (42,)
+    )
+
+
+def test_application_lock_replica_waits_on_server(capfd):
+    connection, cursor = lock_connection(False)
+    lock = core.ApplicationLock(connection, 42, lock_timeout=10)
+    lock.start()
+    lock.wait_acquired()
+    assert lock.acquired
+    assert lock.replica
+    lock.release()
+    assert cursor.execute.call_args_list[1:] == [
+        mock.call('SET LOCAL lock_timeout = %s;', ('10s',)),
+        mock.call('SELECT pg_advisory_xact_lock(%s);',
+                  (42,)),
+    ]
+
+
+def test_application_lock_timeout(capfd):
+    connection, cursor = lock_connection(False)
+    cursor.execute.side_effect = [
+        None, None, core.psycopg2.OperationalError('lock timeout'),
+    ]
+    lock = core.ApplicationLock(connection, 42, lock_timeout=1)
+    lock.start()
+    with pytest.raises(core.MigrationError):
+        lock.wait_acquired()
+    assert not lock.acquired
+
+
+def test_advisory_lock_ident():
+    # the key of the previous versions, they exclude each other
+    assert core.advisory_lock_ident('odoodb') == core.ADVISORY_LOCK_IDENT
+    ident = core.advisory_lock_ident('odoodb', namespace='tenants')
+    assert -2 ** 63 <= ident < 2 ** 63
+    assert ident != core.ADVISORY_LOCK_IDENT
+    assert ident != core.advisory_lock_ident('odoodb2', namespace='tenants')
+    assert (core.advisory_lock_ident('odoodb', namespace='tenants') ==
+            core.advisory_lock_ident('odoodb', namespace='tenants'))
+
+
+def test_print_log_from_version_table(request, capfd):
+    config = example_config(request)
+    with mock.patch.object(core, 'Database'), \
+            mock.patch.object(core.VersionLogTable, 'iter_chunks',
+                              return_value=iter([])), \
+            mock.patch.object(core.MigrationTable, 'iter_log',
+                              return_value=iter([u'first\n', u'second\n'])):
+        core.print_log(config, '1.0.0')
+    assert capfd.readouterr()[0] == u'first\nsecond\n'
+
+
+def test_print_log_from_log_table(request, capfd):
+    config = example_config(request)
+    with mock.patch.object(core, 'Database'), \
+            mock.patch.object(core.VersionLogTable, 'iter_chunks',
+                              return_value=iter([u'start\n', u'done\n'])), \
+            mock.patch.object(core.MigrationTable, 'iter_log') as iter_log:
+        core.print_log(config, '1.0.0')
+    assert capfd.readouterr()[0] == u'start\ndone\n'
+    assert not iter_log.called
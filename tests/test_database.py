@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import hashlib
+import json
+
+from collections import namedtuple
+from datetime import datetime
+
+import mock
+import psycopg2
+import pytest
+
+from marabunta.config import Config
+from marabunta.database import (
+    CompletionTable, Database, IrModuleModule, MigrationTable, VersionRecord,
+)
+from marabunta.exception import MigrationError
+
+Notify = namedtuple('Notify', 'pid channel payload')
+
+
+@pytest.fixture
+def database():
+    database = mock.MagicMock(spec=Database)
+    connection = database.connect.return_value.__enter__.return_value
+    database.connection = connection
+    return database
+
+
+def test_completion_wait_done_notified(database):
+    completion = CompletionTable(database)
+    connection = database.connection
+
+    def poll():
+        connection.notifies.extend([
+            Notify(1, completion.channel, 'other_hash'),
+            Notify(1, completion.channel, 'the_hash'),
+        ])
+
+    connection.notifies = []
+    connection.poll.side_effect = poll
+    with mock.patch.object(completion, 'is_up_to_date', return_value=False), \
+            mock.patch('select.select', return_value=([connection], [], [])):
+        assert completion.wait_done('the_hash', lambda: False)
+    assert connection.close.called
+
+
+def test_completion_wait_done_before_listen(database):
+    completion = CompletionTable(database)
+    with mock.patch.object(completion, 'is_up_to_date', return_value=True), \
+            mock.patch('select.select') as select:
+        assert completion.wait_done('the_hash', lambda: False)
+    assert not select.called
+
+
+def test_completion_wait_done_stopped(database):
+    completion = CompletionTable(database)
+    database.connection.notifies = []
+    with mock.patch.object(completion, 'is_up_to_date', return_value=False), \
+            mock.patch('select.select', return_value=([], [], [])):
+        stop = mock.Mock(side_effect=[False, False, True])
+        assert not completion.wait_done('the_hash', stop)
+    assert stop.call_count == 3
+
+
+@pytest.fixture
+def connect():
+    with mock.patch('psycopg2.connect') as connect:
+        connect.side_effect = lambda **kw: mock.MagicMock(closed=0)
+        yield connect
+
+
+def test_cursor_autocommit_reuse_connection(connect):
+    database = Database(Config('migration.yml', 'test'))
+    with database.cursor_autocommit() as cursor:
+        cursor.execute('SELECT 1')
+    with database.cursor_autocommit() as cursor:
+        cursor.execute('SELECT 2')
+    assert connect.call_count == 1
+    assert database._connection.autocommit
+    database.close()
+    assert database._connection is None
+    with database.cursor_autocommit() as cursor:
+        cursor.execute('SELECT 3')
+    assert connect.call_count == 2
+
+
+def test_cursor_autocommit_reconnect_after_failure(connect):
+    database = Database(Config('migration.yml', 'test'))
+    with pytest.raises(psycopg2.OperationalError):
+        with database.cursor_autocommit() as cursor:
+            raise psycopg2.OperationalError('server closed the connection')
+    with database.cursor_autocommit() as cursor:
+        cursor.execute('SELECT 1')
+    assert connect.call_count == 2
+
+
+def test_cursor_autocommit_health_check(connect):
+    database = Database(Config('migration.yml', 'test'))
+    with database.cursor_autocommit():
+        pass
+    first = database._connection
+    cursor = first.cursor.return_value.__enter__.return_value
+    cursor.execute.side_effect = psycopg2.OperationalError('gone')
+    # not checked when recently used
+    with database.cursor_autocommit():
+        pass
+    assert database._connection is first
+    database._last_used -= Database.health_check_interval + 1
+    with database.cursor_autocommit():
+        pass
+    assert database._connection is not first
+    assert first.close.called
+    assert connect.call_count == 2
+
+
+def test_start_version_single_statement(database):
+    table = MigrationTable(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [
+        ('setup', datetime(2026, 1, 1), datetime(2026, 1, 1)),
+    ]
+    assert [v.number for v in table.versions()] == ['setup']
+    cursor.reset_mock()
+    cursor.fetchone.return_value = ('1.0.0', datetime(2026, 2, 1), None)
+    table.start_version('1.0.0', datetime(2026, 2, 1))
+    assert cursor.execute.call_count == 1
+    assert 'ON CONFLICT (number) DO UPDATE' in cursor.execute.call_args[0][0]
+    # the cache is updated, no need to read the table again
+    versions = table.versions()
+    assert not cursor.fetchall.called
+    assert [(v.number, v.date_done) for v in versions] == [
+        ('setup', datetime(2026, 1, 1)),
+        ('1.0.0', None),
+    ]
+
+    cursor.fetchone.return_value = ('1.0.0', datetime(2026, 2, 1),
+                                    datetime(2026, 2, 2))
+    table.finish_version('1.0.0', datetime(2026, 2, 2), 'done',
+                         [{'name': 'base', 'state': 'installed'}])
+    assert cursor.execute.call_count == 2
+    assert [(v.number, v.date_done) for v in table.versions()] == [
+        ('setup', datetime(2026, 1, 1)),
+        ('1.0.0', datetime(2026, 2, 2)),
+    ]
+
+    # a resumed version keeps its log
+    cursor.fetchall.return_value = []
+    cursor.fetchone.return_value = ('1.0.0', datetime(2026, 2, 3), None)
+    table.start_version('1.0.0', datetime(2026, 2, 3), keep_log=True)
+    assert 'log' not in cursor.execute.call_args[0][0]
+    cursor.fetchone.return_value = ('the failed log', None)
+    assert table.versions()[-1].log == 'the failed log'
+
+
+def test_versions_lazy_details(database):
+    table = MigrationTable(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    table.create_if_not_exists()
+    cursor.reset_mock()
+    cursor.fetchall.return_value = [
+        ('setup', datetime(2026, 1, 1), datetime(2026, 1, 1)),
+        ('1.0.0', datetime(2026, 2, 1), None),
+    ]
+    setup, version = table.versions()
+    query = cursor.execute.call_args[0][0]
+    assert 'log' not in query and 'addons' not in query
+
+    # the addons are read without the log
+    cursor.fetchone.return_value = (
+        '[{"name": "base", "state": "installed"}]',
+    )
+    assert setup.addons == [{'name': 'base', 'state': 'installed'}]
+    assert cursor.execute.call_args == mock.call(mock.ANY, ('setup',))
+    assert 'log' not in cursor.execute.call_args[0][0]
+    assert cursor.execute.call_count == 2
+
+    cursor.fetchone.return_value = ('setup log', None)
+    assert setup.log == 'setup log'
+    assert 'addons' not in cursor.execute.call_args[0][0]
+    assert cursor.execute.call_count == 3
+
+    # the cached record is updated
+    table.record_log('1.0.0', 'error log')
+    assert version.log == 'error log'
+    assert cursor.execute.call_count == 4
+
+
+def state_digest(state):
+    return hashlib.md5(state.encode('utf-8')).hexdigest()
+
+
+def test_module_state_cache(database):
+    modules = IrModuleModule(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    cursor.fetchone.return_value = ('ir_module_module',)
+    cursor.fetchall.return_value = [
+        ('base', 'installed', '16.0.1.3', datetime(2026, 1, 1)),
+        ('sale', 'uninstalled', None, datetime(2026, 1, 2)),
+    ]
+    assert sorted(modules.read_state()) == [
+        ('base', 'installed', '16.0.1.3'), ('sale', 'uninstalled', None),
+    ]
+    assert cursor.execute.call_count == 2  # to_regclass + read
+    # read from the cache
+    modules.read_state()
+    assert cursor.execute.call_count == 2
+
+    # nothing changed
+    modules.invalidate()
+    cursor.fetchone.return_value = (
+        state_digest(u'base:installed:16.0.1.3,sale:uninstalled:'),
+    )
+    modules.read_state()
+    assert cursor.execute.call_count == 3
+
+    modules.invalidate()
+    cursor.fetchone.return_value = (
+        state_digest(u'base:installed:16.0.1.3,sale:installed:16.0.1.0'),
+    )
+    cursor.fetchall.return_value = [
+        ('sale', 'installed', '16.0.1.0', datetime(2026, 1, 3)),
+    ]
+    assert sorted(modules.read_state()) == [
+        ('base', 'installed', '16.0.1.3'), ('sale', 'installed', '16.0.1.0'),
+    ]
+    # only the addons modified since the last read are fetched
+    assert cursor.execute.call_count == 5
+    assert cursor.execute.call_args[0][1] == (datetime(2026, 1, 2),)
+
+
+def test_module_state_deleted(database):
+    modules = IrModuleModule(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    cursor.fetchone.return_value = ('ir_module_module',)
+    cursor.fetchall.return_value = [
+        ('base', 'installed', '16.0.1.3', datetime(2026, 1, 1)),
+        ('sale', 'installed', '16.0.1.0', datetime(2026, 1, 2)),
+    ]
+    modules.read_state()
+    # 'sale' deleted, no row has a more recent write_date
+    modules.invalidate()
+    cursor.fetchone.return_value = (
+        state_digest(u'base:installed:16.0.1.3'),
+    )
+    cursor.fetchall.side_effect = [
+        [('sale', 'installed', '16.0.1.0', datetime(2026, 1, 2))],
+        [('base', 'installed', '16.0.1.3', datetime(2026, 1, 1))],
+    ]
+    assert modules.read_state() == [('base', 'installed', '16.0.1.3')]
+    # digest + modified rows + all the rows
+    assert cursor.execute.call_count == 5
+    assert len(cursor.execute.call_args[0]) == 1
+
+
+def test_module_state_no_table(database):
+    modules = IrModuleModule(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    cursor.fetchone.return_value = (None,)
+    assert modules.read_state() == []
+    assert cursor.execute.call_count == 1
+
+
+def test_finish_version_addons_delta(database):
+    table = MigrationTable(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [
+        ('setup', datetime(2026, 1, 1), datetime(2026, 1, 1)),
+    ]
+    cursor.fetchone.return_value = (
+        '[{"name": "base", "state": "installed"},'
+        ' {"name": "sale", "state": "uninstalled"},'
+        ' {"name": "stock", "state": "installed"}]',
+    )
+    table.versions()
+    table.versions()[0].addons  # load the details of 'setup'
+
+    cursor.fetchone.return_value = ('1.0.0', datetime(2026, 2, 1),
+                                    datetime(2026, 2, 2))
+    table.finish_version('1.0.0', datetime(2026, 2, 2), 'done', [
+        {'name': 'base', 'state': 'installed'},
+        {'name': 'crm', 'state': 'installed'},
+        {'name': 'sale', 'state': 'installed'},
+    ], delta=True)
+    queries = [call[0][0] for call in cursor.execute.call_args_list]
+    assert not any('log' in query for query in queries if 'SELECT' in query)
+    stored = json.loads(cursor.execute.call_args[0][1][3])
+    assert stored == {
+        'base': 'setup',
+        'depth': 1,
+        'changed': [{'name': 'crm', 'state': 'installed'},
+                    {'name': 'sale', 'state': 'installed'}],
+        'removed': ['stock'],
+    }
+    assert table.addons_state('1.0.0') == [
+        {'name': 'base', 'state': 'installed'},
+        {'name': 'crm', 'state': 'installed'},
+        {'name': 'sale', 'state': 'installed'},
+    ]
+
+    # a full snapshot is written when the chain is too long
+    table.addons_keyframe_interval = 1
+    cursor.fetchone.return_value = ('1.0.1', datetime(2026, 3, 1),
+                                    datetime(2026, 3, 2))
+    addons = [{'name': 'base', 'state': 'installed'}]
+    table.finish_version('1.0.1', datetime(2026, 3, 2), 'done', addons,
+                         delta=True)
+    assert json.loads(cursor.execute.call_args[0][1][3]) == addons
+
+
+def test_restart_version_addons_delta(database):
+    table = MigrationTable(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    setup_addons = [{'name': 'base', 'state': 'installed'}]
+    table._versions = [
+        VersionRecord('setup', datetime(2026, 1, 1), datetime(2026, 1, 1),
+                      addons=setup_addons),
+        VersionRecord('1.0.0', datetime(2026, 2, 1), datetime(2026, 2, 1),
+                      addons={'base': 'setup', 'depth': 1, 'removed': [],
+                              'changed': [{'name': 'sale',
+                                           'state': 'installed'}]}),
+        VersionRecord('1.0.1', datetime(2026, 3, 1), datetime(2026, 3, 1),
+                      addons={'base': '1.0.0', 'depth': 2, 'removed': [],
+                              'changed': [{'name': 'crm',
+                                           'state': 'installed'}]}),
+    ]
+    expected = [
+        {'name': 'base', 'state': 'installed'},
+        {'name': 'crm', 'state': 'installed'},
+        {'name': 'sale', 'state': 'installed'},
+    ]
+    # 1.0.0 forced again, 1.0.1 is stored relative to it
+    cursor.fetchall.return_value = [('1.0.1',)]
+    cursor.fetchone.return_value = ('1.0.0', datetime(2026, 4, 1), None)
+    table.start_version('1.0.0', datetime(2026, 4, 1))
+    stored = cursor.executemany.call_args[0][1]
+    assert [(json.loads(addons), number) for addons, number in stored] == [
+        (expected, '1.0.1'),
+    ]
+    assert table.addons_state('1.0.1') == expected
+
+    # the restarted version is a full snapshot, not relative to 1.0.1
+    cursor.fetchone.return_value = ('1.0.0', datetime(2026, 4, 1),
+                                    datetime(2026, 4, 2))
+    addons = [{'name': 'base', 'state': 'installed'}]
+    table.finish_version('1.0.0', datetime(2026, 4, 2), 'done', addons,
+                         delta=True)
+    assert json.loads(cursor.execute.call_args[0][1][3]) == addons
+    assert table.addons_state('1.0.1') == expected
+
+
+def test_addons_delta_base_version_order(database):
+    table = MigrationTable(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    table._versions = [
+        VersionRecord('setup', datetime(2026, 1, 1), datetime(2026, 1, 1),
+                      addons=[]),
+        VersionRecord('1.0.0', datetime(2026, 2, 1), datetime(2026, 2, 1),
+                      addons=[{'name': 'base', 'state': 'installed'}]),
+        # done after 1.0.0 but stored relative to 1.0.2
+        VersionRecord('1.0.3', datetime(2026, 3, 1), datetime(2026, 3, 1),
+                      addons={'base': '1.0.2', 'depth': 1, 'changed': [],
+                              'removed': []}),
+        VersionRecord('1.0.2', datetime(2026, 1, 1), None, addons=[]),
+    ]
+    cursor.fetchone.return_value = ('1.0.2', datetime(2026, 4, 1),
+                                    datetime(2026, 4, 2))
+    table.finish_version('1.0.2', datetime(2026, 4, 2), 'done', [],
+                         delta=True)
+    stored = json.loads(cursor.execute.call_args[0][1][3])
+    assert stored['base'] == '1.0.0'
+
+
+def test_addons_state_cycle(database):
+    table = MigrationTable(database)
+    table._versions = [
+        VersionRecord('1.0.0', datetime(2026, 2, 1), datetime(2026, 2, 1),
+                      addons={'base': '1.0.1', 'depth': 1, 'changed': [],
+                              'removed': []}),
+        VersionRecord('1.0.1', datetime(2026, 3, 1), datetime(2026, 3, 1),
+                      addons={'base': '1.0.0', 'depth': 1, 'changed': [],
+                              'removed': []}),
+    ]
+    with pytest.raises(MigrationError):
+        table.addons_state('1.0.1')
+
+
+def test_log_compressed(database):
+    table = MigrationTable(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    table.create_if_not_exists()
+    log = u'upgrade of all the addons é\n' * 10000
+    cursor.fetchone.return_value = ('1.0.0', datetime(2026, 2, 1),
+                                    datetime(2026, 2, 2))
+    table.finish_version('1.0.0', datetime(2026, 2, 2), log, [],
+                         compress=True)
+    params = cursor.execute.call_args[0][1]
+    assert params[1] is None
+    compressed = bytes(params[2].adapted)
+    assert len(compressed) < len(log) / 10
+
+    cursor.fetchone.return_value = (None, compressed)
+    chunks = list(table.iter_log('1.0.0'))
+    assert len(chunks) > 1
+    assert u''.join(chunks) == log
+
+
+def test_read_log_table_check(database):
+    table = MigrationTable(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    cursor.fetchone.return_value = (False,)
+    with pytest.raises(MigrationError) as err:
+        list(table.iter_log('1.0.0'))
+    assert u'no marabunta_version table' in u'{}'.format(err.value)
+
+    # table created by an older version, without log_compressed
+    cursor.fetchone.side_effect = [(True,), (u'the log', None)]
+    assert list(table.iter_log('1.0.0')) == [u'the log']
+    queries = [call[0][0] for call in cursor.execute.call_args_list]
+    assert u'ADD COLUMN IF NOT EXISTS log_compressed' in queries[-2]
+    # checked once
+    cursor.fetchone.side_effect = [(u'the log', None)]
+    assert list(table.iter_log('1.0.0')) == [u'the log']
+
+
+def test_module_dependencies_cache(database):
+    modules = IrModuleModule(database)
+    cursor = database.cursor_autocommit.return_value.__enter__.return_value
+    cursor.fetchone.return_value = ('ir_module_module',)
+    cursor.fetchall.return_value = [
+        ('sale', 'installed', '16.0.1.0', datetime(2026, 1, 1)),
+    ]
+    modules.read_state()
+    cursor.fetchall.return_value = [
+        ('sale', 'base'), ('sale_stock', 'sale'), ('sale_stock', 'stock'),
+    ]
+    expected = {'sale': {'base'}, 'sale_stock': {'sale', 'stock'}}
+    assert modules.read_dependencies() == expected
+    assert modules.read_dependencies() == expected
+    assert cursor.execute.call_count == 4
+    # an operation did not change the addons
+    modules.invalidate()
+    cursor.fetchone.return_value = (state_digest(u'sale:installed:16.0.1.0'),)
+    assert modules.read_dependencies() == expected
+    assert cursor.execute.call_count == 5  # digest
+    # an addon has been installed
+    modules.invalidate()
+    cursor.fetchone.return_value = ('ir_module_module_dependency',)
+    cursor.fetchall.side_effect = [
+        [('sale_stock', 'installed', '16.0.1.0', datetime(2026, 1, 2))],
+        [('sale', 'installed', '16.0.1.0', datetime(2026, 1, 1)),
+         ('sale_stock', 'installed', '16.0.1.0', datetime(2026, 1, 2))],
+        [('sale', 'base')],
+    ]
+    assert modules.read_dependencies() == {'sale': {'base'}}
+    # digest, modified rows, all the rows, dependencies
+    assert cursor.execute.call_count == 10
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import os
+
+import mock
+
+from marabunta.config import Config
+from marabunta.database import (
+    CheckpointTable, Database, MigrationTable, VersionLogTable, VersionRecord,
+)
+from marabunta.logs import LineBuffer, LogSink, OutputLog
+from marabunta.model import LogLimit, Operation
+from marabunta.parser import YamlParser
+from marabunta.runner import Runner
+
+
+def test_line_buffer_complete_lines():
+    logs = []
+
+    def log(msg, **kwargs):
+        logs.append(msg)
+
+    lines = LineBuffer(log, size=10, interval=60)
+    lines.write(u'first\r\nsec')
+    assert logs == [u'first']
+    lines.write(u'ond\r\n')
+    assert logs == [u'first']
+    lines.write(u'a line longer than the buffer')
+    assert logs == [u'first', u'second']
+    lines.write(u'!')
+    assert logs[-1] == u'a line longer than the buffer!'
+    lines.write(u'last')
+    lines.close()
+    assert logs[-1] == u'last'
+
+
+def test_output_log_split_character():
+    logs = []
+
+    def log(msg, **kwargs):
+        logs.append(msg)
+
+    output = OutputLog(log)
+    data = u'post-op with unicode é â\r\n'.encode('utf-8')
+    split = data.index(u'é'.encode('utf-8')) + 1
+    assert output.filter(data[:split]) == data[:split]
+    assert output.filter(data[split:]) == data[split:]
+    output.close()
+    assert logs == [u'post-op with unicode é â']
+
+
+def test_interactive_output_logged():
+    logs = []
+
+    def log(msg, **kwargs):
+        logs.append(msg)
+
+    def interact(output_filter=None):
+        output_filter(b'hello\r\n')
+        output_filter(b'world\r\n')
+
+    # output not read by interact before the command exited
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'again\r\n')
+    os.close(write_fd)
+    with mock.patch('pexpect.spawn') as spawn:
+        child = spawn.return_value
+        child.interact.side_effect = interact
+        child.child_fd = read_fd
+        child.STDOUT_FILENO = 1
+        child.signalstatus = None
+        child.exitstatus = 0
+        Operation('echo')._execute(log, interactive=True)
+    os.close(read_fd)
+    assert logs == [u'hello\nworld\nagain']
+
+
+def test_operation_log_limit(capfd):
+    logs = []
+
+    def log(msg, **kwargs):
+        logs.append(msg)
+
+    op = Operation('seq 1 2000', log_limit=LogLimit(head=1, tail=1))
+    op.execute(log)
+    assert logs[0] == u'seq 1 2000'
+    head, marker, tail = logs[1:]
+    assert head == u'\n'.join(str(i) for i in range(1, 2001))[:1024]
+    assert tail.endswith(u'1999\n2000') and len(tail) == 1024
+    # 8893 characters printed, without the last line ending
+    assert marker == u'[... {} characters dropped ...]'.format(8892 - 2048)
+    # the whole output is displayed
+    assert capfd.readouterr()[0].endswith(u'1999\n2000\n')
+
+
+def test_log_sink_batches():
+    table = mock.Mock(spec=VersionLogTable)
+    sink = LogSink(table, '1.0.0', batch_size=16, interval=60)
+    sink.write(0, u'start')
+    sink.write(1, u'echo foo')
+    assert not table.write.called
+    sink.write(1, u'foo')
+    assert table.write.call_args == mock.call([
+        ('1.0.0', 0, 0, u'start\n'),
+        ('1.0.0', 1, 0, u'echo foo\nfoo\n'),
+    ])
+    sink.write(1, u'bar')
+    sink.flush()
+    assert table.write.call_args == mock.call([
+        ('1.0.0', 1, 1, u'bar\n'),
+    ])
+
+
+def test_runner_log_storage_table(request, capfd):
+    migration_file = os.path.join(request.fspath.dirname,
+                                  'examples', 'migration.yml')
+    config = Config(migration_file, 'test', allow_serie=True,
+                    log_storage='table')
+    migration = YamlParser.parse_from_file(migration_file).parse()
+    table = mock.MagicMock(spec=MigrationTable)
+    table.versions.return_value = []
+    runner = Runner(config, migration, mock.MagicMock(spec=Database), table)
+    runner.log_table = mock.Mock(spec=VersionLogTable)
+    runner.perform()
+    assert runner.log_table.create_if_not_exists.called
+    rows = [row for call in runner.log_table.write.call_args_list
+            for row in call[0][0] if row[0] == 'setup']
+    assert rows == [
+        ('setup', 0, 0, u'start\nexecute base pre-operations\n'),
+        ('setup', 1, 0, u"echo 'pre-operation'\npre-operation\n"
+                        u'installation / upgrade of addons\n'
+                        u'execute base post-operations\n'),
+        ('setup', 2, 0, u"echo 'post-operation'\npost-operation\n"
+                        u'done\n'),
+    ]
+    # the log is not kept in marabunta_version
+    finish = table.finish_version.call_args_list[0]
+    assert finish[0][:1] == ('setup',) and finish[0][2] is None
+
+
+def test_runner_log_storage_table_resume(request, capfd):
+    migration_file = os.path.join(request.fspath.dirname,
+                                  'examples', 'migration.yml')
+    config = Config(migration_file, 'test', allow_serie=True,
+                    log_storage='table', resume=True)
+    migration = YamlParser.parse_from_file(migration_file).parse()
+    table = mock.MagicMock(spec=MigrationTable)
+    table.versions.return_value = [
+        VersionRecord('setup', '2026-01-01', '2026-01-01', '', ''),
+        VersionRecord('0.0.3', '2026-01-02', None, '', ''),
+    ]
+    runner = Runner(config, migration, mock.MagicMock(spec=Database), table)
+    runner.log_table = mock.Mock(spec=VersionLogTable)
+    # the failed run logged operations 0 to 2
+    runner.log_table.last_operation.return_value = 2
+    runner.checkpoint_table = mock.Mock(spec=CheckpointTable)
+    runner.checkpoint_table.read.return_value = set()
+    runner.perform()
+    # the log of the failed run is kept
+    assert mock.call('0.0.3') not in runner.log_table.clear.call_args_list
+    keys = [row[:3] for call in runner.log_table.write.call_args_list
+            for row in call[0][0] if row[0] == '0.0.3']
+    assert keys == [('0.0.3', 3, 0), ('0.0.3', 4, 0), ('0.0.3', 5, 0),
+                    ('0.0.3', 6, 0)]
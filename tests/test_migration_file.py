@@ -8,10 +8,14 @@ import os
 import mock
 
 from marabunta.config import Config
-from marabunta.database import Database, MigrationTable, VersionRecord
+from marabunta.database import (
+    CheckpointTable, Database, MigrationTable, OperationStatsTable,
+    VersionRecord,
+)
+from marabunta.model import Operation, ParallelOperation
 from marabunta.parser import YamlParser
-from marabunta.runner import Runner
-from marabunta.exception import MigrationError
+from marabunta.runner import Runner, VersionRunner
+from marabunta.exception import MigrationError, OperationError
 
 
 @pytest.fixture
@@ -40,11 +44,11 @@ def test_example_file_output(runner_gen, request, capfd):
         u'|> version setup: start\n'
         u'|> version setup: execute base pre-operations\n'
         u'|> version setup: echo \'pre-operation\'\n'
-        u'pre-operation\r\n'
+        u'pre-operation\n'
         u'|> version setup: installation / upgrade of addons\n'
         u'|> version setup: execute base post-operations\n'
         u'|> version setup: echo \'post-operation\'\n'
-        u'post-operation\r\n'
+        u'post-operation\n'
         u'|> version setup: done\n'
         u'|> migration: processing version 0.0.2\n'
         u'|> version 0.0.2: start\n'
@@ -54,13 +58,13 @@ def test_example_file_output(runner_gen, request, capfd):
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u'|> version 0.0.3: echo \'foobar\'\n'
-        u'foobar\r\n'
+        u'foobar\n'
         u'|> version 0.0.3: echo \'foobarbaz\'\n'
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: done\n'
         u'|> migration: processing version 0.0.4\n'
         u'|> version 0.0.4: start\n'
@@ -79,15 +83,15 @@ def test_example_file_output_mode(runner_gen, request, capfd):
         u'|> version setup: start\n'
         u'|> version setup: execute base pre-operations\n'
         u'|> version setup: echo \'pre-operation\'\n'
-        u'pre-operation\r\n'
+        u'pre-operation\n'
         u'|> version setup: execute full pre-operations\n'
         u'|> version setup: echo \'pre-operation executed only'
         u' when the mode is full\'\n'
-        u'pre-operation executed only when the mode is full\r\n'
+        u'pre-operation executed only when the mode is full\n'
         u'|> version setup: installation / upgrade of addons\n'
         u'|> version setup: execute base post-operations\n'
         u'|> version setup: echo \'post-operation\'\n'
-        u'post-operation\r\n'
+        u'post-operation\n'
         u'|> version setup: execute full post-operations\n'
         u'|> version setup: done\n'
         u'|> migration: processing version 0.0.2\n'
@@ -98,14 +102,14 @@ def test_example_file_output_mode(runner_gen, request, capfd):
         u'|> version 0.0.3: start\n'
         u'|> version 0.0.3: execute base pre-operations\n'
         u'|> version 0.0.3: echo \'foobar\'\n'
-        u'foobar\r\n'
+        u'foobar\n'
         u'|> version 0.0.3: echo \'foobarbaz\'\n'
-        u'foobarbaz\r\n'
+        u'foobarbaz\n'
         u'|> version 0.0.3: execute full pre-operations\n'
         u'|> version 0.0.3: installation / upgrade of addons\n'
         u'|> version 0.0.3: execute base post-operations\n'
         u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-        u'post-op with unicode é â\r\n'
+        u'post-op with unicode é â\n'
         u'|> version 0.0.3: execute full post-operations\n'
         u'|> version 0.0.3: done\n'
         u'|> migration: processing version 0.0.4\n'
@@ -127,11 +131,11 @@ def test_example_no_setup_file_output(runner_gen, request, capfd):
             u'|> version 0.0.1: start\n'
             u'|> version 0.0.1: execute base pre-operations\n'
             u'|> version 0.0.1: echo \'pre-operation\'\n'
-            u'pre-operation\r\n'
+            u'pre-operation\n'
             u'|> version 0.0.1: installation / upgrade of addons\n'
             u'|> version 0.0.1: execute base post-operations\n'
             u'|> version 0.0.1: echo \'post-operation\'\n'
-            u'post-operation\r\n'
+            u'post-operation\n'
             u'|> version 0.0.1: done\n'
             u'|> migration: processing version 0.0.2\n'
             u'|> version 0.0.2: start\n'
@@ -141,13 +145,13 @@ def test_example_no_setup_file_output(runner_gen, request, capfd):
             u'|> version 0.0.3: start\n'
             u'|> version 0.0.3: execute base pre-operations\n'
             u'|> version 0.0.3: echo \'foobar\'\n'
-            u'foobar\r\n'
+            u'foobar\n'
             u'|> version 0.0.3: echo \'foobarbaz\'\n'
-            u'foobarbaz\r\n'
+            u'foobarbaz\n'
             u'|> version 0.0.3: installation / upgrade of addons\n'
             u'|> version 0.0.3: execute base post-operations\n'
             u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-            u'post-op with unicode é â\r\n'
+            u'post-op with unicode é â\n'
             u'|> version 0.0.3: done\n'
             u'|> migration: processing version 0.0.4\n'
             u'|> version 0.0.4: start\n'
@@ -168,15 +172,15 @@ def test_example_no_setup_file_output_mode(runner_gen, request, capfd):
             u'|> version 0.0.1: start\n'
             u'|> version 0.0.1: execute base pre-operations\n'
             u'|> version 0.0.1: echo \'pre-operation\'\n'
-            u'pre-operation\r\n'
+            u'pre-operation\n'
             u'|> version 0.0.1: execute full pre-operations\n'
             u'|> version 0.0.1: echo \'pre-operation executed only'
             u' when the mode is full\'\n'
-            u'pre-operation executed only when the mode is full\r\n'
+            u'pre-operation executed only when the mode is full\n'
             u'|> version 0.0.1: installation / upgrade of addons\n'
             u'|> version 0.0.1: execute base post-operations\n'
             u'|> version 0.0.1: echo \'post-operation\'\n'
-            u'post-operation\r\n'
+            u'post-operation\n'
             u'|> version 0.0.1: execute full post-operations\n'
             u'|> version 0.0.1: done\n'
             u'|> migration: processing version 0.0.2\n'
@@ -187,14 +191,14 @@ def test_example_no_setup_file_output_mode(runner_gen, request, capfd):
             u'|> version 0.0.3: start\n'
             u'|> version 0.0.3: execute base pre-operations\n'
             u'|> version 0.0.3: echo \'foobar\'\n'
-            u'foobar\r\n'
+            u'foobar\n'
             u'|> version 0.0.3: echo \'foobarbaz\'\n'
-            u'foobarbaz\r\n'
+            u'foobarbaz\n'
             u'|> version 0.0.3: execute full pre-operations\n'
             u'|> version 0.0.3: installation / upgrade of addons\n'
             u'|> version 0.0.3: execute base post-operations\n'
             u'|> version 0.0.3: echo \'post-op with unicode é â\'\n'
-            u'post-op with unicode é â\r\n'
+            u'post-op with unicode é â\n'
             u'|> version 0.0.3: execute full post-operations\n'
             u'|> version 0.0.3: done\n'
             u'|> migration: processing version 0.0.4\n'
@@ -296,3 +300,185 @@ def test_allow_series_false(runner_gen, request, capfd):
             match=r"[.]*Only one version can be upgraded at a time.[.]*"
     ):
         runner.perform()
+
+
+def test_batch_addons(runner_gen, request, capfd):
+    runner = runner_gen('migration_batch_addons.yml')
+    runner.perform()
+    expected = (
+        u'|> migration: processing version setup\n'
+        u'|> version setup: start\n'
+        u'|> version setup: execute base pre-operations\n'
+        u'|> version setup: echo \'pre-operation\'\n'
+        u'pre-operation\n'
+        u'|> version setup: installation / upgrade of addons\n'
+        u'|> version setup: echo --workers=0 --stop-after-init --no-http '
+        u'-i base\n'
+        u'--workers=0 --stop-after-init --no-http -i base\n'
+        u'|> version setup: execute base post-operations\n'
+        u'|> version setup: done\n'
+        u'|> migration: processing versions 0.0.2, 0.0.3 in a batch\n'
+        u'|> version 0.0.2: start\n'
+        u'|> version 0.0.3: start\n'
+        u'|> version 0.0.3: installation / upgrade of addons of versions '
+        u'0.0.2, 0.0.3\n'
+        u'|> version 0.0.3: echo --workers=0 --stop-after-init --no-http '
+        u'-i purchase,sale\n'
+        u'--workers=0 --stop-after-init --no-http -i purchase,sale\n'
+        u'|> version 0.0.2: addons installed / upgraded with version 0.0.3\n'
+        u'|> version 0.0.2: done\n'
+        u'|> version 0.0.3: done\n'
+        u'|> migration: processing version 0.0.4\n'
+        u'|> version 0.0.4: start\n'
+        u'|> version 0.0.4: execute base pre-operations\n'
+        u'|> version 0.0.4: installation / upgrade of addons\n'
+        u'|> version 0.0.4: execute base post-operations\n'
+        u'|> version 0.0.4: echo \'post-operation\'\n'
+        u'post-operation\n'
+        u'|> version 0.0.4: done\n',
+        u''
+    )
+    assert expected == capfd.readouterr()
+    table = runner.table
+    assert [call[0][0] for call in table.finish_version.call_args_list] == [
+        'setup', '0.0.2', '0.0.3', '0.0.4',
+    ]
+
+
+def test_resume_batch_addons(runner_gen, request, capfd):
+    db_versions = [
+        VersionRecord('setup', '2026-01-01', '2026-01-01', '', ''),
+        VersionRecord('0.0.2', '2026-01-02', None, '', ''),
+        VersionRecord('0.0.3', '2026-01-02', None, '', ''),
+    ]
+    runner = runner_gen('migration_batch_addons.yml', db_versions=db_versions)
+    runner.config.resume = True
+    runner.checkpoint_table = mock.Mock(spec=CheckpointTable)
+    last = VersionRunner(runner, runner.migration.versions[2])
+    runner.checkpoint_table.read.side_effect = lambda number: {
+        '0.0.2': set(),
+        '0.0.3': {last.fingerprint((u'addons', 0, u'purchase,sale'))},
+    }[number]
+    runner.perform()
+    output = capfd.readouterr().out
+    assert (u'|> migration: processing versions 0.0.2, 0.0.3 in a batch\n'
+            u'|> version 0.0.2: resume, 0 steps already done\n'
+            u'|> version 0.0.2: start\n'
+            u'|> version 0.0.3: resume, 1 steps already done\n'
+            u'|> version 0.0.3: start\n'
+            u'|> version 0.0.3: skip installation / upgrade of addons, '
+            u'already done\n'
+            u'|> version 0.0.2: addons installed / upgraded with version '
+            u'0.0.3\n') in output
+    # the checkpoints are removed once the versions are done only
+    clear = runner.checkpoint_table.clear.call_args_list
+    assert clear[:2] == [mock.call('0.0.2'), mock.call('0.0.3')]
+
+
+def test_resume_failed_version(runner_gen, request, capfd):
+    db_versions = [
+        VersionRecord('setup', '2026-01-01', '2026-01-01', '', ''),
+        VersionRecord('0.0.3', '2026-01-02', None, '', ''),
+    ]
+    runner = runner_gen('migration.yml', db_versions=db_versions)
+    with pytest.raises(MigrationError):
+        runner.perform()
+
+    runner.config.resume = True
+    runner.checkpoint_table = mock.Mock(spec=CheckpointTable)
+    version = runner.migration.versions[2]
+    operation = version.pre_operations()[0]
+    runner.checkpoint_table.read.return_value = {
+        VersionRunner(runner, version).fingerprint((u'pre', 0, operation)),
+    }
+    runner.perform()
+    output = capfd.readouterr().out
+    assert (u'|> version 0.0.3: resume, 1 steps already done\n'
+            u'|> version 0.0.3: start\n'
+            u'|> version 0.0.3: execute base pre-operations\n'
+            u'|> version 0.0.3: skip Operation<echo \'foobar\'>, '
+            u'already done\n'
+            u'|> version 0.0.3: echo \'foobarbaz\'\n'
+            u'foobarbaz\n') in output
+    # the checkpoints are kept when resuming, removed once the version done
+    checkpoint_table = runner.checkpoint_table
+    assert checkpoint_table.clear.call_args_list.count(mock.call('0.0.3')) == 1
+    steps = [call[0][2] for call in checkpoint_table.record.call_args_list]
+    assert steps == [
+        u"pre 1 Operation<echo 'foobarbaz'>",
+        u"post 0 Operation<echo 'post-op with unicode é â'>",
+    ]
+
+
+def test_resume_failed_version_keeps_log(runner_gen, request, capfd):
+    db_versions = [
+        VersionRecord('setup', '2026-01-01', '2026-01-01', '', ''),
+        VersionRecord('0.0.3', '2026-01-02', None,
+                      u'echo \'foobar\'\nfoobar\nerror', ''),
+    ]
+    runner = runner_gen('migration.yml', db_versions=db_versions)
+    runner.config.resume = True
+    runner.checkpoint_table = mock.Mock(spec=CheckpointTable)
+    runner.checkpoint_table.read.return_value = set()
+    runner.perform()
+    table = runner.table
+    assert mock.call('0.0.3', mock.ANY, keep_log=True) in \
+        table.start_version.call_args_list
+    log = [call[0][2] for call in table.finish_version.call_args_list
+           if call[0][0] == '0.0.3'][0]
+    # the log of the resumed run follows the one of the failed run
+    assert log.startswith(u"echo 'foobar'\nfoobar\nerror\n\n"
+                          u"resume, 0 steps already done\nstart\n")
+
+
+def test_operation_stats(runner_gen, request, capfd):
+    runner = runner_gen('migration.yml', mode='full')
+    runner.stats_table = mock.Mock(spec=OperationStatsTable)
+    runner.perform()
+    rows = [row for call in runner.stats_table.write.call_args_list
+            for row in call[0][0]]
+    assert [row[:4] for row in rows] == [
+        ('setup', 'full', 'pre:0', u"echo 'pre-operation'"),
+        ('setup', 'full', 'pre:full:0',
+         u"echo 'pre-operation executed only when the mode is full'"),
+        ('setup', 'full', 'post:0', u"echo 'post-operation'"),
+        ('0.0.3', 'full', 'pre:0', u"echo 'foobar'"),
+        ('0.0.3', 'full', 'pre:1', u"echo 'foobarbaz'"),
+        ('0.0.3', 'full', 'post:0', u"echo 'post-op with unicode é â'"),
+    ]
+    assert all(row[5].exit_code == 0 for row in rows)
+
+
+def test_operation_stats_graph(runner_gen, request, capfd):
+    runner = runner_gen('migration.yml')
+    runner.stats_table = mock.Mock(spec=OperationStatsTable)
+    runner.stats_table.durations.return_value = {}
+    version = runner.migration.versions[0]
+    # operations without id, with the same command
+    version.post_operations()[:] = [
+        ParallelOperation([Operation('true'), Operation('true')]),
+    ]
+    runner.perform()
+    rows = [row for call in runner.stats_table.write.call_args_list
+            for row in call[0][0]]
+    assert [row[:4] for row in rows if row[:2] == ('setup', '') and
+            row[2].startswith('post')] == [
+        ('setup', '', 'post:0', u'true, true'),
+        ('setup', '', 'post:0:0', u'true'),
+        ('setup', '', 'post:0:1', u'true'),
+    ]
+    assert runner.stats_table.durations.call_args_list[0] == mock.call(
+        [u'true', u'true'],
+    )
+
+
+def test_operation_stats_error_not_hidden(runner_gen, request, capfd):
+    runner = runner_gen('migration.yml')
+    runner.stats_table = mock.Mock(spec=OperationStatsTable)
+    runner.stats_table.write.side_effect = RuntimeError('stats table')
+    version = runner.migration.versions[0]
+    version.pre_operations()[:] = [Operation('false')]
+    with pytest.raises(OperationError):
+        runner.perform()
+    assert (u'|> version setup: statistics of pre:0 not stored: stats table'
+            in capfd.readouterr().out)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import io
+import os
+
+import mock
+
+from marabunta import multi
+from marabunta.config import Config
+from marabunta.parser import YamlParser
+
+
+def test_prefixed_stream():
+    output = io.StringIO()
+    stream = multi.PrefixedStream(output, u'[db1] ')
+    stream.write(u'first line\nsecond ')
+    stream.write(u'line\r\n')
+    stream.write(u'third line\n')
+    assert output.getvalue() == (
+        u'[db1] first line\n'
+        u'[db1] second line\r\n'
+        u'[db1] third line\n'
+    )
+    assert not stream.isatty()
+
+
+def worker_state(request, tmpdir=None):
+    migration_file = os.path.join(request.fspath.dirname,
+                                  'examples', 'migration.yml')
+    config = Config(migration_file, None)
+    migration = YamlParser.parse_from_file(migration_file).parse()
+    multi._init_worker(config, migration, 'the_hash', mock.MagicMock(),
+                       tmpdir and str(tmpdir))
+
+
+def test_migrate_database_status(request, capfd):
+    worker_state(request)
+    with mock.patch.object(multi, 'is_up_to_date', return_value=False), \
+            mock.patch.object(multi, 'apply_migration',
+                              return_value=True) as apply_migration:
+        result = multi._migrate_database('db1')
+    assert result.database == 'db1'
+    assert result.status == 'done'
+    assert result.error is None
+    config = apply_migration.call_args[0][0]
+    assert config.database == 'db1'
+    # the migration parsed once is given to the runner
+    load_migration = apply_migration.call_args[0][3]
+    assert load_migration() is multi._worker['migration']
+
+    with mock.patch.object(multi, 'is_up_to_date', return_value=True):
+        result = multi._migrate_database('db2')
+    assert result.status == 'up to date'
+
+
+def test_migrate_database_failure_log_dir(request, tmpdir):
+    worker_state(request, tmpdir=tmpdir)
+    with mock.patch.object(multi, 'is_up_to_date',
+                           side_effect=RuntimeError('boom')):
+        result = multi._migrate_database('db1')
+    assert result.status == 'failed'
+    assert result.error == 'boom'
+    assert 'RuntimeError: boom' in tmpdir.join('db1.log').read()
@@ -3,11 +3,22 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
 import os
+import signal
+import sys
+import time
 
+import mock
+import pexpect
 import pytest
 
-from marabunta.exception import BackupError
-from marabunta.model import Operation, SilentOperation, BackupOperation
+from marabunta.exception import (
+    BackupError, ConfigurationError, OperationError, OperationTimeoutError,
+)
+from marabunta.model import (
+    Operation, OperationGraph, ParallelOperation, SilentOperation,
+    BackupOperation,
+)
+from marabunta.process import Watchdog, children_rusage, execution_stats
 
 
 def test_from_single_unicode():
@@ -39,7 +50,7 @@ def test_log_execute_output(capfd):
 
     op.execute(log)
     assert logs == [u'echo hello world', u'hello world']
-    assert capfd.readouterr() == (u'hello world\r\n', '')
+    assert capfd.readouterr() == (u'hello world\n', '')
 
 
 def test_shell_operation(capfd):
@@ -53,7 +64,230 @@ def test_shell_operation(capfd):
 
     op.execute(log)
     assert logs == [u'echo $PYTEST_CURRENT_TEST', test]
-    assert capfd.readouterr() == (u'%s\r\n' % test, '')
+    assert capfd.readouterr() == (u'%s\n' % test, '')
+
+
+def test_execute_stderr(capfd):
+    op = Operation('echo out; echo err >&2', shell=True)
+    logs = []
+
+    def log(msg, **kwargs):
+        logs.append(msg)
+
+    op.execute(log)
+    assert sorted(logs[1:]) == [u'err', u'out']
+    assert sorted(capfd.readouterr()[0].splitlines()) == [u'err', u'out']
+
+
+def test_execute_stats():
+    op = Operation('sh -c "exit 3"')
+    with pytest.raises(OperationError):
+        op.execute(lambda msg, **kwargs: None)
+    assert op.stats.exit_code == 3
+    op = Operation('python -c "bytearray(50 * 1024 * 1024)"')
+    op.execute(lambda msg, **kwargs: None)
+    assert op.stats.exit_code == 0
+    assert op.stats.wall_time > 0
+    assert op.stats.max_rss > 50 * 1024
+
+
+def test_execution_stats_without_rusage():
+    # a command reaped by pexpect: the maximum resident set size of all
+    # the children is not the one of the command
+    Operation('python -c "bytearray(50 * 1024 * 1024)"').execute(
+        lambda msg, **kwargs: None,
+    )
+    stats = execution_stats(1., 0, children=children_rusage())
+    assert stats.max_rss is None
+    assert stats.cpu_time < 0.1
+
+
+def test_execute_signal():
+    op = Operation('kill -TERM $$', shell=True)
+    with pytest.raises(OperationError) as err:
+        op.execute(lambda msg, **kwargs: None)
+    assert u'interrupted by signal 15' in u'{}'.format(err.value)
+
+
+def test_parallel_operation_outputs():
+    op = ParallelOperation([
+        Operation('echo a1; sleep 0.2; echo a2', shell=True),
+        Operation('sleep 0.1; echo b1; sleep 0.2; echo b2', shell=True),
+    ])
+    logs = []
+
+    def log(msg, **kwargs):
+        logs.append(msg)
+
+    op.execute(log)
+    # the outputs are logged once each operation is done, not mixed
+    a = logs.index(u'echo a1; sleep 0.2; echo a2')
+    b = logs.index(u'sleep 0.1; echo b1; sleep 0.2; echo b2')
+    assert u'\n'.join(logs[a + 1:a + 2]).split() == [u'a1', u'a2']
+    assert u'\n'.join(logs[b + 1:b + 2]).split() == [u'b1', u'b2']
+
+
+def test_parallel_operation_output_file():
+    op = ParallelOperation([
+        Operation('seq 1 100000'),
+        Operation(u'echo é'),
+    ])
+    # the output of an operation is kept in a file until it ends
+    output, error, __, __, __ = op._run(op.operations[0])
+    assert error is None
+    output.seek(0)
+    assert output.read().split() == [u'{}'.format(number)
+                                     for number in range(1, 100001)]
+    output.close()
+
+    logs = []
+    op.execute(lambda msg, **kwargs: logs.append(msg))
+    output = u'\n'.join(logs[logs.index(u'seq 1 100000') + 1:])
+    assert output.split()[:100000] == [u'{}'.format(number)
+                                       for number in range(1, 100001)]
+    assert logs[logs.index(u'echo é') + 1] == u'é'
+
+
+def test_parallel_operation_cancel():
+    op = ParallelOperation([
+        Operation('sleep 0.2; exit 3', shell=True),
+        Operation('sleep 30', shell=True),
+        Operation('echo never', shell=True),
+    ], max_workers=2)
+    logs = []
+
+    def log(msg, **kwargs):
+        logs.append(msg)
+
+    start = time.time()
+    with pytest.raises(OperationError) as err:
+        op.execute(log)
+    assert time.time() - start < 10
+    assert u"command 'sleep 0.2; exit 3' returned 3" == u'{}'.format(err.value)
+    assert u"command 'sleep 30' has been interrupted by signal 15" in logs
+    assert u'echo never: cancelled' in logs
+
+
+def test_operation_graph_critical_path():
+    graph = OperationGraph(
+        [Operation(u'echo {}'.format(name)) for name in 'abcd'],
+        [set(), set(), {1}, {2}],
+        max_workers=1,
+        names=list(u'abcd'),
+    )
+    assert graph.priorities == [1, 3, 2, 1]
+    logs = []
+
+    def log(msg, **kwargs):
+        logs.append(msg)
+
+    graph.execute(log)
+    # the longest chain is started first, then by order of declaration
+    assert [msg for msg in logs if msg.startswith(u'echo')] == [
+        u'echo b', u'echo c', u'echo a', u'echo d',
+    ]
+    assert len([msg for msg in logs if u': started at ' in msg]) == 4
+    assert sorted(graph.node_stats) == [0, 1, 2, 3]
+    assert graph.stats.exit_code == 0
+    assert graph.stats.wall_time >= max(
+        stats.wall_time for stats in graph.node_stats.values()
+    )
+
+
+def test_operation_graph_failure():
+    # the failing operation starts once 'echo b' is done, 'echo after'
+    # is never started
+    graph = OperationGraph(
+        [Operation('echo b'), Operation('false'), Operation('echo after')],
+        [set(), {0}, {1}],
+    )
+    logs = []
+    with pytest.raises(OperationError):
+        graph.execute(lambda msg, **kwargs: logs.append(msg))
+    assert u'echo after: cancelled' in logs
+    assert u'echo b' in logs
+    assert sorted(graph.node_stats) == [0, 1]
+
+
+def test_operation_graph_durations():
+    graph = OperationGraph(
+        [Operation(u'echo {}'.format(name)) for name in 'abcd'],
+        [set(), set(), {1}, {2}],
+        names=list(u'abcd'),
+    )
+    # 'a' alone lasts longer than the chain b, c, d
+    graph.set_durations({u'echo a': 60., u'echo b': 10., u'echo c': 10.,
+                         u'echo d': 10.})
+    assert graph.priorities == [60., 30., 20., 10.]
+    # the unknown durations are the average of the known ones
+    graph.set_durations({u'echo a': 30.})
+    assert graph.priorities == [30., 90., 60., 30.]
+
+
+def test_operation_graph_cycle():
+    with pytest.raises(ConfigurationError):
+        OperationGraph([Operation('ls'), Operation('ls -l')], [{1}, {0}])
+
+
+def test_execute_timeout():
+    op = Operation('sleep 30; echo never', shell=True, timeout=0.2)
+    logs = []
+    start = time.time()
+    with pytest.raises(OperationTimeoutError) as err:
+        op.execute(lambda msg, **kwargs: logs.append(msg))
+    assert time.time() - start < 10
+    message = u'{}'.format(err.value)
+    assert message.startswith(u"command 'sleep 30; echo never' has been "
+                              u"terminated after its timeout of 0.2 seconds")
+    assert u'max RSS' in message
+    assert u'never' not in logs
+
+
+def test_interactive_fast_command_timeout():
+    # interact needs a terminal, the operations are executed in one
+    script = (
+        u"from marabunta.model import Operation\n"
+        u"logs = []\n"
+        u"for __ in range(10):\n"
+        u"    Operation('seq 1 5')._execute(\n"
+        u"        lambda msg, **kwargs: logs.append(msg), timeout=5,\n"
+        u"    )\n"
+        u"print('log:', ' '.join(' '.join(logs).split()))\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    child = pexpect.spawn(sys.executable, ['-c', script], encoding='utf8',
+                          env=dict(os.environ, PYTHONPATH=root), timeout=60)
+    child.expect(pexpect.EOF)
+    child.close()
+    assert child.exitstatus == 0
+    # the output of the commands exiting before it is read is logged
+    assert u'log: {}'.format(u' '.join([u'1 2 3 4 5'] * 10)) in child.before
+
+
+def test_execute_default_timeout():
+    op = Operation('sleep 30')
+    with pytest.raises(OperationTimeoutError):
+        op.execute(lambda msg, **kwargs: None, default_timeout=0.2)
+    op = Operation('true', timeout=5)
+    op.execute(lambda msg, **kwargs: None, default_timeout=0.01)
+
+
+def test_silent_operation_timeout():
+    op = SilentOperation('sleep 30', timeout=0.2)
+    with pytest.raises(OperationTimeoutError):
+        op.execute()
+
+
+def test_watchdog_kill():
+    send_signal = mock.Mock()
+    with Watchdog(send_signal, 0.05, grace=0.05) as watchdog:
+        time.sleep(0.5)
+    assert watchdog.expired
+    assert send_signal.call_args_list == [mock.call(signal.SIGTERM),
+                                          mock.call(signal.SIGKILL)]
+    with Watchdog(send_signal, 10) as watchdog:
+        pass
+    assert not watchdog.expired
 
 
 def test_silent_operation(capfd):
@@ -5,6 +5,9 @@
 
 from io import StringIO
 import pytest
+from marabunta.config import Config
+from marabunta.exception import ParseError
+from marabunta.model import OperationGraph, ParallelOperation
 from marabunta.parser import YamlParser, YAML_EXAMPLE
 from ruamel.yaml.constructor import DuplicateKeyError
 
@@ -46,3 +49,147 @@ def test_dublicate_key_exception():
     with pytest.raises(DuplicateKeyError):
         parser = YamlParser.parser_from_buffer(yaml_file)
         parser.parse()
+
+
+def test_parse_log_limit():
+    file_example = StringIO(YAML_EXAMPLE)
+    parser = YamlParser.parser_from_buffer(file_example)
+    migration = parser.parse()
+    options = migration.options
+    assert (options.log_limit.head, options.log_limit.tail) == (512, 2048)
+    assert options.backup.command_operation(Config('m.yml', 'db')).log_limit \
+        is options.log_limit
+    version = migration.versions[2]
+    pre = version.pre_operations()[0]
+    assert pre.log_limit is options.log_limit
+    post = version.post_operations()[1]
+    assert post.command == 'anthem songs::verbose'
+    assert (post.log_limit.head, post.log_limit.tail) == (0, 64)
+
+
+def test_parse_log_limit_invalid():
+    yaml = u"""
+migration:
+  options:
+    log_limit:
+      head: -1
+  versions:
+    - version: setup
+"""
+    parser = YamlParser.parser_from_buffer(StringIO(yaml))
+    with pytest.raises(ParseError):
+        parser.parse()
+
+
+def test_parse_operation_without_command():
+    yaml = u"""
+migration:
+  versions:
+    - version: setup
+      operations:
+        post:
+          - log_limit:
+              head: 10
+"""
+    parser = YamlParser.parser_from_buffer(StringIO(yaml))
+    with pytest.raises(ParseError) as err:
+        parser.parse()
+    assert u"version setup: an operation of 'post' has no 'command' key" in \
+        u'{}'.format(err.value)
+
+
+def test_parse_parallel():
+    file_example = StringIO(YAML_EXAMPLE)
+    migration = YamlParser.parser_from_buffer(file_example).parse()
+    parallel = migration.versions[2].post_operations()[2]
+    assert isinstance(parallel, ParallelOperation)
+    assert parallel.max_workers == 2
+    assert [op.command for op in parallel.operations] == [
+        u'anthem songs::load_company_a',
+        u'anthem songs::load_company_b',
+        u'anthem songs::load_company_c',
+    ]
+    assert parallel.operations[0].log_limit is migration.options.log_limit
+
+
+def test_parse_parallel_invalid():
+    yaml = u"""
+migration:
+  versions:
+    - version: setup
+      operations:
+        post:
+          - parallel:
+              max_workers: 0
+              operations:
+                - echo 'foo'
+"""
+    parser = YamlParser.parser_from_buffer(StringIO(yaml))
+    with pytest.raises(ParseError):
+        parser.parse()
+
+
+def test_parse_graph():
+    file_example = StringIO(YAML_EXAMPLE)
+    migration = YamlParser.parser_from_buffer(file_example).parse()
+    graph, = migration.versions[3].post_operations()
+    assert isinstance(graph, OperationGraph)
+    assert graph.max_workers == 4
+    assert graph.names == [u'partners', u'products', u'orders',
+                           u'anthem songs::fix_invoices']
+    assert graph.after == [set(), set(), {0, 1}, {0}]
+
+
+@pytest.mark.parametrize('after', [u'[unknown]', u'[partners, orders]',
+                                   u'[[partners]]', u'{partners: 1}'])
+def test_parse_graph_invalid(after):
+    yaml = u"""
+migration:
+  versions:
+    - version: setup
+      operations:
+        post:
+          - id: partners
+            command: echo 'partners'
+            after: {}
+          - id: orders
+            command: echo 'orders'
+            after: [partners]
+""".format(after)
+    parser = YamlParser.parser_from_buffer(StringIO(yaml))
+    with pytest.raises(ParseError):
+        parser.parse()
+
+
+@pytest.mark.parametrize('operation', [
+    u"echo 'invoices'",
+    u"command: echo 'invoices'",
+    u"id: [invoices]\n            command: echo 'invoices'",
+])
+def test_parse_graph_without_id(operation):
+    yaml = u"""
+migration:
+  versions:
+    - version: setup
+      operations:
+        post:
+          - id: partners
+            command: echo 'partners'
+          - {}
+""".format(operation)
+    parser = YamlParser.parser_from_buffer(StringIO(yaml))
+    with pytest.raises(ParseError):
+        parser.parse()
+
+
+def test_parse_timeout():
+    file_example = StringIO(YAML_EXAMPLE)
+    migration = YamlParser.parser_from_buffer(file_example).parse()
+    assert migration.options.timeout == 3600
+    version = migration.versions[2]
+    assert version.pre_operations()[0].timeout == 3600
+    assert version.post_operations()[1].timeout == 600
+    config = Config('m.yml', 'db')
+    backup = migration.options.backup
+    assert backup.command_operation(config).timeout == 3600
+    assert backup.ignore_if_operation().timeout == 3600
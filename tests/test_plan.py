@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import json
+import os
+
+from collections import namedtuple
+from datetime import datetime
+
+import mock
+import pytest
+
+from marabunta.config import Config
+from marabunta.database import (
+    CheckpointTable, Database, IrModuleModule, MigrationTable,
+    OperationStatsTable, VersionRecord,
+)
+from marabunta.exception import MigrationError
+from marabunta.parser import YamlParser
+from marabunta.plan import Plan, format_plan
+from marabunta.runner import Runner, VersionRunner
+
+ModuleRecord = namedtuple('ModuleRecord', 'name state latest_version',
+                          defaults=(None,))
+
+
+@pytest.fixture
+def plan_gen(request):
+    def plan(filename, db_versions=None, **kwargs):
+        migration_file = os.path.join(request.fspath.dirname,
+                                      'examples', filename)
+        config = Config(migration_file, 'test', allow_serie=True, **kwargs)
+        migration = YamlParser.parse_from_file(migration_file).parse()
+        table = mock.MagicMock(spec=MigrationTable)
+        table.exists.return_value = True
+        table.versions.return_value = db_versions or []
+        runner = Runner(config, migration, mock.MagicMock(spec=Database),
+                        table)
+        runner.module_table = mock.Mock(spec=IrModuleModule)
+        runner.module_table.read_state.return_value = [
+            ModuleRecord('base', 'installed'),
+        ]
+        runner.module_table.read_dependencies.return_value = {}
+        runner.stats_table = mock.Mock(spec=OperationStatsTable)
+        runner.stats_table.durations.return_value = {
+            u"echo 'pre-operation'": 2.,
+        }
+        runner.stats_table.stage_duration.return_value = 60.
+        runner.checkpoint_table = mock.Mock(spec=CheckpointTable)
+        return Plan(runner)
+    return plan
+
+
+def test_plan(plan_gen, capfd):
+    plan = plan_gen('migration_batch_addons.yml', db_versions=[
+        VersionRecord('setup', datetime(2026, 1, 1), datetime(2026, 1, 1),
+                      '', ''),
+    ])
+    result = plan.build()
+    assert [(version['versions'], [step['command']
+                                   for step in version['steps']])
+            for version in result['versions']] == [
+        (['0.0.2', '0.0.3'],
+         [u'echo --workers=0 --stop-after-init --no-http -i purchase,sale']),
+        (['0.0.4'], [u"echo 'post-operation'"]),
+    ]
+    assert result['versions'][0]['estimate'] == 60.
+    assert result['unknown'] == 1
+    # nothing is executed nor written
+    assert capfd.readouterr() == ('', '')
+    runner = plan.runner
+    assert not runner.table.create_if_not_exists.called
+    assert not runner.table.start_version.called
+    assert not runner.checkpoint_table.record.called
+    json.dumps(result)
+
+
+def test_plan_resume(plan_gen):
+    plan = plan_gen('migration_batch_addons.yml', resume=True, db_versions=[
+        VersionRecord('setup', datetime(2026, 1, 1), None, '', ''),
+    ])
+    runner = plan.runner
+    version = runner.migration.versions[0]
+    runner.checkpoint_table.read.return_value = {
+        VersionRunner(runner, version).fingerprint(
+            (u'pre', 0, version.pre_operations()[0])
+        ),
+    }
+    result = plan.build()
+    steps = result['versions'][0]['steps']
+    assert [(step['command'], step['done'], step['estimate'])
+            for step in steps] == [
+        (u"echo 'pre-operation'", True, 0.),
+        (u'echo --workers=0 --stop-after-init --no-http -u base', False,
+         60.),
+    ]
+
+
+def test_plan_unfinished(plan_gen):
+    plan = plan_gen('migration_batch_addons.yml', db_versions=[
+        VersionRecord('setup', datetime(2026, 1, 1), None, '', ''),
+    ])
+    with pytest.raises(MigrationError):
+        plan.build()
+
+
+def test_format_plan(plan_gen):
+    plan = plan_gen('migration.yml', mode='full')
+    text = format_plan(plan.build())
+    assert text.splitlines()[:4] == [
+        u'migration plan of database test in mode full',
+        u'version setup [0:00:02]',
+        u"  pre      echo 'pre-operation' [0:00:02]",
+        u"  pre:full echo 'pre-operation executed only when the mode is "
+        u"full' [unknown]",
+    ]
+    assert text.splitlines()[-1] == (
+        u'estimated duration: 0:00:02 (5 steps without history)'
+    )